@@ -0,0 +1,359 @@
+"""
+APIクライアントの共有レジストリ
+Anthropic / Gemini のクライアントをプロセス全体で使い回し、HTTP接続を維持する
+APIキーが変更された場合・クライアントが閉じられた場合は自動で作り直す
+非同期クライアントはイベントループごとに作成する（接続がループに紐づくため）
+SDK（anthropic / google-genai）は読み込みに時間がかかるため、最初にクライアントを作成する時点で import する
+"""
+
+import os
+import time
+import asyncio
+import weakref
+import hashlib
+import threading
+from typing import TYPE_CHECKING, Awaitable, Dict, Any, Optional, Tuple
+
+from metrics import log_event
+
+if TYPE_CHECKING:
+    import httpx
+    import anthropic
+    from google import genai
+
+# HTTP接続プールの設定（Gemini用）
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY_SECONDS = 120.0
+
+
+def _key_fingerprint(api_key: Optional[str]) -> str:
+    """APIキーそのものは保持せず、変更検知用のハッシュだけを保持する"""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+
+class _ClientStats:
+    """クライアント単位の利用統計（接続の再利用状況を含む）"""
+
+    def __init__(self):
+        self.builds = 0
+        self.reuses = 0
+        self.requests = 0
+        self.connections = 0
+        # 使用中の接続（network_stream）。id() は回収後に再利用されるため、オブジェクトを弱参照で持つ
+        self._streams: "weakref.WeakSet[Any]" = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def on_response(self, response: Any) -> None:
+        # 同じ network_stream が使われていれば既存接続の再利用
+        stream = response.extensions.get("network_stream")
+        with self._lock:
+            self.requests += 1
+            if stream is not None and stream not in self._streams:
+                self._streams.add(stream)
+                self.connections += 1
+
+    async def on_response_async(self, response: Any) -> None:
+        self.on_response(response)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            connections = self.connections
+            requests = self.requests
+        return {
+            "builds": self.builds,
+            "reuses": self.reuses,
+            "requests": requests,
+            "connections_opened": connections,
+            "connection_reuse_rate": 1 - connections / requests if requests and connections else 0.0,
+        }
+
+
+class ClientRegistry:
+    """
+    Anthropic / Gemini クライアントのレジストリ
+    st.cache_resource と組み合わせてStreamlitの全セッションで共有する
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # (名前, イベントループID) -> 非同期クライアント
+        self._async_entries: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._stats = {"anthropic": _ClientStats(), "gemini": _ClientStats()}
+        # クローズ中のタスク
+        self._closing = set()
+
+    def _http_client(self, name: str) -> "httpx.Client":
+        import httpx
+
+        return httpx.Client(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            event_hooks={"response": [self._stats[name].on_response]},
+        )
+
+    def _build_anthropic(self, api_key: Optional[str]) -> Dict[str, Any]:
+        import anthropic
+
+        # SDKが使うHTTPライブラリに合わせるため DefaultHttpxClient を使用（接続プールはSDK既定値）
+        http_client = anthropic.DefaultHttpxClient(
+            event_hooks={"response": [self._stats["anthropic"].on_response]},
+        )
+        client = anthropic.Anthropic(api_key=api_key, http_client=http_client)
+        return {"client": client, "http_client": http_client}
+
+    def _build_gemini(self, api_key: Optional[str]) -> Dict[str, Any]:
+        from google import genai
+        from google.genai import types
+
+        # 古い google-genai には httpx_client オプションがないため、その場合は内部プールを使用
+        if "httpx_client" in types.HttpOptions.model_fields:
+            http_client = self._http_client("gemini")
+            client = genai.Client(api_key=api_key, http_options=types.HttpOptions(httpx_client=http_client))
+        else:
+            http_client = None
+            client = genai.Client(api_key=api_key)
+        return {"client": client, "http_client": http_client}
+
+    def _async_http_client(self, name: str) -> "httpx.AsyncClient":
+        import httpx
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            event_hooks={"response": [self._stats[name].on_response_async]},
+        )
+
+    def _build_async_anthropic(self, api_key: Optional[str]) -> Dict[str, Any]:
+        import anthropic
+
+        http_client = anthropic.DefaultAsyncHttpxClient(
+            event_hooks={"response": [self._stats["anthropic"].on_response_async]},
+        )
+        client = anthropic.AsyncAnthropic(api_key=api_key, http_client=http_client)
+        return {"client": client, "http_client": http_client}
+
+    def _build_async_gemini(self, api_key: Optional[str]) -> Dict[str, Any]:
+        from google import genai
+        from google.genai import types
+
+        # 非同期呼び出しは client.aio 経由で行う
+        if "httpx_async_client" in types.HttpOptions.model_fields:
+            http_client = self._async_http_client("gemini")
+            client = genai.Client(api_key=api_key, http_options=types.HttpOptions(httpx_async_client=http_client))
+        else:
+            http_client = None
+            client = genai.Client(api_key=api_key)
+        return {"client": client, "http_client": http_client}
+
+    def _is_alive(self, entry: Dict[str, Any]) -> bool:
+        client = entry["client"]
+        if hasattr(client, "is_closed") and client.is_closed():
+            return False
+        http_client = entry.get("http_client")
+        if http_client is not None and http_client.is_closed:
+            return False
+        return True
+
+    def _get(self, name: str, env_var: str, builder) -> Any:
+        api_key = os.getenv(env_var)
+        fingerprint = _key_fingerprint(api_key)
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry["key_fingerprint"] == fingerprint and self._is_alive(entry):
+                self._stats[name].reuses += 1
+                return entry["client"]
+
+            # 初回・APIキー変更・接続切断時は作り直す
+            if entry:
+                self._close_entry(entry)
+            entry = builder(api_key)
+            entry.update(key_fingerprint=fingerprint, created_at=time.time())
+            self._entries[name] = entry
+            self._stats[name].builds += 1
+            return entry["client"]
+
+    def _get_async(self, name: str, env_var: str, builder) -> Any:
+        loop = asyncio.get_running_loop()
+        api_key = os.getenv(env_var)
+        fingerprint = _key_fingerprint(api_key)
+        key = (name, id(loop))
+
+        with self._lock:
+            # 終了したイベントループのクライアントは破棄
+            for stale_key, stale in list(self._async_entries.items()):
+                stale_loop = stale["loop_ref"]()
+                if stale_loop is None or stale_loop.is_closed():
+                    self._discard_async_entry(self._async_entries.pop(stale_key))
+
+            entry = self._async_entries.get(key)
+            if (entry and entry["loop_ref"]() is loop
+                    and entry["key_fingerprint"] == fingerprint and self._is_alive(entry)):
+                self._stats[name].reuses += 1
+                return entry["client"]
+
+            # APIキー変更・接続切断時は古いクライアントを閉じてから作り直す
+            if entry:
+                self._discard_async_entry(entry)
+            entry = builder(api_key)
+            entry.update(key_fingerprint=fingerprint, created_at=time.time(), loop_ref=weakref.ref(loop))
+            self._async_entries[key] = entry
+            self._stats[name].builds += 1
+            return entry["client"]
+
+    async def _aclose_entry(self, entry: Dict[str, Any]) -> None:
+        try:
+            if hasattr(entry["client"], "close") and asyncio.iscoroutinefunction(entry["client"].close):
+                await entry["client"].close()
+            if entry.get("http_client") is not None:
+                await entry["http_client"].aclose()
+        except Exception as e:
+            log_event("client_close_failed", f"⚠️ 非同期クライアントのクローズに失敗: {e}", error=str(e))
+
+    def _discard_async_entry(self, entry: Dict[str, Any]) -> None:
+        """
+        非同期クライアントを閉じる（作成したイベントループ上で aclose() を実行する）
+        ループがすでに終了している場合は閉じられないため、接続はガベージコレクション時に解放される
+        """
+        loop = entry["loop_ref"]()
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running:
+            task = loop.create_task(self._aclose_entry(entry))
+            # 完了前にタスクが回収されないよう参照を持つ
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        else:
+            asyncio.run_coroutine_threadsafe(self._aclose_entry(entry), loop)
+
+    async def aclose_loop(self) -> None:
+        """現在のイベントループ用の非同期クライアントをすべて閉じる（ループを終了する前に呼ぶ）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entries = [self._async_entries.pop(key) for key, entry in list(self._async_entries.items())
+                       if entry["loop_ref"]() is loop]
+        for entry in entries:
+            await self._aclose_entry(entry)
+
+    def anthropic_client(self) -> "anthropic.Anthropic":
+        """共有 Anthropic クライアントを取得"""
+        return self._get("anthropic", "ANTHROPIC_API_KEY", self._build_anthropic)
+
+    def gemini_client(self) -> "genai.Client":
+        """共有 Gemini クライアントを取得"""
+        return self._get("gemini", "GEMINI_API_KEY", self._build_gemini)
+
+    def async_anthropic_client(self) -> "anthropic.AsyncAnthropic":
+        """現在のイベントループ用の AsyncAnthropic クライアントを取得"""
+        return self._get_async("anthropic", "ANTHROPIC_API_KEY", self._build_async_anthropic)
+
+    def async_gemini_client(self) -> "genai.Client":
+        """現在のイベントループ用の Gemini クライアントを取得（client.aio を使用）"""
+        return self._get_async("gemini", "GEMINI_API_KEY", self._build_async_gemini)
+
+    def check_health(self) -> Dict[str, bool]:
+        """各クライアントが利用可能か確認し、閉じられたものは破棄（次回取得時に再作成）"""
+        health = {}
+        with self._lock:
+            for name, entry in list(self._entries.items()):
+                alive = self._is_alive(entry)
+                if not alive:
+                    self._close_entry(entry)
+                    del self._entries[name]
+                health[name] = alive
+        return health
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """クライアントごとの作成回数・再利用回数・接続再利用率"""
+        result = {}
+        for name, client_stats in self._stats.items():
+            result[name] = client_stats.snapshot()
+            entry = self._entries.get(name)
+            result[name]["age_seconds"] = time.time() - entry["created_at"] if entry else None
+        return result
+
+    def _close_entry(self, entry: Dict[str, Any]) -> None:
+        try:
+            if hasattr(entry["client"], "close"):
+                entry["client"].close()
+            if entry.get("http_client") is not None:
+                entry["http_client"].close()
+        except Exception as e:
+            log_event("client_close_failed", f"⚠️ クライアントのクローズに失敗: {e}", error=str(e))
+
+    def close(self) -> None:
+        """すべてのクライアントを閉じる"""
+        with self._lock:
+            for entry in self._entries.values():
+                self._close_entry(entry)
+            self._entries.clear()
+            for entry in self._async_entries.values():
+                self._discard_async_entry(entry)
+            self._async_entries.clear()
+
+
+_registry: Optional[ClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> ClientRegistry:
+    """プロセス共通のクライアントレジストリを取得"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ClientRegistry()
+        return _registry
+
+
+def set_client_registry(registry: ClientRegistry) -> None:
+    """使用するレジストリを差し替える（Streamlitの cache_resource で作成したものなど）"""
+    global _registry
+    with _registry_lock:
+        _registry = registry
+
+
+def get_anthropic_client() -> "anthropic.Anthropic":
+    """共有 Anthropic クライアントを取得"""
+    return get_client_registry().anthropic_client()
+
+
+def get_gemini_client() -> "genai.Client":
+    """共有 Gemini クライアントを取得"""
+    return get_client_registry().gemini_client()
+
+
+def get_async_anthropic_client() -> "anthropic.AsyncAnthropic":
+    """現在のイベントループ用の共有 AsyncAnthropic クライアントを取得"""
+    return get_client_registry().async_anthropic_client()
+
+
+def get_async_gemini_client() -> "genai.Client":
+    """現在のイベントループ用の共有 Gemini クライアントを取得"""
+    return get_client_registry().async_gemini_client()
+
+
+def run_async(awaitable: Awaitable[Any]) -> Any:
+    """
+    asyncio.run の代わりに使う（ループを終了する前に、そのループで作成した非同期クライアントを閉じる）
+    """
+    async def main() -> Any:
+        try:
+            return await awaitable
+        finally:
+            await get_client_registry().aclose_loop()
+
+    return asyncio.run(main())
@@ -7,12 +7,36 @@ import streamlit as st
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from prompt_converter import convert_prompt_with_claude
-from image_generator import generate_image_with_gemini
+from prompt_converter import get_cache_usage, lookup_cached_prompt, revise_prompt_with_claude, store_cached_prompt
+from brand_compliance import ComplianceChecker, log_compliance
+from prompt_router import (
+    DEFAULT_BUDGET_SECONDS, SOURCE_CACHE, SOURCE_CLAUDE, SOURCE_LOCAL, SOURCE_SPECULATION,
+    ClaudeRoute, fallback_to_local
+)
+from prompt_cache import get_prompt_cache
+from prompt_speculator import PromptSpeculator
+from api_clients import ClientRegistry, set_client_registry
+from app_config import (
+    STAFF, LOCATIONS, SITUATIONS, ASPECT_RATIOS, CLIENT_TYPES, PURPOSE_OPTIONS,
+    STAFF_DIR, BACKGROUNDS_DIR, OUTPUTS_DIR
+)
+from pipeline import run_generation_job
+from job_queue import JobQueue, JobWorkerPool
+from output_store import get_output_store
+from thumbnails import get_thumbnail_cache
+from output_encoder import get_output_encoder
+from result_buffers import get_result_buffers
+from lan_server import LanFileServer
+from reference_selector import DEFAULT_BYTE_BUDGET, REASON_LABELS, get_reference_selector
+from smart_crop import EXPORT_FORMATS, crop_preview, export_formats, master_aspect_ratio
+from asset_index import AssetIndex
+from ui_assets import APP_CSS, ICONS, icon
+from resilience import get_resilient_caller
+from scheduler import get_scheduler, request_context
+from metrics import MetricsExporter, log_event, record_stage, stage_summary
+import time
+import uuid
 import base64
-from datetime import datetime
-import qrcode
-from io import BytesIO
 
 # 環境変数読み込み
 load_dotenv()
@@ -26,407 +50,450 @@ st.set_page_config(
 )
 
 # カスタムCSS（マジンガーZ / 光子力研究所風デザイン）
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Orbitron:wght@400;700;900&family=Noto+Sans+JP:wght@400;700;900&display=swap');
-
-    .stApp {
-        background: linear-gradient(135deg, #0a0a0a 0%, #1a1a2e 50%, #0a0a0a 100%);
-    }
-
-    /* 全体のテキストを白色に */
-    .stApp, .stApp p, .stApp span, .stApp label, .stApp div {
-        color: #ffffff !important;
-    }
+st.markdown(APP_CSS, unsafe_allow_html=True)
+
+@st.cache_resource
+def get_shared_client_registry() -> ClientRegistry:
+    """全セッションで共有するAPIクライアントのレジストリ"""
+    registry = ClientRegistry()
+    set_client_registry(registry)
+    return registry
+
+
+@st.cache_resource
+def get_shared_asset_index() -> AssetIndex:
+    """全セッションで共有するアセットのインデックス（変更はウォッチャーが検出）"""
+    index = AssetIndex()
+    index.start_watcher([STAFF_DIR, BACKGROUNDS_DIR])
+    return index
+
+
+def render_reference_selection(selection: dict) -> None:
+    """参照画像の自動選択の結果（選ばなかった写真とその理由）"""
+    st.caption(
+        f"自動選択: {len(selection['selected'])}/{len(selection['selected']) + len(selection['dropped'])}枚 / "
+        f"{selection['selected_bytes'] / 1024 / 1024:.1f}MB（予算 {selection['budget_bytes'] / 1024 / 1024:.1f}MB）"
+    )
+    if selection["over_budget"]:
+        st.warning("予算に収まる写真がないため、最も小さい1枚を選んでいます")
+    if not selection["dropped"]:
+        return
+    with st.expander(f"選ばなかった写真（{len(selection['dropped'])}枚）"):
+        for item in selection["dropped"]:
+            reason = REASON_LABELS[item["reason"]]
+            if item["similar_to"] is not None:
+                reason += f"（似ている写真: {item['similar_to'].name}）"
+            st.caption(f"{item['path'].name} — {reason} / {item['bytes'] / 1024:.0f}KB")
+
+
+def render_queue_status(placeholder, status) -> None:
+    """スケジューラの待ち順・予想待ち時間を表示（待機中でなければ消す）"""
+    if status and status["state"] == "queued":
+        placeholder.markdown(f'''
+        <div class="info-box">
+            <span style="color: #ffcc00;">◆</span> QUEUE: {status["position"]}番目 / {status["queued"]}件待ち
+            — 予想待ち時間 約{status["eta_seconds"]:.0f}秒
+        </div>
+        ''', unsafe_allow_html=True)
+    else:
+        placeholder.empty()
+
+
+@st.cache_resource
+def get_shared_metrics_exporter() -> MetricsExporter:
+    """メトリクスの公開（METRICS_FILE・METRICS_PORT を設定した場合のみ）"""
+    return MetricsExporter().start_from_env()
+
+
+@st.cache_resource
+def get_shared_lan_server() -> LanFileServer:
+    """iPhone転送用の画像配信サーバー（最初に使うときに起動し、全セッションで共有）"""
+    return LanFileServer(OUTPUTS_DIR).start()
+
+
+@st.cache_resource
+def get_shared_job_workers() -> JobWorkerPool:
+    """全セッションで共有する生成ジョブのワーカー（前回のプロセスで中断されたジョブも回収）"""
+    workers = JobWorkerPool(JobQueue(), {"generate": run_generation_job})
+    workers.start()
+    return workers
+
+
+def wait_for_job(job_queue: JobQueue, job: dict) -> dict:
+    """
+    ジョブが終わるまで状態を表示しながら待つ
+    待機中に再実行されてもジョブはワーカーで続行し、次の実行で再び待つ
+    """
+    if job["status"] not in ("queued", "running"):
+        return job
+
+    count = job["payload"].get("count", 1)
+    status_box = st.empty()
+    with st.spinner(f"◈ PHOTON POWER IMAGE SYNTHESIS{f' × {count}' if count > 1 else ''}... (30-60 SEC)"):
+        while job["status"] in ("queued", "running"):
+            if job["status"] == "queued":
+                status_box.markdown(f'''
+                <div class="info-box">
+                    <span style="color: #ffcc00;">◆</span> JOB QUEUE: {job_queue.position(job["id"]) or 1}番目
+                </div>
+                ''', unsafe_allow_html=True)
+            else:
+                # 実行中でもAPIの待ち行列で順番待ちしていれば待ち順を表示
+                render_queue_status(status_box, get_scheduler().session_status(job["session_id"]))
+            time.sleep(0.5)
+            job = job_queue.get(job["id"])
+    status_box.empty()
+    return job
 
-    /* Streamlitのマークダウンテキスト */
-    .stMarkdown, .stMarkdown p, .stMarkdown span {
-        color: #ffffff !important;
-    }
 
-    /* ラベルテキスト */
-    .stSelectbox label, .stTextArea label, .stCheckbox label,
-    .stSlider label, .stMultiSelect label, .stTextInput label {
-        color: #00aaff !important;
-        font-weight: 600;
-    }
+# 用途別の書き出しの完了を確認する間隔（秒）
+ENCODE_POLL_SECONDS = 1.0
 
-    /* ヘルプテキスト */
-    .stTooltipIcon {
-        color: #888 !important;
-    }
 
-    /* セレクトボックスの選択テキスト */
-    .stSelectbox [data-baseweb="select"] span {
-        color: #ffffff !important;
-    }
+def is_encoding(image_id: str) -> bool:
+    """用途別の書き出しがまだ終わっていないか（元画像の書き込み中は、書き込み後に書き出しが始まる）"""
+    return get_output_encoder().is_pending(image_id) or not get_output_store(OUTPUTS_DIR).is_written(image_id)
 
-    /* チェックボックスのラベル */
-    .stCheckbox span {
-        color: #ffffff !important;
-    }
 
-    /* スライダーのラベル */
-    .stSlider [data-testid="stTickBarMin"],
-    .stSlider [data-testid="stTickBarMax"] {
-        color: #ffffff !important;
-    }
+@st.fragment(run_every=ENCODE_POLL_SECONDS)
+def poll_derivatives(image_id: str) -> None:
+    """
+    書き出し中の表示（この部分だけを一定間隔で再実行する）
+    書き出しが終わったら画面全体を再実行し、ダウンロードボタンを表示する（画面の表示は書き出しを待たない）
+    """
+    if is_encoding(image_id):
+        st.caption("🗜 用途別の書き出し中...")
+        return
+    st.rerun()
 
-    /* メインヘッダー - 光子力研究所風 */
-    .main-header {
-        font-family: 'Orbitron', 'Noto Sans JP', sans-serif;
-        color: #00ff88;
-        font-size: 2.8rem;
-        font-weight: 900;
-        text-transform: uppercase;
-        letter-spacing: 4px;
-        text-shadow:
-            0 0 10px #00ff88,
-            0 0 20px #00ff88,
-            0 0 40px #00ff88,
-            0 0 80px #00aa55;
-        margin-bottom: 0.5rem;
-        padding: 1rem 0;
-        border-bottom: 3px solid #00ff88;
-        position: relative;
-    }
 
-    .main-header::before {
-        content: '';
-        position: absolute;
-        left: 0;
-        bottom: -3px;
-        width: 100%;
-        height: 3px;
-        background: linear-gradient(90deg, transparent, #00ff88, transparent);
-        animation: scan 2s linear infinite;
-    }
+def render_derivative_downloads(record: dict, key: str) -> None:
+    """用途別の書き出し（Instagram用JPEG・Web用WebP・印刷用PNG）のダウンロードボタン"""
+    derivatives = (record.get("metadata") or {}).get("derivatives") or {}
+    if not derivatives:
+        if is_encoding(record["id"]):
+            poll_derivatives(record["id"])
+        return
 
-    @keyframes scan {
-        0% { opacity: 0.3; }
-        50% { opacity: 1; }
-        100% { opacity: 0.3; }
-    }
+    root = get_output_store(OUTPUTS_DIR).root
+    cols = st.columns(len(derivatives))
+    for col, (name, derivative) in zip(cols, derivatives.items()):
+        path = root / derivative["path"]
+        if not path.exists():
+            continue
+        with col:
+            with open(path, "rb") as f:
+                st.download_button(
+                    label=f"⬇ {derivative['label']}",
+                    data=f.read(),
+                    file_name=f"cyclez_{record['id']}_{name}{path.suffix}",
+                    mime=derivative["mime_type"],
+                    use_container_width=True,
+                    key=f"{key}_{name}"
+                )
+            st.caption(
+                f"{derivative['width']}x{derivative['height']} / {derivative['bytes'] / 1024:.0f}KB"
+                f"（圧縮率 {derivative['compression_ratio']:.1f}倍）"
+            )
 
-    .sub-header {
-        font-family: 'Noto Sans JP', sans-serif;
-        color: #888;
-        font-size: 1rem;
-        margin-bottom: 2rem;
-        letter-spacing: 2px;
-    }
 
-    /* セクションヘッダー */
-    .section-header {
-        font-family: 'Orbitron', sans-serif;
-        color: #ff3366;
-        font-size: 1.2rem;
-        font-weight: 700;
-        text-transform: uppercase;
-        letter-spacing: 2px;
-        border-left: 4px solid #ff3366;
-        padding-left: 12px;
-        margin: 1.5rem 0 1rem 0;
-        text-shadow: 0 0 10px rgba(255, 51, 102, 0.5);
-    }
+def render_format_exports(master: dict) -> None:
+    """マルチフォーマット書き出しの結果（形式ごとの切り出し・位置の調整・ダウンロード）"""
+    exports = (master.get("metadata") or {}).get("exports") or {}
+    if not exports:
+        return
 
-    /* パネルスタイル */
-    .control-panel {
-        background: linear-gradient(180deg, rgba(0,255,136,0.1) 0%, rgba(0,0,0,0.8) 100%);
-        border: 1px solid #00ff88;
-        border-radius: 0;
-        padding: 1.5rem;
-        margin: 1rem 0;
-        position: relative;
-        clip-path: polygon(0 0, calc(100% - 15px) 0, 100% 15px, 100% 100%, 15px 100%, 0 calc(100% - 15px));
-    }
+    st.markdown(f'''
+    <div class="section-header" style="font-size: 1.4rem;">
+        {icon("palette", "#00ff88")} MULTI-FORMAT EXPORT ({len(exports)})
+    </div>
+    ''', unsafe_allow_html=True)
+    st.caption("位置のスライダーで切り出し位置を調整できます（0: 左・上端 / 1: 右・下端）")
+
+    store = get_output_store(OUTPUTS_DIR)
+    adjusted = {}
+    cols = st.columns(3)
+    for i, (name, image_id) in enumerate(exports.items()):
+        record = store.get(image_id)
+        if record is None or not Path(record["absolute_path"]).exists() or name not in EXPORT_FORMATS:
+            continue
+        label, ratio = EXPORT_FORMATS[name]
+        crop = record["metadata"]["crop"]
+        with cols[i % 3]:
+            offset = st.slider(
+                f"{label}（{ratio}）の位置",
+                min_value=0.0,
+                max_value=1.0,
+                value=float(crop["offset"]),
+                step=0.01,
+                disabled=ratio == master.get("aspect_ratio"),
+                help=f"自動で決めた位置: {crop['auto_offset']:.2f}",
+                key=f"crop_offset_{master['id']}_{name}"
+            )
+            if abs(offset - crop["offset"]) > 1e-6:
+                adjusted[name] = offset
+                st.image(crop_preview(master["absolute_path"], ratio, offset), caption=f"◆ {label}（調整中）",
+                         use_container_width=True)
+                continue
+
+            data = get_result_buffers().read(record)
+            st.image(data, caption=f"◆ {label} {ratio}", use_container_width=True)
+            st.download_button(
+                label=f"⬇ {label}",
+                data=data,
+                file_name=f"cyclez_{master['id']}_{name}{Path(record['path']).suffix}",
+                mime=record["mime_type"],
+                use_container_width=True,
+                key=f"export_download_{name}"
+            )
 
-    .control-panel::before {
-        content: '';
-        position: absolute;
-        top: 0;
-        left: 0;
-        right: 0;
-        height: 2px;
-        background: linear-gradient(90deg, #00ff88, #00aaff, #00ff88);
-        animation: borderGlow 3s linear infinite;
-    }
+    if adjusted and st.button(f"✂️ 調整した位置で書き出す（{len(adjusted)}形式）", use_container_width=True):
+        export_formats(master, store, list(adjusted), adjusted)
+        st.rerun()
 
-    @keyframes borderGlow {
-        0%, 100% { opacity: 0.5; }
-        50% { opacity: 1; }
-    }
 
-    /* メインボタン - パイルダーオン風 */
-    .stButton>button {
-        font-family: 'Orbitron', sans-serif;
-        background: linear-gradient(180deg, #ff3366 0%, #cc0033 50%, #990022 100%);
-        color: #fff;
-        font-weight: 900;
-        font-size: 1.2rem;
-        letter-spacing: 3px;
-        text-transform: uppercase;
-        border: 2px solid #ff3366;
-        padding: 1rem 2rem;
-        clip-path: polygon(10px 0, 100% 0, 100% calc(100% - 10px), calc(100% - 10px) 100%, 0 100%, 0 10px);
-        box-shadow:
-            0 0 20px rgba(255, 51, 102, 0.5),
-            inset 0 1px 0 rgba(255,255,255,0.2);
-        transition: all 0.3s ease;
-        text-shadow: 0 2px 4px rgba(0,0,0,0.5);
-    }
+def render_phone_transfer(record: dict) -> None:
+    """iPhone転送用のQRコード（読み取るとこのPCの配信サーバーから直接ダウンロードされる）"""
+    st.markdown('''
+    <div class="info-box" style="margin-top: 1rem;">
+        <span style="color: #00aaff;">📱 iPhone転送方法</span>
+    </div>
+    ''', unsafe_allow_html=True)
 
-    .stButton>button:hover {
-        background: linear-gradient(180deg, #ff5588 0%, #ff3366 50%, #cc0033 100%);
-        box-shadow:
-            0 0 30px rgba(255, 51, 102, 0.8),
-            0 0 60px rgba(255, 51, 102, 0.4),
-            inset 0 1px 0 rgba(255,255,255,0.3);
-        transform: scale(1.02);
-    }
+    try:
+        server = get_shared_lan_server()
+    except OSError as e:
+        st.error(f"画像配信サーバーを起動できません: {e}（.env の LAN_SERVER_PORT を変更してください）")
+        return
 
-    .stButton>button:active {
-        transform: scale(0.98);
-    }
+    # 送るファイル（元画像か用途別の書き出し）
+    files = {"元画像": record["path"]}
+    for derivative in ((record.get("metadata") or {}).get("derivatives") or {}).values():
+        files[derivative["label"]] = derivative["path"]
+    selected = st.radio("送るファイル", options=list(files), horizontal=True, key=f"qr_file_{record['id']}")
+    shared = server.share(files[selected])
+
+    col_qr1, col_qr2 = st.columns([1, 2])
+    with col_qr1:
+        st.image(shared["qr_png"], caption="DOWNLOAD QR", width=180)
+    with col_qr2:
+        st.markdown(f"""
+**📱 iPhoneへの転送手順:**
 
-    /* インフォボックス - 研究所コンソール風 */
-    .info-box {
-        background: linear-gradient(180deg, rgba(0,170,255,0.15) 0%, rgba(0,0,0,0.9) 100%);
-        color: #00aaff;
-        padding: 1.5rem;
-        border: 1px solid #00aaff;
-        border-radius: 0;
-        margin: 1rem 0;
-        font-family: 'Orbitron', monospace;
-        position: relative;
-        clip-path: polygon(0 0, calc(100% - 10px) 0, 100% 10px, 100% 100%, 10px 100%, 0 calc(100% - 10px));
-    }
+1. **iPhoneのカメラでQRコードを読み取る**
+2. **表示されたリンクを開く**
+   → 画像がこのPCから直接ダウンロードされます（{time.strftime("%H:%M", time.localtime(shared["expires_at"]))} まで有効）
+3. **写真アプリに保存**
+   → 共有ボタンから「画像を保存」
+        """)
+        st.code(shared["url"], language="text")
 
-    .info-box::after {
-        content: '◆ DATA';
-        position: absolute;
-        top: -10px;
-        left: 15px;
-        background: #0a0a0a;
-        padding: 0 8px;
-        font-size: 0.7rem;
-        color: #00aaff;
-        letter-spacing: 2px;
-    }
+    st.caption("※ iPhoneとこのPCが同じWi-Fi（店内LAN）に接続している必要があります")
 
-    /* 成功ボックス - 光子力エネルギー風 */
-    .success-box {
-        background: linear-gradient(180deg, rgba(0,255,136,0.2) 0%, rgba(0,0,0,0.9) 100%);
-        color: #00ff88;
-        padding: 1.5rem;
-        border: 2px solid #00ff88;
-        border-radius: 0;
-        font-family: 'Orbitron', sans-serif;
-        text-transform: uppercase;
-        letter-spacing: 2px;
-        animation: successPulse 2s ease-in-out infinite;
-    }
 
-    @keyframes successPulse {
-        0%, 100% { box-shadow: 0 0 20px rgba(0,255,136,0.3); }
-        50% { box-shadow: 0 0 40px rgba(0,255,136,0.6); }
-    }
+def render_job_result(job: dict) -> None:
+    """完了したジョブの結果を出力ストアから読み込んで表示"""
+    result = job.get("result") or {}
+    if job["status"] == "failed":
+        st.error(f"画像生成エラー: {job.get('error') or '不明なエラー'}")
+        return
 
-    /* サイドバー */
-    [data-testid="stSidebar"] {
-        background: linear-gradient(180deg, #0a0a0a 0%, #1a1a2e 100%);
-        border-right: 2px solid #00ff88;
-    }
+    # 用途別の書き出しは待たずに表示する（書き出し中のものは render_derivative_downloads で完了を確認する）
+    # 書き込み中の画像もバッファのデータで表示し、ストア・ファイルは書き込みが終わってから使う
+    store = get_output_store(OUTPUTS_DIR)
+    buffers = get_result_buffers()
+    records = []
+    for image_id in result.get("image_ids", []):
+        record = store.peek(image_id)
+        if record is None:
+            continue
+        if store.is_written(image_id):
+            if Path(record["absolute_path"]).exists():
+                records.append(record)
+        elif buffers.get(image_id) is not None:
+            records.append(record)
+    if not records:
+        st.warning("生成画像が見つかりません（削除された可能性があります）")
+        return
 
-    [data-testid="stSidebar"] .stMarkdown h1,
-    [data-testid="stSidebar"] .stMarkdown h2,
-    [data-testid="stSidebar"] .stMarkdown h3 {
-        font-family: 'Orbitron', sans-serif;
-        color: #00ff88;
-        text-transform: uppercase;
-        letter-spacing: 2px;
-    }
+    if result.get("count", 1) > 1:
+        # 候補一覧（グリッド表示）
+        st.markdown(f'''
+        <div class="section-header" style="font-size: 1.4rem;">
+            {icon("palette", "#00ff88")} CANDIDATES ({len(records)})
+        </div>
+        ''', unsafe_allow_html=True)
 
-    /* サイドバーのテキスト全般 */
-    [data-testid="stSidebar"] p,
-    [data-testid="stSidebar"] span,
-    [data-testid="stSidebar"] label,
-    [data-testid="stSidebar"] div {
-        color: #ffffff !important;
-    }
+        cols = st.columns(2)
+        for i, record in enumerate(records):
+            with cols[i % 2]:
+                # 表示とダウンロードで同じバッファを使う
+                data = buffers.read(record)
+                st.image(data, caption=f"◆ CANDIDATE {i + 1}", use_container_width=True)
+                st.download_button(
+                    label=f"⬇ 候補{i + 1}をダウンロード",
+                    data=data,
+                    file_name=f"cyclez_{record['id']}{Path(record['path']).suffix}",
+                    mime=record["mime_type"],
+                    use_container_width=True,
+                    key=f"candidate_download_{i}"
+                )
+                render_derivative_downloads(record, f"candidate_derivative_{i}")
+        return
 
-    [data-testid="stSidebar"] .stSelectbox label,
-    [data-testid="stSidebar"] .stCheckbox label,
-    [data-testid="stSidebar"] .stMultiSelect label {
-        color: #00aaff !important;
-    }
+    record = records[0]
+    st.markdown('''
+    <div class="success-box">
+        <span style="font-size: 1.2rem;">◆ MISSION COMPLETE ◆</span><br>
+        IMAGE GENERATION SUCCESSFUL
+    </div>
+    ''', unsafe_allow_html=True)
 
-    /* セレクトボックス */
-    .stSelectbox > div > div {
-        background: rgba(0,0,0,0.8);
-        border: 1px solid #00aaff;
-        color: #00aaff;
-    }
+    # 生成画像表示（生成時のレスポンスのデータをそのまま使い、ダウンロードでも同じバッファを渡す）
+    data = buffers.read(record)
+    st.image(data, caption="◆ GENERATED OUTPUT", use_container_width=True)
+
+    reference_stats = result.get("reference_stats")
+    if reference_stats and reference_stats["count"]:
+        st.caption(
+            f"参照画像 {reference_stats['count']}枚: "
+            f"{reference_stats['original_bytes'] / 1024 / 1024:.1f}MB → "
+            f"{reference_stats['sent_bytes'] / 1024 / 1024:.1f}MB "
+            f"（{reference_stats['saved_bytes'] / 1024 / 1024:.1f}MB削減）"
+        )
 
-    /* テキストエリア */
-    .stTextArea textarea {
-        background: rgba(0,0,0,0.8);
-        border: 1px solid #00aaff;
-        color: #00ff88;
-        font-family: 'Noto Sans JP', monospace;
-    }
+    # ダウンロードボタンとiPhone転送
+    col_dl1, col_dl2 = st.columns(2)
 
-    /* エクスパンダー */
-    .streamlit-expanderHeader {
-        font-family: 'Orbitron', sans-serif;
-        background: rgba(0,170,255,0.1);
-        border: 1px solid #00aaff;
-        color: #00aaff;
-    }
+    with col_dl1:
+        st.download_button(
+            label="⬇ DOWNLOAD IMAGE",
+            data=data,
+            file_name=f"cyclez_{record['id']}{Path(record['path']).suffix}",
+            mime=record["mime_type"],
+            use_container_width=True
+        )
 
-    /* ディバイダー */
-    hr {
-        border: none;
-        height: 2px;
-        background: linear-gradient(90deg, transparent, #00ff88, #00aaff, #ff3366, transparent);
-    }
+    with col_dl2:
+        # iPhone転送用のQRコード表示ボタン（押すと再実行されるが、結果はストアから再表示される）
+        if st.button("📱 iPhoneに送る", use_container_width=True):
+            st.session_state.show_qr = True
+            st.session_state.qr_image_id = record["id"]
 
-    /* スピナー */
-    .stSpinner > div {
-        border-color: #00ff88 transparent transparent transparent;
-    }
+    render_derivative_downloads(record, "result_derivative")
+    if result.get("exports"):
+        render_format_exports(record)
 
-    /* 警告・エラー */
-    .stAlert {
-        border-radius: 0;
-        border-left: 4px solid;
-    }
+    # QRコード表示（店内LANの配信サーバーから直接ダウンロードする署名URL）
+    if st.session_state.get("show_qr") and st.session_state.get("qr_image_id") == record["id"]:
+        render_phone_transfer(record)
 
-    /* カスタムアイコンスタイル */
-    .icon-wrapper {
-        display: inline-flex;
-        align-items: center;
-        justify-content: center;
-        width: 32px;
-        height: 32px;
-        margin-right: 8px;
-        vertical-align: middle;
-    }
+    # 生成情報
+    if result.get("text_response"):
+        with st.expander("◆ AI SYSTEM RESPONSE"):
+            st.write(result["text_response"])
 
-    .icon-wrapper svg {
-        width: 24px;
-        height: 24px;
-        fill: currentColor;
-    }
 
-    /* グリッドオーバーレイ */
-    .grid-overlay {
-        position: fixed;
-        top: 0;
-        left: 0;
-        right: 0;
-        bottom: 0;
-        pointer-events: none;
-        background-image:
-            linear-gradient(rgba(0,255,136,0.03) 1px, transparent 1px),
-            linear-gradient(90deg, rgba(0,255,136,0.03) 1px, transparent 1px);
-        background-size: 50px 50px;
-        z-index: 0;
-    }
-</style>
-<div class="grid-overlay"></div>
-""", unsafe_allow_html=True)
-
-# SVGアイコン定義（React Iconsスタイル）
-ICONS = {
-    "bike": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="5" cy="17" r="3"/><circle cx="19" cy="17" r="3"/><path d="M12 17V5l4 4M5 17l3-6h8l3 6"/></svg>''',
-    "settings": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="12" cy="12" r="3"/><path d="M12 1v4M12 19v4M4.22 4.22l2.83 2.83M16.95 16.95l2.83 2.83M1 12h4M19 12h4M4.22 19.78l2.83-2.83M16.95 7.05l2.83-2.83"/></svg>''',
-    "store": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M3 9l9-7 9 7v11a2 2 0 01-2 2H5a2 2 0 01-2-2z"/><polyline points="9,22 9,12 15,12 15,22"/></svg>''',
-    "user": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M20 21v-2a4 4 0 00-4-4H8a4 4 0 00-4 4v2"/><circle cx="12" cy="7" r="4"/></svg>''',
-    "palette": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="13.5" cy="6.5" r="2.5"/><circle cx="17.5" cy="10.5" r="2.5"/><circle cx="8.5" cy="7.5" r="2.5"/><circle cx="6.5" cy="12.5" r="2.5"/><path d="M12 2C6.5 2 2 6.5 2 12s4.5 10 10 10c.93 0 1.75-.67 1.75-1.5 0-.39-.15-.74-.39-1.02-.24-.28-.39-.63-.39-1.02 0-.83.67-1.5 1.5-1.5H16c3.31 0 6-2.69 6-6 0-4.96-4.49-9-10-9z"/></svg>''',
-    "document": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M14 2H6a2 2 0 00-2 2v16a2 2 0 002 2h12a2 2 0 002-2V8z"/><polyline points="14,2 14,8 20,8"/><line x1="16" y1="13" x2="8" y2="13"/><line x1="16" y1="17" x2="8" y2="17"/></svg>''',
-    "wrench": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M14.7 6.3a1 1 0 000 1.4l1.6 1.6a1 1 0 001.4 0l3.77-3.77a6 6 0 01-7.94 7.94l-6.91 6.91a2.12 2.12 0 01-3-3l6.91-6.91a6 6 0 017.94-7.94l-3.76 3.76z"/></svg>''',
-    "zap": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><polygon points="13,2 3,14 12,14 11,22 21,10 12,10 13,2"/></svg>''',
-    "download": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M21 15v4a2 2 0 01-2 2H5a2 2 0 01-2-2v-4M7 10l5 5 5-5M12 15V3"/></svg>''',
-    "message": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M21 15a2 2 0 01-2 2H7l-4 4V5a2 2 0 012-2h14a2 2 0 012 2z"/></svg>''',
-    "check": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><polyline points="20,6 9,17 4,12"/></svg>''',
-    "alert": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="12" cy="12" r="10"/><line x1="12" y1="8" x2="12" y2="12"/><line x1="12" y1="16" x2="12.01" y2="16"/></svg>''',
-    "edit": '''<svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><path d="M11 4H4a2 2 0 00-2 2v14a2 2 0 002 2h14a2 2 0 002-2v-7"/><path d="M18.5 2.5a2.12 2.12 0 013 3L12 15l-4 1 1-4 9.5-9.5z"/></svg>''',
-}
+def load_image_as_base64(image_path: Path) -> str:
+    """画像をbase64エンコード"""
+    with open(image_path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
 
-def icon(name: str, color: str = "#00ff88") -> str:
-    """SVGアイコンをHTMLとして返す"""
-    svg = ICONS.get(name, ICONS["zap"])
-    return f'<span class="icon-wrapper" style="color: {color}">{svg}</span>'
 
-# 定数定義
-STAFF = {
-    "岡田": "okada",
-    "仙田": "senda",
-    "西井": "nishii"
+# プロンプトの出どころの表示名
+PROMPT_SOURCE_LABELS = {
+    SOURCE_CACHE: "♻ CACHE HIT",
+    SOURCE_SPECULATION: "⚡ SPECULATIVE",
+    SOURCE_CLAUDE: "◈ CLAUDE API",
+    SOURCE_LOCAL: "◇ LOCAL TEMPLATE",
 }
 
-LOCATIONS = {
-    "cycleZ店舗": "cyclez"
-}
+# 履歴ギャラリーの1ページあたりの件数
+HISTORY_PAGE_SIZE = 24
+HISTORY_COLUMNS = 4
 
-SITUATIONS = {
-    "バイクフィッティング": "bike_fitting",
-    "試乗相談": "test_ride_consultation",
-    "メンテナンス説明": "maintenance_explanation",
-    "パーツ・アクセサリー相談": "parts_accessories",
-    "初心者向け相談": "beginner_consultation",
-    "通勤・通学バイク提案": "commuter_bike",
-    "ロングライド相談": "long_ride",
-    "ウェア・アパレル相談": "apparel_consultation",
-    "店舗内観（人物なし）": "interior",
-    "バイク展示": "bike_display"
-}
 
-ASPECT_RATIOS = {
-    "1:1（正方形）": "1:1",
-    "4:5（縦長）": "4:5",
-    "16:9（横長）": "16:9",
-    "9:16（縦長・ストーリー）": "9:16",
-    "4:3": "4:3",
-    "3:2": "3:2",
-    "21:9（ワイド）": "21:9"
-}
+def render_history_page():
+    """生成履歴ギャラリー（表示中のページ分だけサムネイルを読み込む）"""
+    store = get_output_store(OUTPUTS_DIR)
+    thumbnail_cache = get_thumbnail_cache()
 
-CLIENT_TYPES = {
-    "なし（人物なし）": None,
-    "20代前半男性（理系学生）": "early_20s_male_student",
-    "20代前半女性（理系学生）": "early_20s_female_student",
-    "50代男性": "50s_male",
-    "50代女性": "50s_female",
-    "30代男性": "30s_male",
-    "30代女性": "30s_female",
-    "40代男性": "40s_male",
-    "40代女性": "40s_female"
-}
+    with st.sidebar:
+        st.markdown(f'''
+        <div class="section-header" style="color: #00ff88; border-color: #00ff88;">
+            {icon("settings", "#00ff88")} HISTORY FILTER
+        </div>
+        ''', unsafe_allow_html=True)
 
-# アセットパス
-ASSETS_DIR = Path(__file__).parent / "assets"
-STAFF_DIR = ASSETS_DIR / "staff"
-BACKGROUNDS_DIR = ASSETS_DIR / "backgrounds"
-OUTPUTS_DIR = Path(__file__).parent / "outputs"
+        selected_date = st.selectbox("日付", options=["すべて"] + store.dates())
+        selected_staff = st.selectbox("スタッフ", options=["すべて"] + list(STAFF.keys()))
+        selected_situation = st.selectbox("シチュエーション", options=["すべて"] + list(SITUATIONS.keys()))
 
-# 出力ディレクトリ作成
-OUTPUTS_DIR.mkdir(exist_ok=True)
+    filters = {
+        "date": None if selected_date == "すべて" else selected_date,
+        "staff": None if selected_staff == "すべて" else selected_staff,
+        "situation": None if selected_situation == "すべて" else selected_situation,
+    }
+    total = store.count(**filters)
+    page_count = max(1, -(-total // HISTORY_PAGE_SIZE))
 
+    st.markdown(f'''
+    <div class="section-header" style="font-size: 1.4rem;">
+        {icon("palette", "#00aaff")} HISTORY ({total})
+    </div>
+    ''', unsafe_allow_html=True)
 
-def get_available_images(directory: Path) -> list:
-    """指定ディレクトリ内の画像ファイル一覧を取得"""
-    if not directory.exists():
-        return []
-    extensions = {'.jpg', '.jpeg', '.png', '.webp'}
-    return [f for f in directory.iterdir() if f.suffix.lower() in extensions]
+    if total == 0:
+        st.info("条件に合う生成画像がありません")
+        return
 
+    page = st.number_input("ページ", min_value=1, max_value=page_count, value=1, step=1)
+    st.caption(f"{page} / {page_count} ページ")
+
+    records = store.query(limit=HISTORY_PAGE_SIZE, offset=(page - 1) * HISTORY_PAGE_SIZE, **filters)
+    thumbnails = thumbnail_cache.ensure(records)
+
+    # 選択中の画像（元画像はここでだけ読み込む）
+    selected = store.get(st.session_state["history_selected"]) if st.session_state.get("history_selected") else None
+    if selected is not None and Path(selected["absolute_path"]).exists():
+        col_image, col_info = st.columns([2, 1])
+        data = get_result_buffers().read(selected)
+        with col_image:
+            st.image(data, caption=f"◆ {selected['id']}", use_container_width=True)
+        with col_info:
+            st.download_button(
+                label="⬇ DOWNLOAD IMAGE",
+                data=data,
+                file_name=f"cyclez_{selected['id']}{Path(selected['path']).suffix}",
+                mime=selected["mime_type"],
+                use_container_width=True
+            )
+            # 書き出し前に生成された画像は、開いた時点で用途別のファイルを作成する
+            if not (selected.get("metadata") or {}).get("derivatives"):
+                encoder = get_output_encoder()
+                if not encoder.is_pending(selected["id"]):
+                    encoder.submit(selected, store)
+            render_derivative_downloads(selected, "history_derivative")
+            st.caption(
+                f"{selected['date']} / {selected.get('staff') or 'スタッフなし'} / "
+                f"{selected.get('situation') or '-'} / {selected.get('aspect_ratio') or '-'}"
+            )
+            if selected.get("prompt"):
+                with st.expander("◆ PROMPT"):
+                    st.code(selected["prompt"], language="text")
+        st.divider()
 
-def load_image_as_base64(image_path: Path) -> str:
-    """画像をbase64エンコード"""
-    with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode()
+    cols = st.columns(HISTORY_COLUMNS)
+    for i, record in enumerate(records):
+        with cols[i % HISTORY_COLUMNS]:
+            thumbnail = thumbnails.get(record["id"])
+            if thumbnail:
+                st.image(thumbnail, caption=record["id"], use_container_width=True)
+            else:
+                st.caption(f"{record['id']}（画像なし）")
+            if st.button("開く", key=f"history_open_{record['id']}", use_container_width=True):
+                st.session_state.history_selected = record["id"]
+                st.rerun()
 
 
 def main():
@@ -443,6 +510,13 @@ def main():
     </div>
     ''', unsafe_allow_html=True)
 
+    # 画面切り替え（生成 / 履歴）
+    with st.sidebar:
+        mode = st.radio("MODE", options=["⚡ 生成", "◆ 履歴"], horizontal=True)
+    if mode == "◆ 履歴":
+        render_history_page()
+        return
+
     # API キーチェック
     gemini_key = os.getenv("GEMINI_API_KEY")
     claude_key = os.getenv("ANTHROPIC_API_KEY")
@@ -456,6 +530,17 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
         """)
         return
 
+    # APIクライアント・アセット一覧（全セッション共有）
+    client_registry = get_shared_client_registry()
+    asset_index = get_shared_asset_index()
+    job_workers = get_shared_job_workers()
+    get_shared_metrics_exporter()
+
+    # セッションID（API呼び出しの待ち行列でセッションを区別し、順番に割り当てる）
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    session_id = st.session_state.session_id
+
     # サイドバー：設定
     with st.sidebar:
         st.markdown(f'''
@@ -471,13 +556,6 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
         </div>
         ''', unsafe_allow_html=True)
 
-        PURPOSE_OPTIONS = {
-            "宣材写真（スタッフ紹介）": "promotional_staff",
-            "Instagram投稿": "instagram",
-            "店舗紹介（人物なし）": "shop_interior",
-            "バイク・商品紹介": "product",
-            "カスタム": "custom"
-        }
         selected_purpose = st.selectbox(
             "用途を選択",
             options=list(PURPOSE_OPTIONS.keys()),
@@ -521,7 +599,7 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
 
             # 背景画像選択
             bg_dir = BACKGROUNDS_DIR / LOCATIONS[selected_location]
-            bg_images = get_available_images(bg_dir)
+            bg_images = asset_index.list_images(bg_dir)
 
             if bg_images:
                 selected_bg = st.selectbox(
@@ -530,7 +608,9 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
                     format_func=lambda x: x.name
                 )
                 # 背景プレビュー（目視確認用）
-                st.image(str(selected_bg), caption="選択中の背景", use_container_width=True)
+                bg_preview = asset_index.preview(selected_bg)
+                if bg_preview is not None:
+                    st.image(str(bg_preview), caption="選択中の背景", use_container_width=True)
             else:
                 st.warning(f"背景画像がありません: {bg_dir}")
                 selected_bg = None
@@ -574,15 +654,27 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
                 )
 
             staff_dir = STAFF_DIR / STAFF[selected_staff_name]
-            staff_images = get_available_images(staff_dir)
+            staff_images = asset_index.list_images(staff_dir)
 
             if staff_images:
+                # 似た写真を除き、送信サイズの予算内（背景画像の分を除く）で互いに似ていない写真を初期選択にする
+                selector = get_reference_selector()
+                byte_budget = DEFAULT_BYTE_BUDGET
+                if use_background and selected_bg:
+                    try:
+                        byte_budget -= selector.features(selected_bg)["bytes"]
+                    except Exception:
+                        # 背景画像を読み込めない場合は予算から引かない（送信時は前処理が元画像で代用する）
+                        pass
+                selection = selector.select(staff_images, byte_budget=max(0, byte_budget))
                 selected_staff = st.multiselect(
                     "参照画像を選択（複数選択で人物再現精度向上）",
                     options=staff_images,
                     format_func=lambda x: x.name,
-                    default=staff_images  # 全画像をデフォルトで選択
+                    default=selection["selected"],
+                    help="似た写真を除き、送信サイズの予算内で自動選択しています（追加・削除できます）"
                 )
+                render_reference_selection(selection)
 
                 # 選択した画像のプレビュー
                 if selected_staff:
@@ -591,13 +683,81 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
                     preview_images = selected_staff[:4]
                     cols = st.columns(min(len(preview_images), 2))
                     for i, img in enumerate(preview_images):
+                        staff_preview = asset_index.preview(img)
+                        if staff_preview is None:
+                            continue
                         with cols[i % 2]:
-                            st.image(str(img), caption=img.name, use_container_width=True)
+                            st.image(str(staff_preview), caption=img.name, use_container_width=True)
             else:
                 st.warning(f"スタッフ画像がありません: {staff_dir}")
         else:
             st.info("スタッフなし: 店舗・商品のみの画像を生成")
 
+        # システム状態（キャッシュ・API接続）
+        with st.expander("◆ SYSTEM STATUS"):
+            cache_stats = get_prompt_cache().stats()
+            st.caption(
+                f"PROMPT CACHE: {cache_stats['entries']} entries / "
+                f"hit rate {cache_stats['hit_rate']:.0%}"
+            )
+            if "prompt_speculator" in st.session_state:
+                spec_stats = st.session_state.prompt_speculator.stats()
+                st.caption(
+                    f"SPECULATION: started {spec_stats['started']} / completed {spec_stats['completed']} / "
+                    f"cancelled {spec_stats['cancelled']}"
+                )
+            selector_stats = get_reference_selector().stats()
+            st.caption(f"REFERENCE FEATURES: cached {selector_stats['cached']} / computed {selector_stats['computed']}")
+            asset_stats = asset_index.stats()
+            st.caption(
+                f"ASSETS: {asset_stats['directories']} dirs / scans {asset_stats['scans']} / "
+                f"previews {asset_stats['previews']}"
+            )
+            for api, api_stats in get_scheduler().stats()["apis"].items():
+                st.caption(
+                    f"{api.upper()} QUEUE: running {api_stats['running']}/{api_stats['max_concurrent']} / "
+                    f"queued {api_stats['queued']} / {api_stats['rpm']:g} rpm / burst {api_stats['burst']:g}"
+                )
+            encode_stats = get_output_encoder().stats()
+            st.caption(
+                f"ENCODER: encoded {encode_stats['encoded']} / pending {encode_stats['pending']} / "
+                f"failures {encode_stats['failures']}"
+            )
+            buffer_stats = get_result_buffers().stats()
+            st.caption(
+                f"RESULT BUFFERS: {buffer_stats['entries']}件 / {buffer_stats['bytes'] / 1024 / 1024:.1f}MB / "
+                f"hits {buffer_stats['hits']} / disk reads {buffer_stats['disk_read_bytes'] / 1024 / 1024:.1f}MB"
+            )
+            job_stats = job_workers.stats()
+            st.caption(
+                f"JOBS: active {job_stats['active']}/{job_stats['workers']} / "
+                f"queued {job_stats['queue'].get('queued', 0)} / done {job_stats['queue'].get('done', 0)} / "
+                f"failed {job_stats['queue'].get('failed', 0)}"
+            )
+            claude_cache = get_cache_usage()
+            st.caption(
+                f"CLAUDE CACHE: read {claude_cache['cache_read_input_tokens']} / "
+                f"write {claude_cache['cache_creation_input_tokens']} / input {claude_cache['input_tokens']} tokens"
+            )
+            gemini_stats = get_resilient_caller("gemini").stats()
+            st.caption(
+                f"GEMINI CALLS: {gemini_stats['calls']} / attempts {gemini_stats['attempts']} / "
+                f"retries {gemini_stats['retries']} / hedges {gemini_stats['hedges']} "
+                f"(skipped {gemini_stats['hedges_skipped']}) / abandoned {gemini_stats['abandoned']} / "
+                f"circuit {gemini_stats['circuit']}"
+                + (f" / p95 {gemini_stats['p95']:.1f}s" if gemini_stats["p95"] is not None else "")
+            )
+            client_registry.check_health()
+            for name, client_stats in client_registry.stats().items():
+                st.caption(
+                    f"{name.upper()}: builds {client_stats['builds']} / reuses {client_stats['reuses']} / "
+                    f"requests {client_stats['requests']} / "
+                    f"connection reuse {client_stats['connection_reuse_rate']:.0%}"
+                )
+            # 処理段階ごとの所要時間（直近の p50 / p95）
+            for row in stage_summary():
+                st.caption(f"STAGE {row['stage']}: n={row['count']} / p50 {row['p50']:.2f}s / p95 {row['p95']:.2f}s")
+
     # メインエリア
     col1, col2 = st.columns([1, 1])
 
@@ -633,11 +793,34 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
         else:
             client_count = 0
 
+        # マルチフォーマット書き出し（マスター画像1枚から各比率をローカルで切り出す）
+        multi_format = st.checkbox(
+            "マルチフォーマット書き出し",
+            value=False,
+            help="広めの構図で1枚だけ生成し、" + "・".join(label for label, _ in EXPORT_FORMATS.values())
+                 + " の各比率は人物・被写体が残るように自動で切り出します"
+        )
+        master_ratio = master_aspect_ratio([ratio for _, ratio in EXPORT_FORMATS.values()])
+
         # アスペクト比
         selected_ratio = st.selectbox(
             "アスペクト比",
-            options=list(ASPECT_RATIOS.keys())
+            options=list(ASPECT_RATIOS.keys()),
+            disabled=multi_format
+        )
+        aspect_ratio = master_ratio if multi_format else ASPECT_RATIOS[selected_ratio]
+
+        # 候補数（同じプロンプトで並列生成）
+        candidate_count = st.select_slider(
+            "生成候補数",
+            options=[1, 2, 3, 4],
+            value=1,
+            disabled=multi_format,
+            help="同じプロンプトで複数の画像を同時に生成し、一覧から選べます"
         )
+        if multi_format:
+            candidate_count = 1
+            st.caption(f"マスター {master_ratio} を1枚生成し、{len(EXPORT_FORMATS)}形式に切り出します")
 
         st.divider()
 
@@ -670,6 +853,27 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
                 value="ニュートラル"
             )
 
+            speculate = st.checkbox(
+                "設定変更時にプロンプトを先読みする",
+                value=True,
+                help="設定が決まった時点でプロンプト変換を開始し、生成ボタン押下後の待ち時間を短縮します"
+            )
+
+            latency_budget = st.number_input(
+                "プロンプト変換の待ち時間の上限（秒）",
+                min_value=1.0,
+                max_value=120.0,
+                value=DEFAULT_BUDGET_SECONDS,
+                step=1.0,
+                help="この時間内にClaudeでの変換が終わらない場合、ローカルのテンプレートでプロンプトを作成します"
+            )
+
+            force_refresh = st.checkbox(
+                "プロンプトを再生成する（キャッシュを使わない）",
+                value=False,
+                help="ONにすると同じ条件でもClaude APIで新しくプロンプトを作成します"
+            )
+
     with col2:
         st.markdown(f'''
         <div class="section-header" style="font-size: 1.4rem;">
@@ -691,7 +895,12 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
         summary_parts.append(f"**シチュエーション**: {selected_situation}")
         if CLIENT_TYPES[selected_client]:
             summary_parts.append(f"**お客様**: {selected_client} × {client_count}人")
-        summary_parts.append(f"**アスペクト比**: {selected_ratio}")
+        if multi_format:
+            summary_parts.append(f"**アスペクト比**: マルチフォーマット（マスター {master_ratio}）")
+        else:
+            summary_parts.append(f"**アスペクト比**: {selected_ratio}")
+        if candidate_count > 1:
+            summary_parts.append(f"**生成候補数**: {candidate_count}")
 
         st.info("\n\n".join(summary_parts))
 
@@ -701,6 +910,32 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
 
     st.divider()
 
+    # 入力データ収集
+    generation_input = {
+        "purpose": PURPOSE_OPTIONS[selected_purpose],
+        "location": selected_location if use_background else None,
+        "use_background": use_background,
+        "situation": selected_situation,
+        "staff": selected_staff_name if use_staff else None,
+        "staff_glasses": nishii_glasses if selected_staff_name == "西井" else None,
+        "client": selected_client if CLIENT_TYPES[selected_client] else None,
+        "client_count": client_count if CLIENT_TYPES[selected_client] else 0,
+        "aspect_ratio": aspect_ratio,
+        "resolution": "high",
+        "additional_prompt": additional_prompt,
+        "image_text": image_text if include_text else None,
+        "mood": mood
+    }
+
+    # プロンプトの先読み（設定が落ち着いたらClaude APIで変換を開始）
+    if "prompt_speculator" not in st.session_state:
+        st.session_state.prompt_speculator = PromptSpeculator(session_id=session_id)
+    speculator = st.session_state.prompt_speculator
+    if speculate and not force_refresh:
+        speculator.submit(generation_input)
+    else:
+        speculator.cancel()
+
     # 生成ボタン（パイルダーオン風）
     col_btn1, col_btn2, col_btn3 = st.columns([1, 2, 1])
     with col_btn2:
@@ -719,32 +954,13 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
 
     # 生成処理
     if generate_button:
-        print("=" * 50)
-        print("⚡ PILDER ON! - 生成開始")
-        print("=" * 50)
+        log_event("generation_started", "⚡ PILDER ON! - 生成開始", session_id=session_id)
         st.markdown('''
         <div class="info-box">
             <span style="color: #00ff88;">◆</span> SYSTEM ACTIVATED - PROCESSING INITIATED
         </div>
         ''', unsafe_allow_html=True)
 
-        # 入力データ収集
-        generation_input = {
-            "purpose": PURPOSE_OPTIONS[selected_purpose],
-            "location": selected_location if use_background else None,
-            "use_background": use_background,
-            "situation": selected_situation,
-            "staff": selected_staff_name if use_staff else None,
-            "staff_glasses": nishii_glasses if selected_staff_name == "西井" else None,
-            "client": selected_client if CLIENT_TYPES[selected_client] else None,
-            "client_count": client_count if CLIENT_TYPES[selected_client] else 0,
-            "aspect_ratio": ASPECT_RATIOS[selected_ratio],
-            "resolution": "high",
-            "additional_prompt": additional_prompt,
-            "image_text": image_text if include_text else None,
-            "mood": mood
-        }
-
         # 参照画像収集
         reference_images = []
 
@@ -767,114 +983,126 @@ ANTHROPIC_API_KEY=your_anthropic_api_key
 
         with st.spinner("◈ PROMPT OPTIMIZATION IN PROGRESS..."):
             try:
-                print("📝 Claude APIを呼び出し中...")
-                # Claude APIでプロンプト変換
-                optimized_prompt = convert_prompt_with_claude(generation_input)
-                print(f"✅ プロンプト生成完了: {optimized_prompt[:100]}...")
-
-                with st.expander("◆ OPTIMIZED PROMPT DATA"):
-                    st.code(optimized_prompt, language="text")
-
-            except Exception as e:
-                print(f"❌ Claude APIエラー: {str(e)}")
-                st.error(f"プロンプト変換エラー: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                return
-
-        with st.spinner("◈ PHOTON POWER IMAGE SYNTHESIS... (30-60 SEC)"):
-            try:
-                print("🎨 Gemini APIを呼び出し中...")
-                # Gemini APIで画像生成
-                result = generate_image_with_gemini(
-                    prompt=optimized_prompt,
-                    reference_images=reference_images,
-                    aspect_ratio=ASPECT_RATIOS[selected_ratio],
-                    resolution="high"
+                # 同じ条件ならキャッシュを使用
+                routing_started = time.perf_counter()
+                optimized_prompt = None if force_refresh else lookup_cached_prompt(generation_input)
+                route_info = {"source": SOURCE_CACHE} if optimized_prompt is not None else None
+                route = None
+
+                if route_info is None and speculate and speculator.expedite(generation_input):
+                    # 先読みが実行中なら、新しく呼び出さずに完了を待つ（レイテンシ予算まで）
+                    log_event("prompt_speculation_used", "⚡ 先読み中のプロンプトを使用")
+                    live_prompt = st.empty()
+                    while (speculator.status(generation_input) in ("waiting", "running")
+                           and time.perf_counter() - routing_started < latency_budget):
+                        live_prompt.code(speculator.partial_text(generation_input) + " ▌", language="text")
+                        time.sleep(0.1)
+                    live_prompt.empty()
+                    optimized_prompt = speculator.result(generation_input)
+                    if optimized_prompt is not None:
+                        route_info = {"source": SOURCE_SPECULATION}
+                    elif time.perf_counter() - routing_started >= latency_budget:
+                        # 先読みはそのまま続行し、完了すればキャッシュに保存される
+                        optimized_prompt, route_info = fallback_to_local(
+                            generation_input, f"予算 {latency_budget:g}秒 を超過（先読み中）", routing_started
+                        )
+
+                if route_info is None:
+                    log_event("prompt_claude_started", "📝 Claude APIを呼び出し中（ストリーミング）...")
+                    # Claude APIでプロンプト変換（受信したテキストをその場で表示）
+                    # 予算内に終わらない・失敗した場合はローカル生成に切り替える
+                    live_prompt = st.empty()
+
+                    def render_route_progress(route):
+                        status = get_scheduler().session_status(session_id)
+                        if status and status["state"] == "queued":
+                            render_queue_status(live_prompt, status)
+                        elif route.text:
+                            live_prompt.code(route.text + " ▌", language="text")
+
+                    with request_context(session_id):
+                        route = ClaudeRoute(generation_input, latency_budget).start(routing_started)
+                    optimized_prompt = route.wait(render_route_progress)
+                    route_info = route.info
+                    live_prompt.empty()
+                record_stage("prompt", time.perf_counter() - routing_started, source=route_info["source"])
+                log_event(
+                    "prompt_ready", f"✅ プロンプト生成完了（{route_info['source']}）: {optimized_prompt[:100]}...",
+                    source=route_info["source"], reason=route_info.get("reason"), prompt_chars=len(optimized_prompt)
                 )
 
-                if result["success"]:
-                    st.markdown('''
-                    <div class="success-box">
-                        <span style="font-size: 1.2rem;">◆ MISSION COMPLETE ◆</span><br>
-                        IMAGE GENERATION SUCCESSFUL
-                    </div>
-                    ''', unsafe_allow_html=True)
-
-                    # 生成画像表示
-                    st.image(result["image_path"], caption="◆ GENERATED OUTPUT", use_container_width=True)
-
-                    # ダウンロードボタンとiPhone転送
-                    col_dl1, col_dl2 = st.columns(2)
-
-                    with col_dl1:
-                        with open(result["image_path"], "rb") as f:
-                            image_data = f.read()
-                            st.download_button(
-                                label="⬇ DOWNLOAD IMAGE",
-                                data=image_data,
-                                file_name=f"cyclez_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png",
-                                mime="image/png",
-                                use_container_width=True
-                            )
-
-                    with col_dl2:
-                        # iPhone転送用のQRコード表示ボタン
-                        if st.button("📱 iPhoneに送る", use_container_width=True):
-                            st.session_state.show_qr = True
-                            st.session_state.qr_image_path = result["image_path"]
-
-                    # QRコード表示（同じネットワーク内でアクセス可能なURL）
-                    if st.session_state.get("show_qr") and st.session_state.get("qr_image_path"):
-                        st.markdown('''
-                        <div class="info-box" style="margin-top: 1rem;">
-                            <span style="color: #00aaff;">📱 iPhone転送方法</span>
-                        </div>
-                        ''', unsafe_allow_html=True)
-
-                        # Snapdrop QRコード生成
-                        qr = qrcode.QRCode(version=1, box_size=10, border=2)
-                        qr.add_data("https://snapdrop.net")
-                        qr.make(fit=True)
-                        qr_img = qr.make_image(fill_color="#00ff88", back_color="#0a0a0a")
-
-                        # QRコードをバイトに変換
-                        qr_buffer = BytesIO()
-                        qr_img.save(qr_buffer, format="PNG")
-                        qr_buffer.seek(0)
-
-                        col_qr1, col_qr2 = st.columns([1, 2])
-                        with col_qr1:
-                            st.image(qr_buffer, caption="Snapdrop QR", width=150)
-                        with col_qr2:
-                            st.markdown("""
-**📱 iPhoneへの転送手順:**
-
-1. **iPhoneでQRコードをスキャン**
-   → Snapdropが開きます
+                # ブランドガイドラインのチェック（NGの語は置き換え、否定形でのメーカー名の言及は1回だけ書き直しを依頼）
+                def revise(terms):
+                    with request_context(session_id):
+                        return revise_prompt_with_claude(generation_input, optimized_prompt, terms)
 
-2. **Surfaceのブラウザでも Snapdrop を開く**
-   → https://snapdrop.net
-
-3. **お互いのデバイスが表示される**
-   → iPhoneのアイコンをクリック
-
-4. **ダウンロードした画像を選択して送信**
-                            """)
+                checked_prompt, compliance = ComplianceChecker().enforce(
+                    optimized_prompt, revise if route_info["source"] != SOURCE_LOCAL else None
+                )
+                log_compliance(compliance)
+                if checked_prompt != optimized_prompt:
+                    optimized_prompt = checked_prompt
+                    # 違反していたキャッシュは直したプロンプトで上書き（ローカル生成の結果は保存しない）
+                    if route_info["source"] != SOURCE_LOCAL:
+                        store_cached_prompt(generation_input, optimized_prompt)
 
-                        st.caption("※ 同じWi-Fiに接続している必要があります")
+                if route_info["source"] == SOURCE_LOCAL:
+                    st.warning(f"Claudeでの変換を使えなかったため、ローカルのテンプレートでプロンプトを作成しました（{route_info['reason']}）")
 
-                    # 生成情報
-                    if result.get("text_response"):
-                        with st.expander("◆ AI SYSTEM RESPONSE"):
-                            st.write(result["text_response"])
-                else:
-                    st.error(f"画像生成エラー: {result.get('error', '不明なエラー')}")
+                with st.expander("◆ OPTIMIZED PROMPT DATA"):
+                    st.code(optimized_prompt, language="text")
+                    cache_stats = get_prompt_cache().stats()
+                    st.caption(
+                        f"{PROMPT_SOURCE_LABELS[route_info['source']]} | "
+                        f"hits: {cache_stats['hits']} / misses: {cache_stats['misses']} / "
+                        f"entries: {cache_stats['entries']}"
+                    )
+                    st.caption(
+                        f"🛡 BRAND CHECK: {'OK' if compliance['action'] == 'none' else compliance['action'].upper()}"
+                        f" / NG {len(compliance['violations'])} / scan {compliance['scan_microseconds']:.0f}µs"
+                    )
+                    if route is not None and route_info["source"] == SOURCE_CLAUDE:
+                        st.caption(
+                            f"first token: {route.stream.time_to_first_token or 0:.2f}s / "
+                            f"total: {route.stream.total_seconds:.2f}s / budget: {latency_budget:g}s"
+                        )
 
             except Exception as e:
-                st.error(f"画像生成エラー: {str(e)}")
                 import traceback
-                st.code(traceback.format_exc())
+                log_event("prompt_error", f"❌ Claude APIエラー: {str(e)}", level="error",
+                          error=str(e), traceback=traceback.format_exc())
+                st.error(f"プロンプト変換エラー: {str(e)}")
+                return
+
+        # 画像生成はジョブキューに登録してワーカースレッドで実行（再実行・再読み込みでは中断されない）
+        job_id = job_workers.queue.submit(
+            "generate",
+            {
+                "prompt": optimized_prompt,
+                "reference_images": reference_images,
+                "aspect_ratio": aspect_ratio,
+                "count": candidate_count,
+                "export_formats": list(EXPORT_FORMATS) if multi_format else None,
+                "generation_input": generation_input,
+                "prompt_source": route_info["source"],
+                "compliance": compliance,
+            },
+            session_id=session_id
+        )
+        job_workers.wake()
+        log_event("job_submitted", f"🎨 生成ジョブを登録: {job_id}", job_id=job_id, count=candidate_count)
+        st.session_state.active_job_id = job_id
+        st.session_state.show_qr = False
+        # ページを再読み込みしても同じジョブの結果を表示できるよう、URLにも保持
+        st.query_params["job"] = job_id
+
+    # 生成ジョブの状態・結果（ボタンを押した実行以外でも、ストアから読み込んで再表示する）
+    active_job_id = st.session_state.get("active_job_id") or st.query_params.get("job")
+    job = job_workers.queue.get(active_job_id) if active_job_id else None
+    if job is not None:
+        st.session_state.active_job_id = job["id"]
+        job = wait_for_job(job_workers.queue, job)
+        render_job_result(job)
 
     # フッター（光子力研究所風）
     st.divider()
@@ -0,0 +1,78 @@
+"""
+アプリ共通の設定（選択肢・アセットパス）
+Streamlit UI とバッチ実行の両方から使用する
+"""
+
+from pathlib import Path
+
+# 定数定義
+STAFF = {
+    "岡田": "okada",
+    "仙田": "senda",
+    "西井": "nishii"
+}
+
+LOCATIONS = {
+    "cycleZ店舗": "cyclez"
+}
+
+SITUATIONS = {
+    "バイクフィッティング": "bike_fitting",
+    "試乗相談": "test_ride_consultation",
+    "メンテナンス説明": "maintenance_explanation",
+    "パーツ・アクセサリー相談": "parts_accessories",
+    "初心者向け相談": "beginner_consultation",
+    "通勤・通学バイク提案": "commuter_bike",
+    "ロングライド相談": "long_ride",
+    "ウェア・アパレル相談": "apparel_consultation",
+    "店舗内観（人物なし）": "interior",
+    "バイク展示": "bike_display"
+}
+
+ASPECT_RATIOS = {
+    "1:1（正方形）": "1:1",
+    "4:5（縦長）": "4:5",
+    "16:9（横長）": "16:9",
+    "9:16（縦長・ストーリー）": "9:16",
+    "4:3": "4:3",
+    "3:2": "3:2",
+    "21:9（ワイド）": "21:9"
+}
+
+CLIENT_TYPES = {
+    "なし（人物なし）": None,
+    "20代前半男性（理系学生）": "early_20s_male_student",
+    "20代前半女性（理系学生）": "early_20s_female_student",
+    "50代男性": "50s_male",
+    "50代女性": "50s_female",
+    "30代男性": "30s_male",
+    "30代女性": "30s_female",
+    "40代男性": "40s_male",
+    "40代女性": "40s_female"
+}
+
+# アセットパス
+ASSETS_DIR = Path(__file__).parent / "assets"
+STAFF_DIR = ASSETS_DIR / "staff"
+BACKGROUNDS_DIR = ASSETS_DIR / "backgrounds"
+OUTPUTS_DIR = Path(__file__).parent / "outputs"
+
+# 出力ディレクトリ作成
+OUTPUTS_DIR.mkdir(exist_ok=True)
+
+# 用途
+PURPOSE_OPTIONS = {
+    "宣材写真（スタッフ紹介）": "promotional_staff",
+    "Instagram投稿": "instagram",
+    "店舗紹介（人物なし）": "shop_interior",
+    "バイク・商品紹介": "product",
+    "カスタム": "custom"
+}
+
+
+def get_available_images(directory: Path) -> list:
+    """指定ディレクトリ内の画像ファイル一覧を取得"""
+    if not directory.exists():
+        return []
+    extensions = {'.jpg', '.jpeg', '.png', '.webp'}
+    return [f for f in directory.iterdir() if f.suffix.lower() in extensions]
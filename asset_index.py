@@ -0,0 +1,220 @@
+"""
+アセット（スタッフ・背景画像）のインデックス
+ディレクトリごとの画像一覧をキャッシュし、ディレクトリの更新時刻が変わった場合だけ再スキャンする
+サイドバー表示用の小さなプレビュー画像を事前に作成しておき、元画像は表示に使わない
+"""
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from metrics import log_event
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+DEFAULT_PREVIEW_DIR = Path(__file__).parent / "cache" / "previews"
+DEFAULT_PREVIEW_SIZE = int(os.getenv("ASSET_PREVIEW_SIZE", "384"))
+DEFAULT_POLL_SECONDS = float(os.getenv("ASSET_POLL_SECONDS", "3"))
+
+
+def _load_pil():
+    """Pillow は初めて画像を処理する時点で読み込む（Pillow未インストール時は元画像をプレビューに使用）"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None, None
+    return Image, ImageOps
+
+
+class AssetIndex:
+    """
+    画像ディレクトリの一覧とプレビューのキャッシュ
+    ウォッチャー起動中はウォッチャーが変更を検出するため、一覧の取得時にディスクへアクセスしない
+    """
+
+    def __init__(
+        self,
+        preview_dir: Path = DEFAULT_PREVIEW_DIR,
+        preview_size: int = DEFAULT_PREVIEW_SIZE
+    ):
+        self.preview_dir = Path(preview_dir)
+        self.preview_size = preview_size
+
+        self._lock = threading.Lock()
+        # ディレクトリ -> (mtime_ns, 画像一覧)
+        self._listings: Dict[str, Tuple[Optional[int], List[Path]]] = {}
+        # 元画像 -> (mtime_ns, size, プレビュー)
+        self._previews: Dict[str, Tuple[int, int, Path]] = {}
+        self._watcher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.scans = 0
+        self.version = 0
+
+    @staticmethod
+    def _mtime(directory: Path) -> Optional[int]:
+        try:
+            return directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _scan(self, directory: Path, mtime_ns: Optional[int]) -> List[Path]:
+        images = []
+        if mtime_ns is not None:
+            images = sorted(
+                (f for f in directory.iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS),
+                key=lambda f: f.name
+            )
+        with self._lock:
+            self._listings[str(directory)] = (mtime_ns, images)
+            self.scans += 1
+            self.version += 1
+        return images
+
+    def list_images(self, directory: Path) -> List[Path]:
+        """ディレクトリ内の画像一覧（前回から変更がなければキャッシュを返す）"""
+        directory = Path(directory)
+        with self._lock:
+            cached = self._listings.get(str(directory))
+            watching = self._watcher is not None and self._watcher.is_alive()
+
+        if cached is not None and watching:
+            return list(cached[1])
+
+        mtime_ns = self._mtime(directory)
+        if cached is not None and cached[0] == mtime_ns:
+            return list(cached[1])
+        return list(self._scan(directory, mtime_ns))
+
+    def refresh(self) -> int:
+        """
+        登録済みの全ディレクトリの更新時刻を確認し、変わったものだけ再スキャン
+
+        Returns:
+            再スキャンしたディレクトリ数
+        """
+        with self._lock:
+            known = list(self._listings.items())
+
+        changed = 0
+        for key, (mtime_ns, _) in known:
+            directory = Path(key)
+            current = self._mtime(directory)
+            if current != mtime_ns:
+                images = self._scan(directory, current)
+                self.warm(images)
+                changed += 1
+        return changed
+
+    def start_watcher(self, directories: List[Path], interval: float = DEFAULT_POLL_SECONDS) -> None:
+        """
+        指定ディレクトリを一覧に登録し、一定間隔で変更を確認するスレッドを開始
+        サブディレクトリ（スタッフごと・店舗ごと）も登録する
+        """
+        for directory in directories:
+            directory = Path(directory)
+            self.warm(self.list_images(directory))
+            if directory.exists():
+                for child in directory.iterdir():
+                    if child.is_dir():
+                        self.warm(self.list_images(child))
+
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+            self._stop.clear()
+            self._watcher = threading.Thread(
+                target=self._watch, args=(interval,), name="asset-index-watcher", daemon=True
+            )
+            self._watcher.start()
+
+    def _watch(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                log_event("asset_refresh_error", f"⚠️ アセットの変更確認エラー: {e}", level="warning", error=str(e))
+
+    def stop_watcher(self) -> None:
+        """ウォッチャーを停止"""
+        self._stop.set()
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher.join(timeout=5)
+
+    def _preview_path(self, path: Path, mtime_ns: int, size: int) -> Path:
+        key = f"{path.resolve()}|{mtime_ns}|{size}|{self.preview_size}"
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return self.preview_dir / f"{name}.jpg"
+
+    def preview(self, path: Path) -> Optional[Path]:
+        """
+        元画像の小さなプレビュー（元画像が変更されていれば作り直す）
+        作成できない場合は元画像のパス、元画像がない場合は None
+        """
+        path = Path(path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+
+        key = str(path)
+        with self._lock:
+            known = self._previews.get(key)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size and known[2].exists():
+            return known[2]
+
+        target = self._preview_path(path, stat.st_mtime_ns, stat.st_size)
+        if not target.exists():
+            Image, ImageOps = _load_pil()
+            if Image is None:
+                return path
+            try:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with Image.open(path) as img:
+                    img.draft("RGB", (self.preview_size, self.preview_size))
+                    img = ImageOps.exif_transpose(img)
+                    img.thumbnail((self.preview_size, self.preview_size), Image.LANCZOS)
+                    tmp_path = target.with_name(f".tmp_{threading.get_ident()}_{target.name}")
+                    img.convert("RGB").save(tmp_path, format="JPEG", quality=80, optimize=True)
+                os.replace(tmp_path, target)
+            except Exception as e:
+                log_event("asset_preview_error", f"⚠️ プレビュー作成エラー（元画像を使用）: {e}", level="warning",
+                          path=str(path), error=str(e))
+                return path
+
+        with self._lock:
+            self._previews[key] = (stat.st_mtime_ns, stat.st_size, target)
+        # 元画像が変更されていた場合、古いプレビューを削除
+        if known and known[2] != target:
+            known[2].unlink(missing_ok=True)
+        return target
+
+    def warm(self, paths: List[Path]) -> None:
+        """プレビューを事前に作成"""
+        for path in paths:
+            self.preview(path)
+
+    def stats(self) -> Dict[str, int]:
+        """登録ディレクトリ数・スキャン回数・プレビュー数"""
+        with self._lock:
+            return {
+                "directories": len(self._listings),
+                "scans": self.scans,
+                "previews": len(self._previews),
+            }
+
+
+_default_index: Optional[AssetIndex] = None
+_default_index_lock = threading.Lock()
+
+
+def get_asset_index() -> AssetIndex:
+    """プロセス共通のデフォルトインデックスを取得"""
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = AssetIndex()
+        return _default_index
@@ -0,0 +1,327 @@
+"""
+バッチ生成ツール
+ジョブファイル（JSONL / CSV）または組み合わせ指定（JSON）から画像をまとめて生成する
+結果はマニフェスト（JSONL）に1件ずつ記録し、中断しても完了済みジョブは再生成しない
+
+使い方:
+    python batch_runner.py jobs.jsonl --concurrency 4
+    python batch_runner.py --matrix weekly.json --manifest outputs/weekly/manifest.jsonl
+    python batch_runner.py --matrix weekly.json --export-formats all
+
+--export-formats を指定すると、アスペクト比だけが違うジョブはまとめてマスター画像を1枚だけ生成し、
+各形式（Instagram・ストーリー・YouTube・チラシなど）はローカルで切り出す
+
+組み合わせ指定の例（リストの各要素の全組み合わせを生成、"*" はすべての選択肢）:
+    {"situation": "*", "staff": ["岡田", "仙田"], "aspect_ratio": "*", "mood": "ニュートラル"}
+"""
+
+import sys
+import csv
+import json
+import time
+import asyncio
+import argparse
+import itertools
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from app_config import (
+    STAFF, LOCATIONS, SITUATIONS, ASPECT_RATIOS, CLIENT_TYPES, PURPOSE_OPTIONS,
+    STAFF_DIR, BACKGROUNDS_DIR, OUTPUTS_DIR, get_available_images
+)
+from prompt_cache import canonical_hash
+from pipeline import generate_async
+from api_clients import run_async
+from scheduler import PRIORITY_BATCH, request_context
+from smart_crop import EXPORT_FORMATS
+from reference_selector import DEFAULT_BYTE_BUDGET, get_reference_selector
+
+# "*" で展開される選択肢
+WILDCARD_VALUES = {
+    "situation": list(SITUATIONS.keys()),
+    "staff": list(STAFF.keys()),
+    "aspect_ratio": list(ASPECT_RATIOS.values()),
+    "client": [name for name, value in CLIENT_TYPES.items() if value],
+    "mood": ["落ち着いた", "やや落ち着いた", "ニュートラル", "やや活気ある", "活気ある"],
+    "purpose": list(PURPOSE_OPTIONS.values()),
+}
+
+# CSVで数値・真偽値として扱う列
+INT_FIELDS = {"client_count"}
+BOOL_FIELDS = {"use_background"}
+
+
+def load_jobs(path: Path) -> List[Dict[str, Any]]:
+    """JSONL または CSV のジョブファイルを読み込む"""
+    jobs = []
+    if path.suffix.lower() == ".csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                job = {}
+                for key, value in row.items():
+                    if value is None or value == "":
+                        continue
+                    if key in INT_FIELDS:
+                        value = int(value)
+                    elif key in BOOL_FIELDS:
+                        value = value.strip().lower() in ("1", "true", "yes", "y")
+                    job[key] = value
+                jobs.append(job)
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    jobs.append(json.loads(line))
+    return jobs
+
+
+def expand_matrix(spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """組み合わせ指定を個々のジョブに展開（リスト値の直積）"""
+    keys = []
+    value_lists = []
+    fixed = {}
+    for key, value in spec.items():
+        if value == "*":
+            value = WILDCARD_VALUES.get(key)
+            if value is None:
+                raise ValueError(f"'*' は {key} には使用できません")
+        if isinstance(value, list):
+            keys.append(key)
+            value_lists.append(value)
+        else:
+            fixed[key] = value
+
+    return [dict(fixed, **dict(zip(keys, combination))) for combination in itertools.product(*value_lists)]
+
+
+def job_id(job: Dict[str, Any]) -> str:
+    """ジョブ内容から決まるID（同じ内容なら再実行でも同じID）"""
+    return canonical_hash(job)[:16]
+
+
+def build_generation_input(job: Dict[str, Any]) -> Dict[str, Any]:
+    """ジョブを generation_input に変換（app.py と同じ形式）"""
+    use_background = job.get("use_background", True)
+    client = job.get("client")
+    staff = job.get("staff")
+    return {
+        "purpose": job.get("purpose", "custom"),
+        "location": job.get("location", "cycleZ店舗") if use_background else None,
+        "use_background": use_background,
+        "situation": job.get("situation", "試乗相談"),
+        "staff": staff,
+        "staff_glasses": job.get("staff_glasses") if staff == "西井" else None,
+        "client": client,
+        "client_count": job.get("client_count", 1) if client else 0,
+        "aspect_ratio": job.get("aspect_ratio", "1:1"),
+        "resolution": "high",
+        "additional_prompt": job.get("additional_prompt", ""),
+        "image_text": job.get("image_text"),
+        "mood": job.get("mood", "ニュートラル")
+    }
+
+
+def build_reference_images(job: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """ジョブの店舗・スタッフ指定から参照画像リストを作成"""
+    reference_images = []
+
+    if job.get("use_background", True):
+        location = job.get("location", "cycleZ店舗")
+        bg_images = sorted(get_available_images(BACKGROUNDS_DIR / LOCATIONS[location]))
+        if job.get("background"):
+            bg_images = [img for img in bg_images if img.name == job["background"]]
+        if bg_images:
+            reference_images.append({
+                "path": bg_images[0],
+                "type": "background",
+                "description": f"{location}の店舗背景"
+            })
+
+    staff = job.get("staff")
+    if staff:
+        staff_images = sorted(get_available_images(STAFF_DIR / STAFF[staff]))
+        if job.get("staff_images"):
+            staff_images = [img for img in staff_images if img.name in job["staff_images"]]
+        elif staff_images:
+            # 指定がない場合は画面と同じく、送信サイズの予算内で互いに似ていない写真を選ぶ
+            selector = get_reference_selector()
+            byte_budget = DEFAULT_BYTE_BUDGET - sum(selector.features(img["path"])["bytes"] for img in reference_images)
+            staff_images = selector.select(staff_images, byte_budget=max(0, byte_budget))["selected"]
+        for img in staff_images:
+            reference_images.append({
+                "path": img,
+                "type": "staff",
+                "description": f"スタッフ{staff}"
+            })
+
+    return reference_images
+
+
+def collapse_export_jobs(jobs: List[Dict[str, Any]], formats: List[str]) -> List[Dict[str, Any]]:
+    """
+    マルチフォーマット書き出し用に、アスペクト比を除いたジョブにまとめる
+    （アスペクト比だけが違うジョブは1件になり、マスター画像の生成は1回になる）
+    """
+    collapsed = {}
+    for job in jobs:
+        job = {key: value for key, value in job.items() if key != "aspect_ratio"}
+        job["export_formats"] = formats
+        collapsed.setdefault(job_id(job), job)
+    return list(collapsed.values())
+
+
+def load_manifest(path: Path) -> Dict[str, Dict[str, Any]]:
+    """マニフェストを読み込み、ジョブIDごとの最新の記録を返す"""
+    records = {}
+    if path.exists():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断時に書きかけになった行は無視
+                    continue
+                records[record["job_id"]] = record
+    return records
+
+
+def append_manifest(path: Path, record: Dict[str, Any]) -> None:
+    """マニフェストに1件追記（チェックポイント）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        f.flush()
+
+
+async def run_batch(
+    jobs: List[Dict[str, Any]],
+    manifest_path: Path,
+    output_dir: Path,
+    concurrency: int = 4,
+    claude_concurrency: Optional[int] = None
+) -> Dict[str, int]:
+    """
+    ジョブをまとめて実行（完了済みのジョブはスキップ）
+
+    Returns:
+        {"total", "skipped", "succeeded", "failed"}
+    """
+    done = {jid for jid, record in load_manifest(manifest_path).items() if record.get("status") == "done"}
+
+    pending: List[Tuple[str, Dict[str, Any]]] = []
+    seen = set()
+    for job in jobs:
+        jid = job_id(job)
+        if jid in done or jid in seen:
+            continue
+        seen.add(jid)
+        pending.append((jid, job))
+
+    summary = {"total": len(jobs), "skipped": len(jobs) - len(pending), "succeeded": 0, "failed": 0}
+    print(f"📋 ジョブ {summary['total']}件（完了済み {summary['skipped']}件をスキップ）")
+
+    claude_semaphore = asyncio.Semaphore(claude_concurrency or concurrency)
+    gemini_semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(jid: str, job: Dict[str, Any]) -> None:
+        started = time.time()
+        try:
+            result = await generate_async(
+                build_generation_input(job),
+                build_reference_images(job),
+                output_dir=output_dir,
+                claude_semaphore=claude_semaphore,
+                gemini_semaphore=gemini_semaphore,
+                export_formats=job.get("export_formats")
+            )
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+
+        record = {
+            "job_id": jid,
+            "status": "done" if result.get("success") else "failed",
+            "job": job,
+            "image_path": result.get("image_path"),
+            "image_id": result.get("image_id"),
+            "prompt": result.get("prompt"),
+            "prompt_source": result.get("prompt_source"),
+            "exports": result.get("exports"),
+            "error": result.get("error"),
+            "elapsed_seconds": round(time.time() - started, 2),
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        append_manifest(manifest_path, record)
+
+        if result.get("success"):
+            summary["succeeded"] += 1
+            print(f"✅ [{jid}] {record['image_path']}")
+            for name, export in (record["exports"] or {}).items():
+                print(f"   ✂️ {name}: {export['image_path']}")
+        else:
+            summary["failed"] += 1
+            print(f"❌ [{jid}] {record['error']}")
+
+    # バッチのリクエストは対話的な生成より後に割り当てる
+    with request_context("batch", PRIORITY_BATCH):
+        await asyncio.gather(*[run_one(jid, job) for jid, job in pending])
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="cycleZ 画像のバッチ生成")
+    parser.add_argument("jobs", nargs="?", type=Path, help="ジョブファイル（.jsonl / .csv）")
+    parser.add_argument("--matrix", type=Path, help="組み合わせ指定ファイル（.json）")
+    parser.add_argument("--manifest", type=Path, help="マニフェストの保存先（デフォルト: ジョブファイル名.manifest.jsonl）")
+    parser.add_argument("--output-dir", type=Path, help="画像の出力先（デフォルト: outputs/batch_<ジョブファイル名>）")
+    parser.add_argument("--concurrency", type=int, default=4, help="Gemini の同時実行数")
+    parser.add_argument("--claude-concurrency", type=int, help="Claude の同時実行数（デフォルト: --concurrency と同じ）")
+    parser.add_argument(
+        "--export-formats",
+        help=f"マスター画像1枚から切り出す形式（カンマ区切り / all: {','.join(EXPORT_FORMATS)}）"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="ジョブ一覧を表示するだけで生成しない")
+    args = parser.parse_args(argv)
+
+    if (args.jobs is None) == (args.matrix is None):
+        parser.error("ジョブファイルか --matrix のどちらか一方を指定してください")
+
+    if args.matrix:
+        with open(args.matrix, encoding="utf-8") as f:
+            jobs = expand_matrix(json.load(f))
+        source = args.matrix
+    else:
+        jobs = load_jobs(args.jobs)
+        source = args.jobs
+
+    if args.export_formats:
+        formats = list(EXPORT_FORMATS) if args.export_formats == "all" else args.export_formats.split(",")
+        unknown = [name for name in formats if name not in EXPORT_FORMATS]
+        if unknown:
+            parser.error(f"不明な形式: {', '.join(unknown)}")
+        jobs = collapse_export_jobs(jobs, formats)
+
+    manifest_path = args.manifest or source.with_suffix(".manifest.jsonl")
+    output_dir = args.output_dir or OUTPUTS_DIR / f"batch_{source.stem}"
+
+    if args.dry_run:
+        done = load_manifest(manifest_path)
+        for job in jobs:
+            jid = job_id(job)
+            status = done.get(jid, {}).get("status", "pending")
+            print(f"{jid}  {status:8}  {json.dumps(job, ensure_ascii=False)}")
+        return 0
+
+    load_dotenv()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    summary = run_async(run_batch(jobs, manifest_path, output_dir, args.concurrency, args.claude_concurrency))
+    print(f"📊 完了: 成功 {summary['succeeded']} / 失敗 {summary['failed']} / スキップ {summary['skipped']}")
+    print(f"📄 マニフェスト: {manifest_path}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,481 @@
+"""
+オフラインのベンチマーク
+Claude / Gemini を代替クライアント（fake_clients.py）に差し替えて生成パイプラインを実行し、
+参照画像の枚数・アスペクト比・同時実行数ごとにスループット・レイテンシ・メモリ・送信バイト数を計測する
+APIの利用枠は使わない。結果はJSONに保存し、--compare で前回の結果と比較できる
+
+使い方:
+    python benchmark.py
+    python benchmark.py --concurrency 1,8,32 --references 0,10 --gemini-latency 2 --failure-rate 0.05
+    python benchmark.py --matrix --output outputs/benchmarks/after.json --compare outputs/benchmarks/before.json
+
+計測方法:
+    - 参照画像は実行ごとに作成するダミー画像（スタッフ画像として渡す）
+    - 各シナリオの前に1件だけ生成して参照画像の前処理キャッシュを温めてから計測する
+    - メモリは tracemalloc のピーク（Python のヒープ）と、プロセス全体の最大RSS
+    - handoff は生成結果を画面に渡す経路（表示とダウンロード）の計測。生成時のバッファを使う経路（buffer）と、
+      保存したファイルを表示用・ダウンロード用に2回読む経路（file）のピークメモリ・ディスク読み込み量を比べる
+    - overhead_seconds は1件あたりのレイテンシから代替APIの応答時間を引いた値（同時実行数が
+      スケジューラの上限を超える場合は待ち行列の待ち時間を含む）
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import itertools
+import contextlib
+import tracemalloc
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from app_config import ASPECT_RATIOS, OUTPUTS_DIR
+
+DEFAULT_RESULTS_DIR = OUTPUTS_DIR / "benchmarks"
+DEFAULT_REFERENCES = [0, 1, 2, 5, 10]
+DEFAULT_CONCURRENCY = [1, 2, 4, 8, 16, 32]
+# 各軸を変化させるときの他の軸の値
+BASE_REFERENCES = 2
+BASE_ASPECT_RATIO = "1:1"
+BASE_CONCURRENCY = 4
+# スケジューラのレート制限を実質的に無効にする値（--respect-limits で環境変数の設定を使う）
+UNLIMITED_RPM = 1_000_000
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """線形補間のパーセンタイル（q は 0〜1）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def make_reference_images(directory: Path, count: int, size: Tuple[int, int]) -> List[Dict[str, Any]]:
+    """
+    ダミーのスタッフ参照画像（JPEG）を count 枚作成
+    スマートフォンの写真に近いサイズ・圧縮率になるよう、ノイズを含む画像にする
+    """
+    from PIL import Image
+
+    directory.mkdir(parents=True, exist_ok=True)
+    references = []
+    for i in range(count):
+        path = directory / f"staff_{i:02d}.jpg"
+        noise = Image.effect_noise(size, 24)
+        gradient = Image.linear_gradient("L").resize(size)
+        Image.merge("RGB", (gradient, noise, gradient.rotate(180))).save(path, format="JPEG", quality=90)
+        references.append({"path": path, "type": "staff", "description": f"ベンチマーク用スタッフ {i + 1}"})
+    return references
+
+
+def build_scenarios(
+    references: List[int],
+    aspect_ratios: List[str],
+    concurrency: List[int],
+    matrix: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    計測するシナリオの一覧
+    matrix=False の場合は1つの軸だけを変化させ（他は BASE_* の値）、True の場合は全組み合わせ
+    """
+    if matrix:
+        combinations = list(itertools.product(references, aspect_ratios, concurrency))
+    else:
+        combinations = (
+            [(count, BASE_ASPECT_RATIO, BASE_CONCURRENCY) for count in references]
+            + [(BASE_REFERENCES, ratio, BASE_CONCURRENCY) for ratio in aspect_ratios]
+            + [(BASE_REFERENCES, BASE_ASPECT_RATIO, jobs) for jobs in concurrency]
+        )
+    scenarios = []
+    for count, ratio, jobs in dict.fromkeys(combinations):
+        scenarios.append({
+            "name": f"refs={count} aspect={ratio} concurrency={jobs}",
+            "references": count,
+            "aspect_ratio": ratio,
+            "concurrency": jobs,
+        })
+    return scenarios
+
+
+def _generation_input(aspect_ratio: str, index: int) -> Dict[str, Any]:
+    from batch_runner import build_generation_input
+
+    return build_generation_input({
+        "situation": "試乗相談",
+        "staff": "岡田",
+        "aspect_ratio": aspect_ratio,
+        "use_background": False,
+        "additional_prompt": f"benchmark #{index}",
+    })
+
+
+def _run_async_jobs(jobs: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]], concurrency: int,
+                    output_dir: Path, budget_seconds: float) -> List[Tuple[float, Dict[str, Any]]]:
+    """
+    pipeline.generate_async を1つのイベントループで同時実行（バッチ生成と同じ経路）
+    スレッドでの実行と揃えるため、同時実行数の枠を確保した時点からレイテンシを数える
+    """
+    from api_clients import run_async
+    from pipeline import generate_async
+
+    async def run_all():
+        slots = asyncio.Semaphore(concurrency)
+        claude_semaphore = asyncio.Semaphore(concurrency)
+        gemini_semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_one(generation_input, reference_images):
+            async with slots:
+                started = time.perf_counter()
+                result = await generate_async(
+                    generation_input, reference_images, force_refresh=True, output_dir=output_dir,
+                    claude_semaphore=claude_semaphore, gemini_semaphore=gemini_semaphore,
+                    budget_seconds=budget_seconds
+                )
+                return time.perf_counter() - started, result
+
+        return await asyncio.gather(*[run_one(*job) for job in jobs])
+
+    return run_async(run_all())
+
+
+def _run_thread_jobs(jobs: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]], concurrency: int,
+                     output_dir: Path, budget_seconds: float) -> List[Tuple[float, Dict[str, Any]]]:
+    """
+    ワーカースレッドで route_prompt → generate_image_with_gemini を実行
+    （画面からの生成と同じ同期の経路。ジョブキューのワーカーと同様にスレッド数が同時実行数になる）
+    """
+    from prompt_router import route_prompt
+    from image_generator import generate_image_with_gemini
+
+    def run_one(job):
+        generation_input, reference_images = job
+        started = time.perf_counter()
+        prompt, _ = route_prompt(generation_input, budget_seconds, force_refresh=True)
+        result = generate_image_with_gemini(
+            prompt, reference_images, aspect_ratio=generation_input["aspect_ratio"],
+            output_dir=output_dir, generation_input=generation_input
+        )
+        return time.perf_counter() - started, result
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="benchmark") as executor:
+        return list(executor.map(run_one, jobs))
+
+
+RUNNERS = {"async": _run_async_jobs, "threads": _run_thread_jobs}
+
+
+def measure_handoff(image_ids: List[str], output_dir: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    生成結果を画面に渡す経路のメモリ・ディスク読み込み量を計測
+
+    Returns:
+        {"buffer": {...}, "file": {...}}（それぞれ "images", "peak_memory_bytes", "disk_read_bytes", "seconds"）
+    """
+    from output_store import get_output_store
+    from result_buffers import get_result_buffers
+
+    store = get_output_store(output_dir)
+    records = [record for record in (store.get(image_id) for image_id in image_ids) if record]
+    buffers = get_result_buffers()
+
+    # 画面では表示用・ダウンロード用のデータがどちらも再実行まで保持されるため、計測中は参照を残しておく
+    def via_buffer(held: List[bytes]) -> int:
+        before = buffers.stats()["disk_read_bytes"]
+        for record in records:
+            data = buffers.read(record)
+            held.extend((data, data))
+        return buffers.stats()["disk_read_bytes"] - before
+
+    def via_file(held: List[bytes]) -> int:
+        read_bytes = 0
+        for record in records:
+            for _ in ("display", "download"):
+                with open(record["absolute_path"], "rb") as f:
+                    held.append(f.read())
+                read_bytes += len(held[-1])
+        return read_bytes
+
+    results = {}
+    for name, handoff in (("buffer", via_buffer), ("file", via_file)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        held: List[bytes] = []
+        disk_read_bytes = handoff(held)
+        seconds = time.perf_counter() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del held
+        results[name] = {
+            "images": len(records),
+            "peak_memory_bytes": peak_memory,
+            "disk_read_bytes": disk_read_bytes,
+            "seconds": seconds,
+        }
+    return results
+
+
+def _max_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux では KB、macOS ではバイト単位
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_scenario(
+    scenario: Dict[str, Any],
+    references: List[Dict[str, Any]],
+    registry: Any,
+    output_dir: Path,
+    mode: str = "async",
+    jobs: Optional[int] = None,
+    budget_seconds: float = 20.0,
+    respect_limits: bool = False,
+    quiet: bool = True
+) -> Dict[str, Any]:
+    """
+    1つのシナリオを実行して計測結果を返す
+
+    Returns:
+        scenario に "jobs", "succeeded", "failed", "seconds", "throughput_per_second", "latency",
+        "overhead_seconds", "peak_memory_bytes", "payload_bytes", "response_bytes", "handoff", "api" を加えた辞書
+    """
+    from scheduler import get_scheduler
+    from output_store import get_output_store
+    from output_encoder import get_output_encoder
+
+    concurrency = scenario["concurrency"]
+    job_count = jobs or max(8, concurrency * 2)
+    reference_images = references[:scenario["references"]]
+    if not respect_limits:
+        for api, profile in (("claude", registry.claude_profile), ("gemini", registry.gemini_profile)):
+            get_scheduler().configure(api, UNLIMITED_RPM, concurrency, expected_seconds=max(profile.latency, 0.01))
+
+    runner = RUNNERS[mode]
+    output = open(os.devnull, "w") if quiet else None
+    try:
+        with contextlib.ExitStack() as stack:
+            if output is not None:
+                stack.enter_context(contextlib.redirect_stdout(output))
+                stack.enter_context(contextlib.redirect_stderr(output))
+
+            # 参照画像の前処理キャッシュを温める（計測には含めない）
+            runner([(_generation_input(scenario["aspect_ratio"], -1), reference_images)], 1, output_dir, budget_seconds)
+
+            registry.reset_stats()
+            batch = [(_generation_input(scenario["aspect_ratio"], i), reference_images) for i in range(job_count)]
+            tracemalloc.start()
+            started = time.perf_counter()
+            timed = runner(batch, concurrency, output_dir, budget_seconds)
+            seconds = time.perf_counter() - started
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            # ファイルの書き込みと派生ファイルの書き出しが終わってから次のシナリオへ（出力ディレクトリの削除と重ならないように）
+            image_ids = [image_id for _, result in timed for image_id in result.get("image_ids", [])]
+            get_output_store(output_dir).wait_written(image_ids, timeout=None)
+            get_output_encoder().wait(image_ids)
+            handoff = measure_handoff(image_ids, output_dir)
+    finally:
+        if output is not None:
+            output.close()
+
+    latencies = [latency for latency, _ in timed]
+    succeeded = sum(1 for _, result in timed if result.get("success"))
+    api = registry.stats()
+    api_seconds = api["anthropic"]["api_seconds"] + api["gemini"]["api_seconds"]
+    gemini = api["gemini"]
+
+    return dict(
+        scenario,
+        mode=mode,
+        jobs=job_count,
+        succeeded=succeeded,
+        failed=job_count - succeeded,
+        errors=sorted({result.get("error") for _, result in timed if result.get("error")}),
+        seconds=seconds,
+        throughput_per_second=job_count / seconds if seconds else None,
+        latency={
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies),
+        },
+        overhead_seconds=(sum(latencies) - api_seconds) / job_count,
+        peak_memory_bytes=peak_memory,
+        payload_bytes={
+            "total": gemini["request_bytes"],
+            "mean": gemini["request_bytes"] / gemini["requests"] if gemini["requests"] else 0,
+            "max": gemini["max_request_bytes"],
+        },
+        response_bytes=gemini["response_bytes"],
+        handoff=handoff,
+        api=api,
+    )
+
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """同じ名前・モードのシナリオごとにスループット・p95・ピークメモリの変化率を計算"""
+    previous = {(row["mode"], row["name"]): row for row in baseline.get("scenarios", [])}
+    rows = []
+    for row in current["scenarios"]:
+        before = previous.get((row["mode"], row["name"]))
+        if before is None:
+            continue
+        changes = {"name": row["name"], "mode": row["mode"]}
+        for key, now, then in (
+            ("throughput_per_second", row["throughput_per_second"], before["throughput_per_second"]),
+            ("latency_p95", row["latency"]["p95"], before["latency"]["p95"]),
+            ("peak_memory_bytes", row["peak_memory_bytes"], before["peak_memory_bytes"]),
+            ("payload_bytes_mean", row["payload_bytes"]["mean"], before["payload_bytes"]["mean"]),
+        ):
+            changes[key] = (now - then) / then if now is not None and then else None
+        rows.append(changes)
+    return rows
+
+
+def _format_change(value: Optional[float]) -> str:
+    return "     -" if value is None else f"{value * 100:+6.1f}%"
+
+
+def print_scenario(row: Dict[str, Any]) -> None:
+    latency = row["latency"]
+    print(
+        f"   {row['name']:<38} {row['throughput_per_second']:7.2f} 件/s  "
+        f"p50 {latency['p50']:6.2f}s  p95 {latency['p95']:6.2f}s  "
+        f"overhead {row['overhead_seconds'] * 1000:7.1f}ms  "
+        f"peak {row['peak_memory_bytes'] / 2**20:7.1f}MB  "
+        f"payload {row['payload_bytes']['mean'] / 1024:8.0f}KB  "
+        f"handoff {row['handoff']['buffer']['peak_memory_bytes'] / 2**20:.1f}MB"
+        f"（file {row['handoff']['file']['peak_memory_bytes'] / 2**20:.1f}MB）"
+        + (f"  ❌ {row['failed']}/{row['jobs']}" if row["failed"] else "")
+    )
+
+
+def print_comparison(rows: List[Dict[str, Any]]) -> None:
+    print("\n◆ 前回との比較（スループット / p95 / ピークメモリ / 送信サイズ）")
+    for row in rows:
+        print(
+            f"   {row['name']:<38} {_format_change(row['throughput_per_second'])}  "
+            f"{_format_change(row['latency_p95'])}  {_format_change(row['peak_memory_bytes'])}  "
+            f"{_format_change(row['payload_bytes_mean'])}"
+        )
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def _str_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from fake_clients import (
+        FakeProfile, fake_image_bytes, install_fake_clients, parse_image_sizes, uninstall_fake_clients
+    )
+    from metrics import stage_summary
+
+    parser = argparse.ArgumentParser(description="代替クライアントで生成パイプラインを計測（APIは呼ばない）")
+    parser.add_argument("--mode", choices=sorted(RUNNERS), action="append",
+                        help="async: pipeline.generate_async（バッチ生成の経路）/ threads: 同期関数をスレッドで実行（複数指定可、デフォルト: async）")
+    parser.add_argument("--references", type=_int_list, default=DEFAULT_REFERENCES, help="参照画像の枚数（カンマ区切り）")
+    parser.add_argument("--aspect-ratios", type=_str_list, default=list(ASPECT_RATIOS.values()), help="アスペクト比（カンマ区切り）")
+    parser.add_argument("--concurrency", type=_int_list, default=DEFAULT_CONCURRENCY, help="同時実行数（カンマ区切り）")
+    parser.add_argument("--matrix", action="store_true", help="1軸ずつではなく全組み合わせを計測")
+    parser.add_argument("--jobs", type=int, help="シナリオごとの生成件数（デフォルト: 同時実行数の2倍、最低8件）")
+    parser.add_argument("--claude-latency", type=float, default=0.2, help="Claude の応答時間の中央値（秒）")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="Gemini の応答時間の中央値（秒）")
+    parser.add_argument("--jitter", type=float, default=0.25, help="応答時間のばらつき（対数正規分布の標準偏差）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="1リクエストが失敗する確率（両API共通）")
+    parser.add_argument("--image-sizes", type=parse_image_sizes, default=parse_image_sizes("1024x1024,2048x2048"),
+                        help="生成画像のサイズの候補（例: 1024x1024,2048x2048）")
+    parser.add_argument("--reference-size", type=lambda v: parse_image_sizes(v)[0], default=(3024, 4032),
+                        help="ダミー参照画像のサイズ（例: 3024x4032）")
+    parser.add_argument("--budget", type=float, default=20.0, help="プロンプト変換の待ち時間の上限（秒）")
+    parser.add_argument("--respect-limits", action="store_true", help="スケジューラのレート制限・同時実行数を環境変数の設定のまま使う")
+    parser.add_argument("--seed", type=int, default=0, help="代替クライアントの乱数の種")
+    parser.add_argument("--output", type=Path, help="結果のJSONの保存先（デフォルト: outputs/benchmarks/benchmark_<日時>.json）")
+    parser.add_argument("--compare", type=Path, help="比較する前回の結果（JSON）")
+    parser.add_argument("--verbose", action="store_true", help="パイプラインのログを表示")
+    args = parser.parse_args(argv)
+
+    # APIキーの確認を通すためのダミー値（代替クライアントは使わない）
+    os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+    claude = FakeProfile(args.claude_latency, args.jitter, args.failure_rate, seed=args.seed)
+    gemini = FakeProfile(args.gemini_latency, args.jitter, args.failure_rate, args.image_sizes, seed=args.seed)
+    scenarios = build_scenarios(args.references, args.aspect_ratios, args.concurrency, args.matrix)
+    modes = args.mode or ["async"]
+
+    registry = install_fake_clients(claude, gemini)
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="cyclez-benchmark-") as workdir:
+            workdir = Path(workdir)
+            print(f"🖼 ダミー参照画像を作成中（{max(args.references)}枚）...")
+            references = make_reference_images(workdir / "references", max(args.references), args.reference_size)
+            # 代替クライアントが返す画像も先に作っておく（作成時間を計測に含めない）
+            for size in args.image_sizes:
+                fake_image_bytes(*size)
+
+            for mode in modes:
+                print(f"\n◆ {mode}（{len(scenarios)} シナリオ）")
+                for scenario in scenarios:
+                    row = run_scenario(
+                        scenario, references, registry, workdir / "outputs", mode, args.jobs,
+                        args.budget, args.respect_limits, quiet=not args.verbose
+                    )
+                    rows.append(row)
+                    print_scenario(row)
+    finally:
+        uninstall_fake_clients()
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "claude": claude.to_dict(),
+            "gemini": gemini.to_dict(),
+            "reference_size": "x".join(map(str, args.reference_size)),
+            "budget_seconds": args.budget,
+            "respect_limits": args.respect_limits,
+            "matrix": args.matrix,
+        },
+        "max_rss_bytes": _max_rss_bytes(),
+        "scenarios": rows,
+        "stages": stage_summary(),
+    }
+
+    output = args.output or DEFAULT_RESULTS_DIR / f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\n💾 結果を保存: {output}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        print_comparison(compare_results(results, baseline))
+
+    failed = sum(row["failed"] for row in rows)
+    if failed and not args.failure_rate:
+        print(f"❌ {failed} 件の生成に失敗しました: {sorted({e for row in rows for e in row['errors']})}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
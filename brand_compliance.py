@@ -0,0 +1,408 @@
+"""
+ブランドガイドラインのチェック
+Geminiに送る前のプロンプトからNGメーカー・NGワードを検出し、その場で置き換えるか、
+Claudeに1回だけ該当箇所の書き直しを依頼する
+ガイドラインの全ての語を1つの正規表現にまとめてコンパイルしておき、1回の走査で照合する
+"""
+
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import log_event
+from prompt_converter import (
+    NG_BIKE_BRANDS, NG_KEYWORDS, NG_WEAR_BRANDS, RECOMMENDED_BIKE_BRANDS, RECOMMENDED_KEYWORDS,
+    RECOMMENDED_WEAR_BRANDS
+)
+
+# 分類
+NG_BIKE = "ng_bike"
+NG_WEAR = "ng_wear"
+NG_KEYWORD = "ng_keyword"
+OK_BIKE = "ok_bike"
+OK_WEAR = "ok_wear"
+OK_KEYWORD = "ok_keyword"
+NG_CATEGORIES = (NG_BIKE, NG_WEAR, NG_KEYWORD)
+
+# 一般的な英単語と同じつづりのメーカー名は、大文字で始まる場合だけメーカーとみなす
+# （"specialized tools" "trekking" "giant windows" "anchor point" を誤検出しない）
+CASE_SENSITIVE_TERMS = {"Specialized", "Trek", "GIANT", "ANCHOR", "MATE", "CHROME", "MERIDA"}
+
+# NGワードの置き換え先
+KEYWORD_REPLACEMENTS = {
+    "racing": "casual riding",
+    "competitive": "relaxed",
+    "professional": "casual",
+    "intense": "focused",
+    "aggressive": "relaxed",
+    "extreme": "enjoyable",
+    "championship": "community ride",
+    "aero": "comfortable",
+    "time trial": "weekend ride",
+    "velodrome": "city street",
+    "peloton": "group of friends riding",
+    "pro team": "local cycling club",
+}
+
+# "professional" はプロレーサー風の印象（競技・機材の性能の訴求）を避けるためのNGワードで、
+# 写真・接客の品質や人物・雰囲気の説明（"professional photograph" "urban professional"
+# "relaxed professional atmosphere"）は問題ない。直後に競技・機材を表す語が続く場合だけ違反とする
+PROFESSIONAL_CLAIM = re.compile(
+    r"[\s-]+(?:(?:road|track|racing)[\s-]+(?:bikes?|bicycles?|cyclists?|riders?)|cyclists?|riders?|racers?"
+    r"|athletes?|teams?|racing|races?|level|grade|spec|performance|competition|kit|gear|equipment)\b",
+    re.IGNORECASE
+)
+
+# "professional-grade" "professional level" は語ごと削除し、"professional racing" は直後の語の置き換えに任せる
+# （"casual-grade" "casual casual riding" のような不自然な文にしない）
+PROFESSIONAL_DROP = re.compile(r"[\s-]+(?:(?:grade|level|spec)\b|(?=rac(?:ing|ers?|es?)\b))", re.IGNORECASE)
+
+# NGの語の直前（同じ句の3語以内）にある否定（"no racing gear" "avoid aggressive poses" "non-racing"）
+NEGATION_WORDS = {"no", "not", "never", "without", "avoid", "avoids", "avoiding", "non"}
+NEGATION_PHRASES = {"instead of", "rather than", "free of", "free from"}
+NEGATION_WINDOW = 60
+_CLAUSE_BREAK = re.compile(r"[.,;:!?()]")
+
+
+def _is_negated(text: str, start: int) -> bool:
+    clause = _CLAUSE_BREAK.split(text[max(0, start - NEGATION_WINDOW):start])[-1]
+    words = clause.lower().replace("-", " ").split()[-4:]
+    if any(word in NEGATION_WORDS for word in words):
+        return True
+    return any(f"{a} {b}" in NEGATION_PHRASES for a, b in zip(words, words[1:]))
+
+
+def _normalize(text: str) -> str:
+    if " " not in text and "-" not in text:
+        return text.lower()
+    return re.sub(r"[\s-]+", " ", text).lower()
+
+
+def _trie_pattern(terms: List[str]) -> str:
+    r"""
+    語の一覧から接頭辞を共有する正規表現を作る（"pro team|professional" → "pro(?:[\s-]+team|fessional)"）
+    分岐の数が減るため、語を単純に並べた選択より走査が速い
+    """
+    trie: Dict[str, Any] = {}
+    for term in terms:
+        node = trie
+        # "Pearl Izumi" "time trial" は間の空白・ハイフンの違いも許容
+        for token in (r"[\s-]+" if char == " " else re.escape(char) for char in _normalize(term)):
+            node = node.setdefault(token, {})
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        branches = [token + build(child) for token, child in node.items() if token]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class BrandMatcher:
+    r"""
+    ガイドラインの語（NG・推奨）をまとめた照合器
+    全ての語を1つの正規表現（接頭辞を共有した \b(?:語1|語2|...)\b）にコンパイルし、
+    小文字にしたテキストを1回走査して全ての語を検出する
+    一致した文字列は正規化して辞書で語・分類に戻す
+    """
+
+    def __init__(self, terms: Dict[str, List[str]]):
+        self._terms: Dict[str, Tuple[str, str]] = {}
+        for category, words in terms.items():
+            for term in words:
+                self._terms[_normalize(term)] = (term, category)
+        source = r"\b" + _trie_pattern([term for term, _ in self._terms.values()]) + r"\b"
+        self.pattern = re.compile(source)
+        # 小文字にすると長さが変わる文字を含むテキスト用（位置がずれないよう元のテキストを走査）
+        self._pattern_ignorecase = re.compile(source, re.IGNORECASE)
+
+    def scan(self, text: str) -> List[Dict[str, Any]]:
+        """
+        テキスト中のガイドラインの語を検出
+
+        Returns:
+            [{"term", "category", "text", "start", "end", "negated"}, ...]（出現順）
+            "professional" は競技・機材の性能を表す用法（"professional racer" "professional-grade gear"）だけを含める
+        """
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            found = self.pattern.finditer(lowered)
+        else:
+            found = self._pattern_ignorecase.finditer(text)
+
+        matches = []
+        for match in found:
+            term, category = self._terms[_normalize(match.group())]
+            original = text[match.start():match.end()]
+            if term in CASE_SENSITIVE_TERMS and original not in (term, term.upper(), term.capitalize()):
+                continue
+            if term == "professional" and not PROFESSIONAL_CLAIM.match(text, match.end()):
+                continue
+            negated = False
+            if category in NG_CATEGORIES:
+                negated = _is_negated(text, match.start())
+            matches.append({
+                "term": term,
+                "category": category,
+                "text": original,
+                "start": match.start(),
+                "end": match.end(),
+                "negated": negated,
+            })
+        return matches
+
+
+def _sentences(text: str) -> List[Tuple[int, int]]:
+    spans = []
+    start = 0
+    for match in re.finditer(r"(?<=[.!?])\s+", text):
+        spans.append((start, match.start()))
+        start = match.end()
+    if start < len(text):
+        spans.append((start, len(text)))
+    return spans
+
+
+def _fix_article(head: str, following: str) -> str:
+    """置き換えた語の直前の不定冠詞を、続く語に合わせる（"an aggressive" → "a relaxed"）"""
+    article = re.search(r"\b([Aa])n?(\s+)$", head)
+    if article is None or not following:
+        return head
+    vowel = following[:1].lower() in "aeiou"
+    return head[:article.start()] + article.group(1) + ("n" if vowel else "") + article.group(2)
+
+
+def repair(prompt: str, violations: List[Dict[str, Any]]) -> str:
+    """
+    NGの語をその場で置き換える
+    - NGメーカー: 推奨メーカーに置き換え（否定形での言及は文ごと削除。メーカー名自体を出さない）
+    - NGワード: 置き換え表の語に置き換え（否定形での言及はガイドラインに沿うため残す）
+    """
+    removed_sentences = set()
+    spans = _sentences(prompt)
+    for violation in violations:
+        if violation["negated"] and violation["category"] in (NG_BIKE, NG_WEAR):
+            for i, (start, end) in enumerate(spans):
+                if start <= violation["start"] < end:
+                    removed_sentences.add(i)
+
+    # 全ての文が対象になる場合は文を残し、メーカー名だけを削除する
+    drop_names = len(removed_sentences) == len(spans)
+    if drop_names:
+        removed_sentences.clear()
+
+    bike_index = wear_index = 0
+    replacements = []
+    for violation in violations:
+        if violation["negated"]:
+            if drop_names and violation["category"] in (NG_BIKE, NG_WEAR):
+                replacements.append((violation["start"], violation["end"], ""))
+            continue
+        if violation["category"] == NG_BIKE:
+            replacement = RECOMMENDED_BIKE_BRANDS[bike_index % len(RECOMMENDED_BIKE_BRANDS)]
+            bike_index += 1
+        elif violation["category"] == NG_WEAR:
+            replacement = RECOMMENDED_WEAR_BRANDS[wear_index % len(RECOMMENDED_WEAR_BRANDS)]
+            wear_index += 1
+        else:
+            replacement = KEYWORD_REPLACEMENTS.get(violation["term"], "")
+            if violation["term"] == "professional":
+                dropped = PROFESSIONAL_DROP.match(prompt, violation["end"])
+                if dropped:
+                    replacements.append((violation["start"], dropped.end(), ""))
+                    continue
+            if violation["text"][:1].isupper():
+                replacement = replacement[:1].upper() + replacement[1:]
+        replacements.append((violation["start"], violation["end"], replacement))
+
+    # 後ろから置き換えて位置がずれないようにする
+    parts = []
+    for i, (start, end) in enumerate(spans):
+        if i in removed_sentences:
+            continue
+        sentence = prompt[start:end]
+        for r_start, r_end, replacement in sorted(replacements, reverse=True):
+            if start <= r_start < end:
+                head, tail = sentence[:r_start - start], sentence[r_end - start:]
+                sentence = _fix_article(head, replacement or tail.lstrip()) + replacement + tail
+        parts.append(sentence)
+    return re.sub(r"\s{2,}", " ", " ".join(parts)).strip()
+
+
+class ComplianceChecker:
+    """
+    Geminiに送る前のプロンプトのチェック
+    違反は置き換えで直す。置き換えで直せない（否定形でのメーカー名の言及）場合は reconvert を1回だけ呼ぶ
+    """
+
+    def __init__(self, matcher: Optional[BrandMatcher] = None):
+        self.matcher = matcher or get_brand_matcher()
+
+    @staticmethod
+    def violations(matches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """検出結果のうちガイドライン違反のもの（否定形のNGワードは違反としない）"""
+        return [
+            m for m in matches
+            if m["category"] in NG_CATEGORIES and not (m["negated"] and m["category"] == NG_KEYWORD)
+        ]
+
+    def check(self, prompt: str) -> Dict[str, Any]:
+        """
+        プロンプトを照合
+
+        Returns:
+            {"compliant", "violations", "recommended", "scan_microseconds"}
+        """
+        started = time.perf_counter()
+        matches = self.matcher.scan(prompt)
+        scan_microseconds = (time.perf_counter() - started) * 1e6
+        return {
+            "compliant": not self.violations(matches),
+            "violations": self.violations(matches),
+            "recommended": sorted({m["term"] for m in matches if m["category"] not in NG_CATEGORIES}),
+            "scan_microseconds": scan_microseconds,
+        }
+
+    def enforce(
+        self,
+        prompt: str,
+        reconvert: Optional[Callable[[List[str]], str]] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        プロンプトをガイドラインに沿うように直す
+
+        Args:
+            prompt: チェックするプロンプト
+            reconvert: 違反した語のリストを受け取り、書き直したプロンプトを返す関数（Claudeへの再変換）
+                       None の場合は置き換えだけで直す
+
+        Returns:
+            (直したプロンプト, {"action", "compliant", "violations", "recommended", "scan_microseconds", ...})
+            action は "none"（違反なし）/ "repaired"（置き換え）/ "reconverted"（再変換）
+        """
+        report = self.check(prompt)
+        result = {
+            "action": "none",
+            "violations": [
+                {"term": v["term"], "category": v["category"], "negated": v["negated"]} for v in report["violations"]
+            ],
+            "recommended": report["recommended"],
+            "scan_microseconds": round(report["scan_microseconds"], 1),
+        }
+        if report["compliant"]:
+            result["compliant"] = True
+            return prompt, result
+
+        terms = sorted({v["term"] for v in report["violations"]})
+        needs_rewrite = any(v["negated"] for v in report["violations"])
+        if needs_rewrite and reconvert is not None:
+            try:
+                revised = reconvert(terms)
+                revised_report = self.check(revised)
+                if revised_report["compliant"]:
+                    result.update(action="reconverted", compliant=True)
+                    return revised, result
+                # 再変換でも残った語は置き換えで直す
+                prompt, report = revised, revised_report
+            except Exception as e:
+                log_event("compliance_reconvert_error", f"⚠️ ブランドチェックの再変換エラー（置き換えで修正）: {e}",
+                          level="warning", error=str(e))
+
+        repaired = repair(prompt, report["violations"])
+        result.update(action="repaired", compliant=self.check(repaired)["compliant"])
+        return repaired, result
+
+
+def log_compliance(result: Dict[str, Any], label: str = "") -> None:
+    """チェック結果を表示"""
+    prefix = f"[{label}] " if label else ""
+    fields = {"label": label, "action": result["action"], "scan_microseconds": result["scan_microseconds"]}
+    if result["action"] == "none":
+        log_event(
+            "compliance", f"🛡️ {prefix}ブランドチェック: OK（{result['scan_microseconds']:.0f}µs、推奨語 {len(result['recommended'])}件）",
+            compliant=True, recommended=result["recommended"], **fields
+        )
+        return
+    terms = sorted({v["term"] for v in result["violations"]})
+    action = "再変換" if result["action"] == "reconverted" else "置き換え"
+    status = "修正済み" if result["compliant"] else "一部未修正"
+    log_event(
+        "compliance", f"🛡️ {prefix}ブランドチェック: NG {len(result['violations'])}件（{', '.join(terms)}）→ {action}で{status}",
+        level="info" if result["compliant"] else "warning", compliant=result["compliant"], violations=terms, **fields
+    )
+
+
+_default_matcher: Optional[BrandMatcher] = None
+
+
+def get_brand_matcher() -> BrandMatcher:
+    """ガイドラインの語をまとめた照合器（初回にコンパイル）"""
+    global _default_matcher
+    if _default_matcher is None:
+        _default_matcher = BrandMatcher({
+            NG_BIKE: NG_BIKE_BRANDS,
+            NG_WEAR: NG_WEAR_BRANDS,
+            NG_KEYWORD: NG_KEYWORDS,
+            OK_BIKE: RECOMMENDED_BIKE_BRANDS,
+            OK_WEAR: RECOMMENDED_WEAR_BRANDS,
+            OK_KEYWORD: RECOMMENDED_KEYWORDS,
+        })
+    return _default_matcher
+
+
+def _check_local_prompts() -> None:
+    """
+    テーブルの説明文と、build_local_prompt が作る全ての組み合わせのプロンプトが
+    置き換えなしでチェックを通ることを確認（APIは呼ばない）
+    """
+    import itertools
+    from prompt_converter import (
+        CLIENT_DESCRIPTIONS, MOOD_MODIFIERS, PURPOSE_STYLES, SITUATION_PROMPTS, build_local_prompt
+    )
+
+    checker = ComplianceChecker()
+    phrases = list(CLIENT_DESCRIPTIONS.values()) + list(MOOD_MODIFIERS.values())
+    phrases += [text for info in SITUATION_PROMPTS.values() for text in info.values()]
+    for phrase in phrases:
+        assert checker.check(phrase)["compliant"], phrase
+
+    staff_options = [{}, {"staff": "西井", "staff_glasses": "眼鏡あり"}, {"staff": "西井", "staff_glasses": "眼鏡なし"}]
+    combinations = itertools.product(
+        PURPOSE_STYLES, SITUATION_PROMPTS, [None] + list(CLIENT_DESCRIPTIONS), MOOD_MODIFIERS, staff_options
+    )
+    count = 0
+    for purpose, situation, client, mood, staff in combinations:
+        generation_input = dict(staff, purpose=purpose, situation=situation, client=client, mood=mood)
+        prompt = build_local_prompt(generation_input)
+        enforced, result = checker.enforce(prompt)
+        assert result["action"] == "none" and enforced == prompt, (generation_input, result["violations"])
+        count += 1
+    print(f"✅ ローカルプロンプト: {count}通り・テーブルの説明文 {len(phrases)}件が置き換えなしで通過")
+
+
+if __name__ == "__main__":
+    import timeit
+
+    _check_local_prompts()
+
+    checker = ComplianceChecker()
+    samples = [
+        "All people in this image must be Japanese. A professional photograph of a staff member showing a "
+        "GIOS road bike to a customer, casual cycling, natural light, welcoming atmosphere.",
+        "A customer in Rapha kit next to a Specialized aero bike, intense racing mood in the peloton.",
+        "No racing gear or aggressive poses. Avoid brands like Trek or Bianchi. A TOKYOBIKE in a modern shop.",
+        "Rows of specialized tools on the workbench, trekking maps and giant windows with an anchor point for the stand.",
+        "A professional road bike and professional-grade racing kit for an urban professional.",
+        "An aggressive sprint by a professional cyclist in professional racing gear.",
+    ]
+    for sample in samples:
+        prompt, result = checker.enforce(sample)
+        log_compliance(result)
+        print(f"   {prompt}\n")
+
+    runs = 10000
+    seconds = timeit.timeit(lambda: checker.matcher.scan(samples[1]), number=runs)
+    print(f"⏱ 照合: {seconds / runs * 1e6:.1f}µs / プロンプト（{len(samples[1])}文字）")
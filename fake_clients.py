@@ -0,0 +1,403 @@
+"""
+Claude / Gemini のローカル代替クライアント（APIを呼ばない）
+api_clients のレジストリを差し替えて、convert_prompt_with_claude・generate_image_with_gemini などを
+そのまま実行できるようにする。応答までの時間・失敗率・生成画像のサイズは FakeProfile で指定する
+ベンチマーク（benchmark.py）と動作確認用
+
+使い方:
+    registry = install_fake_clients(gemini=FakeProfile(latency=2.0, failure_rate=0.05))
+    result = generate_image_with_gemini(prompt, reference_images)
+    print(registry.stats())
+    uninstall_fake_clients()
+"""
+
+import io
+import time
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from api_clients import ClientRegistry, get_client_registry, set_client_registry
+
+# 代替クライアントが返すプロンプト（ブランドチェックを通る内容）
+FAKE_PROMPT = (
+    "All people in this image must be Japanese. A professional photograph inside a bright, modern bicycle shop. "
+    "A friendly Japanese staff member in a casual cycling jersey explains a GIOS road bike to a customer. "
+    "Natural light, clean interior, approachable atmosphere, brand accent color red (#e63232). "
+    "Eye-level composition, shallow depth of field, high quality photography."
+)
+
+
+class FakeApiError(RuntimeError):
+    """代替クライアントが失敗率に応じて発生させるエラー（status_code 503 のため再試行の対象になる）"""
+
+    def __init__(self, api: str):
+        super().__init__(f"{api}: 代替クライアントの擬似エラー (503)")
+        self.status_code = 503
+
+
+class FakeProfile:
+    """
+    代替クライアントの応答の設定
+    latency: 応答までの時間の中央値（秒）。対数正規分布でばらつかせる（jitter はその標準偏差）
+    failure_rate: 1リクエストが失敗する確率
+    image_sizes: 生成画像のサイズ (幅, 高さ) の候補（リクエストごとに weights に従って選ぶ）
+    seed: 乱数の種（同じ設定なら同じ順番で同じ値を返す）
+    """
+
+    def __init__(
+        self,
+        latency: float = 1.0,
+        jitter: float = 0.25,
+        failure_rate: float = 0.0,
+        image_sizes: Sequence[Tuple[int, int]] = ((1024, 1024),),
+        weights: Optional[Sequence[float]] = None,
+        seed: Optional[int] = 0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.image_sizes = [tuple(size) for size in image_sizes]
+        self.weights = list(weights) if weights else None
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        with self._lock:
+            return self.latency * self._random.lognormvariate(0.0, self.jitter)
+
+    def sample_failure(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def sample_image_size(self) -> Tuple[int, int]:
+        with self._lock:
+            return self._random.choices(self.image_sizes, weights=self.weights)[0]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "latency": self.latency,
+            "jitter": self.jitter,
+            "failure_rate": self.failure_rate,
+            "image_sizes": [f"{width}x{height}" for width, height in self.image_sizes],
+            "weights": self.weights,
+            "seed": self.seed,
+        }
+
+
+def parse_image_sizes(value: str) -> List[Tuple[int, int]]:
+    """"1024x1024,2048x2048" 形式の文字列をサイズのリストに変換"""
+    sizes = []
+    for item in value.split(","):
+        width, _, height = item.strip().lower().partition("x")
+        sizes.append((int(width), int(height or width)))
+    return sizes
+
+
+@lru_cache(maxsize=16)
+def fake_image_bytes(width: int, height: int) -> bytes:
+    """
+    指定サイズのPNG画像（ノイズ入りで圧縮されにくく、実際の生成画像に近いバイト数になる）
+    サイズごとに1回だけ作成して使い回す
+    """
+    from PIL import Image
+
+    noise = Image.effect_noise((width, height), 48)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (noise, gradient, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def contents_bytes(contents: Any) -> int:
+    """Gemini に渡されたコンテンツ（文字列・Part）の合計バイト数"""
+    if isinstance(contents, (str, bytes)) or not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item.encode("utf-8"))
+        elif isinstance(item, bytes):
+            total += len(item)
+        else:
+            inline_data = getattr(item, "inline_data", None)
+            if inline_data is not None and inline_data.data:
+                total += len(inline_data.data)
+            elif getattr(item, "text", None):
+                total += len(item.text.encode("utf-8"))
+    return total
+
+
+class _FakeStats:
+    """代替クライアントの呼び出し回数・失敗数・送受信バイト数・擬似的な応答時間の合計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.failures = 0
+            self.request_bytes = 0
+            self.response_bytes = 0
+            self.max_request_bytes = 0
+            self.api_seconds = 0.0
+
+    def record(self, request_bytes: int = 0, response_bytes: int = 0, failed: bool = False, seconds: float = 0.0) -> None:
+        with self._lock:
+            self.requests += 1
+            self.failures += int(failed)
+            self.request_bytes += request_bytes
+            self.response_bytes += response_bytes
+            self.max_request_bytes = max(self.max_request_bytes, request_bytes)
+            self.api_seconds += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "request_bytes": self.request_bytes,
+                "response_bytes": self.response_bytes,
+                "max_request_bytes": self.max_request_bytes,
+                "api_seconds": self.api_seconds,
+            }
+
+
+def _claude_usage(first: bool) -> SimpleNamespace:
+    # 1回目はシステムプロンプトのキャッシュ書き込み、以降は読み込みとして応答
+    return SimpleNamespace(
+        input_tokens=200,
+        output_tokens=120,
+        cache_creation_input_tokens=1500 if first else 0,
+        cache_read_input_tokens=0 if first else 1500,
+    )
+
+
+def _claude_message(first: bool) -> SimpleNamespace:
+    return SimpleNamespace(content=[SimpleNamespace(text=FAKE_PROMPT)], usage=_claude_usage(first))
+
+
+def _claude_request_bytes(kwargs: Dict[str, Any]) -> int:
+    return len(repr(kwargs.get("system", "")).encode("utf-8")) + len(repr(kwargs.get("messages", "")).encode("utf-8"))
+
+
+class _FakeClaudeStream:
+    """messages.stream() の代替（latency の間に応答を分割して返す）"""
+
+    def __init__(self, messages: "_FakeMessages", kwargs: Dict[str, Any]):
+        self._messages = messages
+        self._kwargs = kwargs
+
+    def __enter__(self) -> "_FakeClaudeStream":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> bool:
+        return False
+
+    @property
+    def text_stream(self) -> Iterator[str]:
+        words = FAKE_PROMPT.split(" ")
+        delay = self._messages.begin(self._kwargs)
+        # 最初のトークンまでに全体の3割、残りを単語ごとに分けて待つ
+        time.sleep(delay * 0.3)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(delay * 0.7 / len(words))
+            yield word if i == 0 else " " + word
+
+    def get_final_message(self) -> SimpleNamespace:
+        return _claude_message(self._messages.first_response())
+
+
+class _FakeMessages:
+    """anthropic の client.messages の代替"""
+
+    def __init__(self, profile: FakeProfile, stats: _FakeStats):
+        self.profile = profile
+        self.stats = stats
+        self._responses = 0
+        self._lock = threading.Lock()
+
+    def first_response(self) -> bool:
+        with self._lock:
+            self._responses += 1
+            return self._responses == 1
+
+    def begin(self, kwargs: Dict[str, Any]) -> float:
+        """1リクエスト分の失敗判定と記録を行い、応答までの時間を返す（失敗時は待ってから例外）"""
+        delay = self.profile.sample_latency()
+        failed = self.profile.sample_failure()
+        self.stats.record(_claude_request_bytes(kwargs), 0 if failed else len(FAKE_PROMPT), failed, delay)
+        if failed:
+            time.sleep(delay)
+            raise FakeApiError("claude")
+        return delay
+
+    def create(self, **kwargs: Any) -> SimpleNamespace:
+        time.sleep(self.begin(kwargs))
+        return _claude_message(self.first_response())
+
+    def stream(self, **kwargs: Any) -> _FakeClaudeStream:
+        return _FakeClaudeStream(self, kwargs)
+
+
+class _FakeAsyncMessages:
+    """anthropic の AsyncAnthropic().messages の代替"""
+
+    def __init__(self, messages: _FakeMessages):
+        self._messages = messages
+
+    async def create(self, **kwargs: Any) -> SimpleNamespace:
+        delay = self._messages.profile.sample_latency()
+        failed = self._messages.profile.sample_failure()
+        self._messages.stats.record(_claude_request_bytes(kwargs), 0 if failed else len(FAKE_PROMPT), failed, delay)
+        await asyncio.sleep(delay)
+        if failed:
+            raise FakeApiError("claude")
+        return _claude_message(self._messages.first_response())
+
+
+class _FakeModels:
+    """google-genai の client.models の代替"""
+
+    def __init__(self, profile: FakeProfile, stats: _FakeStats):
+        self.profile = profile
+        self.stats = stats
+
+    def _prepare(self, contents: Any) -> Tuple[float, Optional[bytes]]:
+        delay = self.profile.sample_latency()
+        failed = self.profile.sample_failure()
+        data = None if failed else fake_image_bytes(*self.profile.sample_image_size())
+        self.stats.record(contents_bytes(contents), len(data) if data else 0, failed, delay)
+        return delay, data
+
+    @staticmethod
+    def _response(data: bytes) -> SimpleNamespace:
+        parts = [
+            SimpleNamespace(text="Here is the generated image.", inline_data=None),
+            SimpleNamespace(text=None, inline_data=SimpleNamespace(data=data, mime_type="image/png")),
+        ]
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))])
+
+    def generate_content(self, model: str, contents: Any, config: Any = None) -> SimpleNamespace:
+        delay, data = self._prepare(contents)
+        time.sleep(delay)
+        if data is None:
+            raise FakeApiError("gemini")
+        return self._response(data)
+
+
+class _FakeAsyncModels:
+    """google-genai の client.aio.models の代替"""
+
+    def __init__(self, models: _FakeModels):
+        self._models = models
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> SimpleNamespace:
+        delay, data = self._models._prepare(contents)
+        await asyncio.sleep(delay)
+        if data is None:
+            raise FakeApiError("gemini")
+        return _FakeModels._response(data)
+
+
+class FakeClientRegistry(ClientRegistry):
+    """
+    代替クライアントを返すレジストリ
+    同期・非同期のどちらの取得関数からも同じ設定・統計のクライアントを返す
+    """
+
+    def __init__(self, claude: Optional[FakeProfile] = None, gemini: Optional[FakeProfile] = None):
+        super().__init__()
+        self.claude_profile = claude or FakeProfile(latency=0.5)
+        self.gemini_profile = gemini or FakeProfile(latency=1.0)
+        self.fake_stats = {"anthropic": _FakeStats(), "gemini": _FakeStats()}
+
+        messages = _FakeMessages(self.claude_profile, self.fake_stats["anthropic"])
+        models = _FakeModels(self.gemini_profile, self.fake_stats["gemini"])
+        self._anthropic = SimpleNamespace(messages=messages)
+        self._async_anthropic = SimpleNamespace(messages=_FakeAsyncMessages(messages))
+        self._gemini = SimpleNamespace(models=models, aio=SimpleNamespace(models=_FakeAsyncModels(models)))
+
+    def anthropic_client(self) -> Any:
+        return self._anthropic
+
+    def gemini_client(self) -> Any:
+        return self._gemini
+
+    def async_anthropic_client(self) -> Any:
+        return self._async_anthropic
+
+    def async_gemini_client(self) -> Any:
+        return self._gemini
+
+    def check_health(self) -> Dict[str, bool]:
+        return {"anthropic": True, "gemini": True}
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """クライアントごとのリクエスト数・失敗数・送受信バイト数"""
+        return {name: stats.snapshot() for name, stats in self.fake_stats.items()}
+
+    def reset_stats(self) -> None:
+        for stats in self.fake_stats.values():
+            stats.reset()
+
+    def close(self) -> None:
+        pass
+
+
+_previous_registry: Optional[ClientRegistry] = None
+
+
+def install_fake_clients(claude: Optional[FakeProfile] = None, gemini: Optional[FakeProfile] = None) -> FakeClientRegistry:
+    """代替クライアントのレジストリに差し替える（uninstall_fake_clients で元に戻す）"""
+    global _previous_registry
+    current = get_client_registry()
+    if not isinstance(current, FakeClientRegistry):
+        _previous_registry = current
+    registry = FakeClientRegistry(claude, gemini)
+    set_client_registry(registry)
+    return registry
+
+
+def uninstall_fake_clients() -> None:
+    """install_fake_clients の前のレジストリに戻す"""
+    global _previous_registry
+    if _previous_registry is not None:
+        set_client_registry(_previous_registry)
+        _previous_registry = None
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from pathlib import Path
+
+    from prompt_converter import convert_prompt_with_claude
+    from image_generator import generate_image_with_gemini
+
+    # APIキーの確認を通すためのダミー値（代替クライアントは使わない）
+    os.environ.setdefault("ANTHROPIC_API_KEY", "fake")
+    os.environ.setdefault("GEMINI_API_KEY", "fake")
+
+    registry = install_fake_clients(
+        claude=FakeProfile(latency=0.05),
+        gemini=FakeProfile(latency=0.1, image_sizes=[(512, 512), (768, 512)]),
+    )
+    try:
+        prompt = convert_prompt_with_claude({"situation": "試乗相談", "staff": "岡田"})
+        with tempfile.TemporaryDirectory() as output_dir:
+            result = generate_image_with_gemini(prompt, [], aspect_ratio="3:2", output_dir=Path(output_dir))
+        assert result["success"], result
+        print(f"✅ 代替クライアントで生成: {registry.stats()}")
+    finally:
+        uninstall_fake_clients()
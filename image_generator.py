@@ -4,12 +4,252 @@ Google Genai API (Gemini 2.0 Flash) を使用した画像生成モジュール
 """
 
 import os
+import time
 import base64
+import asyncio
 from pathlib import Path
-from datetime import datetime
-from typing import Dict, Any, List, Optional
-from google import genai
-from google.genai import types
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple
+
+from api_clients import get_gemini_client, get_async_gemini_client
+from output_store import get_output_store
+from output_encoder import get_output_encoder
+from result_buffers import get_result_buffers
+from reference_preprocessor import get_reference_preprocessor
+from resilience import get_resilient_caller
+from scheduler import get_scheduler
+from metrics import SIZE_BUCKETS, get_metrics, log_event, record_stage, span
+
+if TYPE_CHECKING:
+    from google.genai import types
+
+# 使用するGeminiモデル（Nano Banana Pro）
+GEMINI_MODEL = "gemini-3-pro-image-preview"
+
+# メトリクス名
+REQUEST_BYTES = "cyclez_request_bytes"
+GENERATIONS_TOTAL = "cyclez_generations_total"
+get_metrics().describe(REQUEST_BYTES, "Size of API request payloads in bytes")
+get_metrics().describe(GENERATIONS_TOTAL, "Number of Gemini generations by result")
+
+
+def build_gemini_contents(
+    prompt: str,
+    reference_images: List[Dict[str, Any]],
+    aspect_ratio: str = "1:1"
+) -> Tuple[List[Any], Dict[str, Any]]:
+    """
+    Gemini API に送るコンテンツ（指示付きプロンプト + 参照画像）を構築
+    同期版・非同期版で共通に使用する
+
+    Returns:
+        (contents, 参照画像の統計 {"count", "original_bytes", "sent_bytes", "saved_bytes", "hashes"})
+    """
+    # コンテンツを構築
+    contents = []
+
+    # 参照画像の説明付きプロンプトを構築
+    image_instructions = []
+
+    # 背景画像とスタッフ画像を分類
+    bg_images = [img for img in reference_images if img["type"] == "background"]
+    staff_images = [img for img in reference_images if img["type"] in ["staff", "trainer"]]
+
+    if bg_images:
+        image_instructions.append(
+            "IMPORTANT: Use the provided background image as the exact setting/environment. "
+            "Maintain the architectural features, lighting, colors, and atmosphere of this space precisely."
+        )
+    else:
+        # 背景画像がない場合はシンプルな背景を指定
+        image_instructions.append(
+            "BACKGROUND: Use a clean, simple, professional background. "
+            "Options: pure white, light gray, soft gradient, or minimal studio setting. "
+            "The background should not distract from the main subject."
+        )
+
+    if staff_images:
+        num_staff_images = len(staff_images)
+        if num_staff_images == 1:
+            image_instructions.append(
+                "CRITICAL: The staff member in the generated image MUST look EXACTLY like the person in the reference photo. "
+                "Maintain their exact facial features, face shape, hairstyle, skin tone, and overall appearance. "
+                "This is essential - the generated staff must be recognizable as the same person."
+            )
+        else:
+            image_instructions.append(
+                f"CRITICAL: You are provided with {num_staff_images} reference photos of the SAME staff member from different angles. "
+                f"Study ALL {num_staff_images} photos carefully to understand their complete appearance: "
+                "facial features from multiple angles, face shape, hairstyle, skin tone, body build, and distinguishing characteristics. "
+                "The staff member in the generated image MUST look EXACTLY like this person. "
+                "Use all reference photos together to create an accurate, recognizable representation. "
+                "This is absolutely essential - the generated staff must be immediately recognizable as the same person shown in all reference photos."
+            )
+
+    # プロンプトに日本人指定を追加
+    full_prompt = prompt
+    if "Japanese" not in prompt:
+        full_prompt = "All people in this image must be Japanese. " + prompt
+
+    # 画像指示を追加
+    if image_instructions:
+        full_prompt = "\n\n".join(image_instructions) + "\n\n" + full_prompt
+
+    # アスペクト比と解像度の指示を追加
+    full_prompt += f"\n\nIMPORTANT: Generate a high-resolution, 4K quality image with {aspect_ratio} aspect ratio. The image should be crisp, detailed, and suitable for professional marketing use."
+
+    # テキストプロンプトを追加
+    contents.append(full_prompt)
+
+    # 参照画像を追加（スタッフを先に、背景を後に）
+    # 向き補正・縮小・再エンコード済みのキャッシュを使用
+    reference_paths = []
+    reference_types = []
+    for img_info in staff_images + bg_images:
+        image_path = img_info["path"]
+        if isinstance(image_path, str):
+            image_path = Path(image_path)
+
+        if image_path.exists():
+            reference_paths.append(image_path)
+            reference_types.append(img_info["type"])
+
+    with span("reference_io", count=len(reference_paths)) as io_span:
+        prepared_images, reference_stats = get_reference_preprocessor().prepare_many(reference_paths)
+        io_span.set(original_bytes=reference_stats["original_bytes"], sent_bytes=reference_stats["sent_bytes"])
+
+    from google.genai import types
+
+    for image_path, image_type, prepared in zip(reference_paths, reference_types, prepared_images):
+        contents.append(types.Part.from_bytes(data=prepared["data"], mime_type=prepared["mime_type"]))
+        log_event(
+            "reference_added",
+            f"   📎 参照画像追加: {image_type} - {image_path.name} "
+            f"({prepared['original_bytes'] // 1024}KB → {prepared['prepared_bytes'] // 1024}KB)",
+            type=image_type, name=image_path.name,
+            original_bytes=prepared["original_bytes"], prepared_bytes=prepared["prepared_bytes"]
+        )
+
+    if reference_stats["count"]:
+        log_event(
+            "reference_saved",
+            f"   📉 参照画像サイズ削減: {reference_stats['saved_bytes'] // 1024}KB",
+            saved_bytes=reference_stats["saved_bytes"]
+        )
+
+    # リクエストの大きさ（プロンプト + 参照画像）
+    payload_bytes = len(full_prompt.encode("utf-8")) + sum(len(prepared["data"]) for prepared in prepared_images)
+    get_metrics().observe(REQUEST_BYTES, payload_bytes, buckets=SIZE_BUCKETS, api="gemini")
+
+    log_event(
+        "gemini_request_prepared",
+        f"📤 Gemini Pro ({GEMINI_MODEL}) にリクエスト送信中... "
+        f"アスペクト比: {aspect_ratio} / 参照画像数: {len(staff_images + bg_images)} / {payload_bytes // 1024}KB",
+        model=GEMINI_MODEL, aspect_ratio=aspect_ratio,
+        reference_count=len(staff_images + bg_images), payload_bytes=payload_bytes
+    )
+
+    return contents, reference_stats
+
+
+def _generate_config() -> "types.GenerateContentConfig":
+    """
+    生成リクエストの設定
+    HTTPのタイムアウトを試行の期限に合わせ、期限切れで結果を捨てた試行の通信も同じ時点で打ち切る
+    （同期版はスレッドを止められないため、これがないと再試行と並んで課金対象のリクエストが残り続ける）
+    """
+    from google.genai import types
+
+    timeout_ms = int(get_resilient_caller("gemini").policy.attempt_timeout * 1000)
+    return types.GenerateContentConfig(
+        response_modalities=["IMAGE", "TEXT"],
+        http_options=types.HttpOptions(timeout=timeout_ms),
+    )
+
+
+def _handle_response(
+    response: Any,
+    output_dir: Optional[Path],
+    reference_stats: Dict[str, Any],
+    prompt: Optional[str] = None,
+    generation_input: Optional[Dict[str, Any]] = None,
+    timings: Optional[Dict[str, float]] = None
+) -> Dict[str, Any]:
+    """レスポンスから画像をストアに保存し、結果の辞書を作成"""
+    log_event("gemini_response", "📥 レスポンス受信")
+
+    # レスポンス処理（画像パートが複数ある場合はすべて保存）
+    store = get_output_store(output_dir)
+    text_response = ""
+    image_paths = []
+    image_ids = []
+    image_buffers = []
+    timings = dict(timings or {})
+
+    for part in response.candidates[0].content.parts:
+        if part.text is not None:
+            text_response += part.text
+            log_event(
+                "gemini_text",
+                f"📝 テキスト応答: {part.text[:100]}..." if len(part.text) > 100 else f"📝 テキスト応答: {part.text}"
+            )
+        elif part.inline_data is not None:
+            # 画像データを保存（ファイルの書き込みとインデックスへの記録は書き込み用スレッドで行い、完了を待たない）
+            data = part.inline_data.data
+            save_started = time.perf_counter()
+            with span("save", bytes=len(data)) as save_span:
+                record = store.save(
+                    data,
+                    mime_type=part.inline_data.mime_type or "image/png",
+                    prompt=prompt,
+                    generation_input=generation_input,
+                    reference_hashes=reference_stats.get("hashes"),
+                    timings=timings,
+                    metadata={"text_response": text_response} if text_response else None,
+                    background=True
+                )
+                save_span.set(image_id=record["id"])
+            timings["save"] = time.perf_counter() - save_started
+            # 表示・ダウンロードはレスポンスの bytes をそのまま使う（ファイルを読み直さない）
+            image_buffers.append(get_result_buffers().put(record["id"], data))
+            # 用途別の派生ファイル（Instagram用JPEGなど）は書き込み後にプロセスプールで作成し、完了を待たない
+            store.when_written(record["id"], lambda record=record: get_output_encoder().submit(record, store))
+
+            image_paths.append(record["absolute_path"])
+            image_ids.append(record["id"])
+            log_event("image_saved", f"💾 画像保存: {record['absolute_path']}", image_id=record["id"], path=record["path"])
+
+    get_metrics().inc(GENERATIONS_TOTAL, status="success" if image_paths else "no_image")
+    if image_paths:
+        return {
+            "success": True,
+            "image_path": image_paths[0],
+            "image_paths": image_paths,
+            "image_id": image_ids[0],
+            "image_ids": image_ids,
+            "image_buffer": image_buffers[0],
+            "image_buffers": image_buffers,
+            "text_response": text_response,
+            "timings": timings,
+            "reference_stats": reference_stats
+        }
+    else:
+        return {
+            "success": False,
+            "error": "画像が生成されませんでした",
+            "text_response": text_response,
+            "reference_stats": reference_stats
+        }
+
+
+def _error_result(e: Exception) -> Dict[str, Any]:
+    import traceback
+    get_metrics().inc(GENERATIONS_TOTAL, status="error")
+    log_event("generation_error", f"❌ エラー発生: {str(e)}", level="error",
+              error=str(e), error_type=type(e).__name__, traceback=traceback.format_exc())
+    return {
+        "success": False,
+        "error": str(e)
+    }
 
 
 def generate_image_with_gemini(
@@ -17,7 +257,8 @@ def generate_image_with_gemini(
     reference_images: List[Dict[str, Any]],
     aspect_ratio: str = "1:1",
     resolution: str = "2K",
-    output_dir: Optional[Path] = None
+    output_dir: Optional[Path] = None,
+    generation_input: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     """
     Google Genai API (Gemini 2.0 Flash) を使用して画像を生成
@@ -29,13 +270,21 @@ def generate_image_with_gemini(
             各要素は {"path": Path, "type": "background"|"trainer", "description": str}
         aspect_ratio: アスペクト比 (例: "1:1", "16:9")
         resolution: 解像度 ("1K", "2K", "4K")
-        output_dir: 出力ディレクトリ（Noneの場合はデフォルト）
+        output_dir: 出力先ストアのディレクトリ（Noneの場合はデフォルト）
+        generation_input: 画像生成の入力情報（インデックスへの記録用、オプション）
 
     Returns:
         Dict: {
             "success": bool,
-            "image_path": Path (成功時),
+            "image_path": Path (成功時、最初の画像),
+            "image_paths": List[str] (成功時、レスポンスに含まれるすべての画像),
+            "image_id": str / "image_ids": List[str] (成功時、ストアでのID),
+            "image_buffer": memoryview / "image_buffers": List[memoryview]
+                (成功時、レスポンスの画像データ。ファイルの書き込みはバックグラウンドで行う),
+            "timings": Dict (処理時間),
             "text_response": str,
+            "reference_stats": Dict (参照画像の元サイズ・送信サイズ・削減量),
+            "request_info": Dict (試行回数・ヘッジの有無など),
             "error": str (失敗時)
         }
     """
@@ -45,152 +294,110 @@ def generate_image_with_gemini(
     if not api_key:
         return {"success": False, "error": "GEMINI_API_KEY が設定されていません"}
 
-    # 出力ディレクトリ設定
-    if output_dir is None:
-        output_dir = Path(__file__).parent / "outputs"
-    output_dir.mkdir(exist_ok=True)
-
     try:
-        # クライアント初期化
-        client = genai.Client(api_key=api_key)
+        # 共有クライアントを取得（接続を維持して使い回す）
+        client = get_gemini_client()
+
+        started = time.perf_counter()
+        contents, reference_stats = build_gemini_contents(prompt, reference_images, aspect_ratio)
+        timings = {"reference_io": time.perf_counter() - started}
+
+        # Nano Banana Pro で画像生成（試行ごとの期限・再試行・サーキットブレーカー付き）
+        # 全セッション共通のレート制限・待ち行列で順番を待ってから送信（再試行は同じ実行枠の中で行う）
+        config = _generate_config()
+        queued = time.perf_counter()
+        with get_scheduler().slot("gemini", GEMINI_MODEL):
+            started = time.perf_counter()
+            timings["queue_wait"] = started - queued
+            record_stage("queue_wait", timings["queue_wait"], api="gemini")
+            with span("gemini_request", model=GEMINI_MODEL) as request_span:
+                response, request_info = get_resilient_caller("gemini").call(
+                    lambda: client.models.generate_content(model=GEMINI_MODEL, contents=contents, config=config),
+                    model=GEMINI_MODEL
+                )
+                request_span.set(**request_info)
+            timings["gemini_request"] = time.perf_counter() - started
 
-        # コンテンツを構築
-        contents = []
+        result = _handle_response(response, output_dir, reference_stats, prompt, generation_input, timings)
+        result["request_info"] = request_info
+        return result
 
-        # 参照画像の説明付きプロンプトを構築
-        image_instructions = []
+    except Exception as e:
+        return _error_result(e)
 
-        # 背景画像とスタッフ画像を分類
-        bg_images = [img for img in reference_images if img["type"] == "background"]
-        staff_images = [img for img in reference_images if img["type"] in ["staff", "trainer"]]
 
-        if bg_images:
-            image_instructions.append(
-                "IMPORTANT: Use the provided background image as the exact setting/environment. "
-                "Maintain the architectural features, lighting, colors, and atmosphere of this space precisely."
-            )
-        else:
-            # 背景画像がない場合はシンプルな背景を指定
-            image_instructions.append(
-                "BACKGROUND: Use a clean, simple, professional background. "
-                "Options: pure white, light gray, soft gradient, or minimal studio setting. "
-                "The background should not distract from the main subject."
-            )
+async def generate_image_with_gemini_async(
+    prompt: str,
+    reference_images: List[Dict[str, Any]],
+    aspect_ratio: str = "1:1",
+    resolution: str = "2K",
+    output_dir: Optional[Path] = None,
+    generation_input: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    generate_image_with_gemini の非同期版（client.aio を使用）
+    参照画像の前処理と画像保存はスレッドで実行し、イベントループを止めない
+    """
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return {"success": False, "error": "GEMINI_API_KEY が設定されていません"}
 
-        if staff_images:
-            num_staff_images = len(staff_images)
-            if num_staff_images == 1:
-                image_instructions.append(
-                    "CRITICAL: The staff member in the generated image MUST look EXACTLY like the person in the reference photo. "
-                    "Maintain their exact facial features, face shape, hairstyle, skin tone, and overall appearance. "
-                    "This is essential - the generated staff must be recognizable as the same person."
-                )
-            else:
-                image_instructions.append(
-                    f"CRITICAL: You are provided with {num_staff_images} reference photos of the SAME staff member from different angles. "
-                    f"Study ALL {num_staff_images} photos carefully to understand their complete appearance: "
-                    "facial features from multiple angles, face shape, hairstyle, skin tone, body build, and distinguishing characteristics. "
-                    "The staff member in the generated image MUST look EXACTLY like this person. "
-                    "Use all reference photos together to create an accurate, recognizable representation. "
-                    "This is absolutely essential - the generated staff must be immediately recognizable as the same person shown in all reference photos."
-                )
+    try:
+        started = time.perf_counter()
+        contents, reference_stats = await asyncio.to_thread(
+            build_gemini_contents, prompt, reference_images, aspect_ratio
+        )
+        timings = {"reference_io": time.perf_counter() - started}
+    except Exception as e:
+        return _error_result(e)
+
+    return await generate_from_contents_async(
+        contents, reference_stats, output_dir, prompt, generation_input, timings
+    )
+
+
+async def generate_from_contents_async(
+    contents: List[Any],
+    reference_stats: Dict[str, Any],
+    output_dir: Optional[Path] = None,
+    prompt: Optional[str] = None,
+    generation_input: Optional[Dict[str, Any]] = None,
+    timings: Optional[Dict[str, float]] = None
+) -> Dict[str, Any]:
+    """
+    構築済みのコンテンツで画像を生成（非同期）
+    同じ参照画像・プロンプトで複数候補を生成する場合に、コンテンツの構築を1回で済ませるために使用
+    prompt・generation_input はインデックスへの記録用
+    """
+    if not os.getenv("GEMINI_API_KEY"):
+        return {"success": False, "error": "GEMINI_API_KEY が設定されていません"}
 
-        # プロンプトに日本人指定を追加
-        full_prompt = prompt
-        if "Japanese" not in prompt:
-            full_prompt = "All people in this image must be Japanese. " + prompt
-
-        # 画像指示を追加
-        if image_instructions:
-            full_prompt = "\n\n".join(image_instructions) + "\n\n" + full_prompt
-
-        # アスペクト比と解像度の指示を追加
-        full_prompt += f"\n\nIMPORTANT: Generate a high-resolution, 4K quality image with {aspect_ratio} aspect ratio. The image should be crisp, detailed, and suitable for professional marketing use."
-
-        # テキストプロンプトを追加
-        contents.append(full_prompt)
-
-        # 参照画像を追加（スタッフを先に、背景を後に）
-        for img_info in staff_images + bg_images:
-            image_path = img_info["path"]
-            if isinstance(image_path, str):
-                image_path = Path(image_path)
-
-            if image_path.exists():
-                with open(image_path, "rb") as f:
-                    image_bytes = f.read()
-
-                suffix = image_path.suffix.lower()
-                mime_types = {
-                    '.jpg': 'image/jpeg',
-                    '.jpeg': 'image/jpeg',
-                    '.png': 'image/png',
-                    '.webp': 'image/webp',
-                    '.gif': 'image/gif'
-                }
-                mime_type = mime_types.get(suffix, 'image/jpeg')
-
-                contents.append(types.Part.from_bytes(data=image_bytes, mime_type=mime_type))
-                print(f"   📎 参照画像追加: {img_info['type']} - {image_path.name}")
-
-        print(f"📤 Gemini Pro (gemini-3-pro-image-preview) にリクエスト送信中...")
-        print(f"   アスペクト比: {aspect_ratio}")
-        print(f"   参照画像数: {len(staff_images + bg_images)}")
-
-        # Nano Banana Pro で画像生成
-        response = client.models.generate_content(
-            model="gemini-3-pro-image-preview",
-            contents=contents,
-            config=types.GenerateContentConfig(
-                response_modalities=["IMAGE", "TEXT"],
+    try:
+        client = get_async_gemini_client()
+
+        config = _generate_config()
+        queued = time.perf_counter()
+        async with get_scheduler().slot_async("gemini", GEMINI_MODEL):
+            started = time.perf_counter()
+            record_stage("queue_wait", started - queued, api="gemini")
+            with span("gemini_request", model=GEMINI_MODEL) as request_span:
+                response, request_info = await get_resilient_caller("gemini").call_async(
+                    lambda: client.aio.models.generate_content(model=GEMINI_MODEL, contents=contents, config=config),
+                    model=GEMINI_MODEL
+                )
+                request_span.set(**request_info)
+            timings = dict(
+                timings or {}, queue_wait=started - queued, gemini_request=time.perf_counter() - started
             )
-        )
 
-        print(f"📥 レスポンス受信")
-
-        # レスポンス処理
-        text_response = ""
-        image_saved = False
-        image_path = None
-
-        for part in response.candidates[0].content.parts:
-            if part.text is not None:
-                text_response += part.text
-                print(f"📝 テキスト応答: {part.text[:100]}..." if len(part.text) > 100 else f"📝 テキスト応答: {part.text}")
-            elif part.inline_data is not None:
-                # 画像データを保存
-                image_data = part.inline_data.data
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                image_path = output_dir / f"firefitness_{timestamp}.png"
-
-                # バイトデータとして保存
-                with open(image_path, "wb") as f:
-                    f.write(image_data)
-
-                image_saved = True
-                print(f"💾 画像保存: {image_path}")
-
-        if image_saved:
-            return {
-                "success": True,
-                "image_path": str(image_path),
-                "text_response": text_response
-            }
-        else:
-            return {
-                "success": False,
-                "error": "画像が生成されませんでした",
-                "text_response": text_response
-            }
+        result = await asyncio.to_thread(
+            _handle_response, response, output_dir, reference_stats, prompt, generation_input, timings
+        )
+        result["request_info"] = request_info
+        return result
 
     except Exception as e:
-        print(f"❌ エラー発生: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return {
-            "success": False,
-            "error": str(e)
-        }
+        return _error_result(e)
 
 
 def generate_image_simple(
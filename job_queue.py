@@ -0,0 +1,285 @@
+"""
+永続的なバックグラウンドジョブキュー
+生成リクエストをSQLiteに記録し、ワーカースレッドが順番に実行する
+Streamlitの再実行・ページの再読み込みでは処理が中断されず、UIはジョブIDで状態と結果を取得する
+プロセスが異常終了した場合、実行中だったジョブは一定時間後に再実行（上限回数まで）される
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import contextvars
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from app_config import OUTPUTS_DIR
+from metrics import log_event
+
+DEFAULT_PATH = OUTPUTS_DIR / "jobs.sqlite3"
+DEFAULT_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# ハートビートがこの秒数途絶えた実行中ジョブは中断されたとみなす
+HEARTBEAT_SECONDS = 10.0
+STALE_SECONDS = 60.0
+MAX_ATTEMPTS = 2
+
+_JSON_COLUMNS = ("payload", "result")
+
+
+class JobQueue:
+    """
+    SQLiteのジョブテーブル
+    状態: queued（待機中）→ running（実行中）→ done（完了）/ failed（失敗）
+    """
+
+    def __init__(self, path: Path = DEFAULT_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    session_id TEXT,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    heartbeat_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, priority, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _to_job(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        for column in _JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] else None
+        return job
+
+    def submit(self, kind: str, payload: Dict[str, Any], session_id: Optional[str] = None, priority: int = 0) -> str:
+        """ジョブを登録してIDを返す"""
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, session_id, priority, status, payload, created_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, session_id, priority, json.dumps(payload, ensure_ascii=False, default=str), time.time())
+            )
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """待機中のジョブを1件取り出して実行中にする（複数ワーカーから同時に呼んでも重複しない）"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ?,
+                                attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM jobs WHERE status = 'queued' ORDER BY priority, created_at LIMIT 1
+                )
+                RETURNING *
+                """,
+                (worker, now, now)
+            ).fetchone()
+        return self._to_job(row)
+
+    def heartbeat(self, job_ids: List[str]) -> None:
+        """実行中ジョブの生存を記録"""
+        if not job_ids:
+            return
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND id IN ({', '.join('?' * len(job_ids))})",
+                [time.time()] + list(job_ids)
+            )
+
+    def finish(self, job_id: str, result: Dict[str, Any], error: Optional[str] = None) -> None:
+        """ジョブを完了（error があれば失敗）にする"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                ("failed" if error else "done", json.dumps(result, ensure_ascii=False, default=str),
+                 error, time.time(), job_id)
+            )
+
+    def recover_stale(self, stale_seconds: float = STALE_SECONDS, max_attempts: int = MAX_ATTEMPTS) -> int:
+        """
+        ハートビートが途絶えた実行中ジョブを待機中に戻す（試行回数が上限なら失敗にする）
+
+        Returns:
+            処理したジョブ数
+        """
+        threshold = time.time() - stale_seconds
+        with self._connect() as conn:
+            requeued = conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL "
+                "WHERE status = 'running' AND heartbeat_at < ? AND attempts < ?",
+                (threshold, max_attempts)
+            ).rowcount
+            failed = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                ("処理が中断されました（再実行の上限に達しました）", time.time(), threshold)
+            ).rowcount
+        return requeued + failed
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """IDでジョブを取得"""
+        with self._connect() as conn:
+            return self._to_job(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def position(self, job_id: str) -> Optional[int]:
+        """待機中ジョブの順番（1始まり。待機中でなければ None）"""
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                SELECT COUNT(*) FROM jobs AS ahead, jobs AS target
+                WHERE target.id = ? AND target.status = 'queued' AND ahead.status = 'queued'
+                  AND (ahead.priority, ahead.created_at) <= (target.priority, target.created_at)
+                """,
+                (job_id,)
+            ).fetchone()
+        return row[0] or None
+
+    def list(self, session_id: Optional[str] = None, status: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """ジョブ一覧（新しい順）"""
+        clauses, params = [], []
+        if session_id is not None:
+            clauses.append("session_id = ?")
+            params.append(session_id)
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM jobs {where} ORDER BY created_at DESC LIMIT ?", params + [limit]
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """状態ごとの件数"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class JobWorkerPool:
+    """
+    ジョブキューを処理するワーカースレッド群
+    handlers: {ジョブ種別: 関数(payload, job) -> 結果の辞書}
+    結果に "success": False が含まれる場合はジョブを失敗として記録する
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: Dict[str, Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]],
+        workers: int = DEFAULT_WORKERS,
+        poll_interval: float = 1.0
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._active: Dict[str, str] = {}
+        self._threads: List[threading.Thread] = []
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        """ワーカーとハートビートのスレッドを開始（前回のプロセスで中断されたジョブも回収）"""
+        if self._threads:
+            return
+        self.queue.recover_stale()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def wake(self) -> None:
+        """新しいジョブを登録したことをワーカーに知らせる（次のポーリングを待たずに開始）"""
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            job = self.queue.claim(f"{self.worker_id}/{threading.current_thread().name}")
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+
+            with self._lock:
+                self._active[job["id"]] = job["kind"]
+            try:
+                handler = self.handlers[job["kind"]]
+                # ジョブごとに新しいコンテキストで実行（ハンドラー内で設定した contextvars を持ち越さない）
+                result = contextvars.Context().run(handler, job["payload"], job)
+                error = None if result.get("success", True) else result.get("error", "不明なエラー")
+            except Exception as e:
+                log_event("job_error", f"❌ ジョブ実行エラー [{job['id']}]: {e}", level="error",
+                          job_id=job["id"], kind=job["kind"], error=str(e))
+                result, error = {"success": False, "error": str(e)}, str(e)
+            finally:
+                with self._lock:
+                    self._active.pop(job["id"], None)
+
+            self.queue.finish(job["id"], result, error)
+            if error:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            try:
+                with self._lock:
+                    active = list(self._active)
+                self.queue.heartbeat(active)
+                self.queue.recover_stale()
+            except Exception as e:
+                log_event("job_heartbeat_error", f"⚠️ ジョブのハートビート更新エラー: {e}", level="warning", error=str(e))
+
+    def stats(self) -> Dict[str, Any]:
+        """実行中・完了・失敗の件数と、キュー全体の状態ごとの件数"""
+        with self._lock:
+            active = len(self._active)
+        return {
+            "workers": self.workers,
+            "active": active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "queue": self.queue.counts(),
+        }
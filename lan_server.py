@@ -0,0 +1,288 @@
+"""
+店内LAN向けの画像配信サーバー
+outputs/ のストアの画像を、有効期限付きの署名URLでだけ配信する小さなHTTPサーバー
+iPhone でQRコードを読み取ると、外部サービスを経由せずにこのPCから直接ダウンロードできる
+
+- 本体は sendfile（socket.sendfile）で送り、Python のメモリに読み込まない
+- Range リクエスト（途中からの再開・動画プレイヤー等）と ETag / If-None-Match に対応
+- URL は /files/<ストア内の相対パス>?exp=<有効期限>&sig=<HMAC> の形式で、期限切れ・改ざんは拒否する
+"""
+
+import os
+import hmac
+import time
+import socket
+import hashlib
+import secrets
+import threading
+from pathlib import Path
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import log_event
+from output_store import MIME_EXTENSIONS
+
+DEFAULT_PORT = int(os.getenv("LAN_SERVER_PORT", "8765"))
+# QRコードに載せるホスト名・IPアドレス（未設定の場合はLAN側のIPアドレスを自動で調べる）
+ADVERTISED_HOST = os.getenv("LAN_SERVER_HOST", "")
+# 署名URLの有効期間（秒）
+DEFAULT_URL_TTL = int(os.getenv("LAN_URL_TTL", "600"))
+# 署名の鍵（未設定の場合は起動ごとに作成するため、再起動すると発行済みのURLは使えなくなる）
+SECRET = os.getenv("LAN_SERVER_SECRET", "")
+# sendfile で一度に送る最大バイト数
+CHUNK_BYTES = 1024 * 1024
+
+EXTENSION_MIME_TYPES = {extension: mime_type for mime_type, extension in MIME_EXTENSIONS.items()}
+
+
+def lan_address() -> str:
+    """このPCのLAN側のIPアドレス（UDPソケットの送信元を調べるだけで、実際には送信しない）"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        try:
+            probe.connect(("10.255.255.255", 1))
+            return probe.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Range ヘッダー（単一範囲のみ）を (開始, 終了) に変換（終了は含む）
+    範囲外の場合は None、ヘッダーの形式が不正・複数範囲の場合は (0, size - 1)（全体を返す）
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return 0, size - 1
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            # 末尾から N バイト
+            length = int(last)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return 0, size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class LanFileServer:
+    """署名URLで outputs/ の画像を配信するサーバー（start() で別スレッドで待ち受ける）"""
+
+    def __init__(
+        self,
+        root: Path,
+        port: int = DEFAULT_PORT,
+        host: str = "0.0.0.0",
+        advertised_host: str = ADVERTISED_HOST,
+        url_ttl: int = DEFAULT_URL_TTL,
+        secret: str = SECRET
+    ):
+        self.root = Path(root).resolve()
+        self.port = port
+        self.host = host
+        self.advertised_host = advertised_host
+        self.url_ttl = url_ttl
+        self._key = (secret or secrets.token_hex(32)).encode("utf-8")
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+        # (相対パス) -> (有効期限, URL, QRコードのPNG)
+        self._qr_cache: Dict[str, Tuple[float, str, bytes]] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.sent_bytes = 0
+        self.not_modified = 0
+        self.rejected = 0
+
+    # --- 署名URL ---
+
+    def _signature(self, relative_path: str, expires: int) -> str:
+        message = f"{relative_path}\n{expires}".encode("utf-8")
+        return hmac.new(self._key, message, hashlib.sha256).hexdigest()[:32]
+
+    def verify(self, relative_path: str, expires: str, signature: str) -> bool:
+        """署名と有効期限を確認"""
+        try:
+            expires_at = int(expires)
+        except ValueError:
+            return False
+        if expires_at < time.time():
+            return False
+        return hmac.compare_digest(self._signature(relative_path, expires_at), signature)
+
+    @property
+    def base_url(self) -> str:
+        port = self._server.server_address[1] if self._server is not None else self.port
+        return f"http://{self.advertised_host or lan_address()}:{port}"
+
+    def signed_url(self, relative_path: str, ttl: Optional[int] = None) -> Tuple[str, int]:
+        """
+        ストア内の相対パスの署名URL
+
+        Returns:
+            (URL, 有効期限のUNIX時刻)
+        """
+        expires = int(time.time()) + (ttl or self.url_ttl)
+        query = f"exp={expires}&sig={self._signature(relative_path, expires)}"
+        return f"{self.base_url}/files/{quote(relative_path)}?{query}", expires
+
+    def share(self, relative_path: str) -> Dict[str, Any]:
+        """
+        ダウンロード用の署名URLとQRコード（同じファイルは有効期間の半分が過ぎるまで同じものを使い回す）
+
+        Returns:
+            {"url", "expires_at", "qr_png"}
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._qr_cache.get(relative_path)
+        if cached is not None and cached[0] - now > self.url_ttl / 2:
+            expires_at, url, qr_png = cached
+            return {"url": url, "expires_at": expires_at, "qr_png": qr_png}
+
+        url, expires_at = self.signed_url(relative_path)
+        qr_png = qr_code_png(url)
+        with self._lock:
+            # 期限切れのものは捨てる
+            self._qr_cache = {path: entry for path, entry in self._qr_cache.items() if entry[0] > now}
+            self._qr_cache[relative_path] = (expires_at, url, qr_png)
+        return {"url": url, "expires_at": expires_at, "qr_png": qr_png}
+
+    # --- 配信 ---
+
+    def resolve(self, request_path: str) -> Optional[Path]:
+        """URLのパスをストア内のファイルに変換（ストアの外・存在しないファイルは None）"""
+        if not request_path.startswith("/files/"):
+            return None
+        relative_path = unquote(request_path[len("/files/"):])
+        path = (self.root / relative_path).resolve()
+        if self.root not in path.parents or not path.is_file():
+            return None
+        return path
+
+    def start(self) -> "LanFileServer":
+        # http.server はサーバーを使う場合だけ読み込む（起動時間を増やさない）
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self._serve(send_body=False)
+
+            def do_GET(self):
+                self._serve(send_body=True)
+
+            def _serve(self, send_body: bool) -> None:
+                url = urlsplit(self.path)
+                params = parse_qs(url.query)
+                relative_path = unquote(url.path[len("/files/"):]) if url.path.startswith("/files/") else ""
+                if not server.verify(relative_path, params.get("exp", [""])[0], params.get("sig", [""])[0]):
+                    server._count(rejected=1)
+                    self.send_error(403, explain="URLの有効期限が切れているか、署名が正しくありません")
+                    return
+                path = server.resolve(url.path)
+                if path is None:
+                    self.send_error(404)
+                    return
+
+                stat = path.stat()
+                size = stat.st_size
+                etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+                if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                    server._count(not_modified=1)
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                start, end = 0, size - 1
+                status = 200
+                range_header = self.headers.get("Range")
+                if range_header and size:
+                    # If-Range が一致しない（ファイルが変わった）場合は全体を返す
+                    if_range = self.headers.get("If-Range")
+                    if not if_range or if_range == etag:
+                        byte_range = parse_range(range_header, size)
+                        if byte_range is None:
+                            self.send_response(416)
+                            self.send_header("Content-Range", f"bytes */{size}")
+                            self.send_header("Content-Length", "0")
+                            self.end_headers()
+                            return
+                        start, end = byte_range
+                        status = 206 if (start, end) != (0, size - 1) else 200
+                length = end - start + 1 if size else 0
+
+                self.send_response(status)
+                self.send_header("Content-Type", EXTENSION_MIME_TYPES.get(path.suffix, "application/octet-stream"))
+                self.send_header("Content-Length", str(length))
+                self.send_header("Content-Disposition", f'attachment; filename="cyclez_{path.name}"')
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "private, max-age=300")
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.end_headers()
+
+                if send_body and length:
+                    with open(path, "rb") as f:
+                        # カーネルの sendfile でファイルから直接ソケットへ送る（対応していない環境では通常の送信）
+                        sent = 0
+                        while sent < length:
+                            count = self.connection.sendfile(f, start + sent, min(CHUNK_BYTES, length - sent))
+                            if not count:
+                                break
+                            sent += count
+                    server._count(sent_bytes=sent)
+                server._count(requests=1)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="lan-server", daemon=True)
+        self._thread.start()
+        log_event("lan_server", f"📶 画像配信サーバーを起動: {self.base_url}", port=self._server.server_address[1])
+        return self
+
+    def _count(self, **values: int) -> None:
+        with self._lock:
+            for key, value in values.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "sent_bytes": self.sent_bytes,
+                "not_modified": self.not_modified,
+                "rejected": self.rejected,
+                "qr_cached": len(self._qr_cache),
+            }
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def qr_code_png(url: str) -> bytes:
+    """URLのQRコード（PNG）"""
+    # qrcode はここで初めて読み込む
+    import io
+    import qrcode
+
+    qr = qrcode.QRCode(version=None, box_size=10, border=2)
+    qr.add_data(url)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    # 白黒を反転したQRコードは読み取れないカメラがあるため、白地に黒で作る
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
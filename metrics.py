@@ -0,0 +1,378 @@
+"""
+処理段階ごとの計測・構造化ログ・メトリクス
+- span(): 処理段階を囲むコンテキストマネージャー。所要時間をヒストグラムに記録し、JSONのログ行を出力する
+- log_event(): 構造化ログ（LOG_FORMAT=json で1行1JSON、text で従来どおりのメッセージ）
+- MetricsRegistry: プロセス内のカウンター・ヒストグラム。Prometheusのテキスト形式で出力できる
+  METRICS_FILE を指定するとファイルに定期的に書き出し（node_exporter の textfile collector 用）、
+  METRICS_PORT を指定すると http://<host>:<port>/metrics で公開する
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from scheduler import current_context
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_FILE_INTERVAL = float(os.getenv("METRICS_FILE_INTERVAL", "15"))
+
+# 所要時間（秒）とサイズ（バイト）のバケット
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))  # 1KB 〜 64MB
+
+# 処理段階の所要時間（stage ラベルで区別）
+STAGE_SECONDS = "cyclez_stage_duration_seconds"
+STAGE_TOTAL = "cyclez_stage_total"
+
+# p50/p95 の表示用に保持する直近の観測値の数
+RECENT_SAMPLES = 1024
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> _LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: _LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = []
+    for name, value in items:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Histogram:
+    """ラベルの組み合わせ1つ分のヒストグラム（累積バケット・合計・件数と直近の観測値）"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: deque = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class MetricsRegistry:
+    """
+    プロセス内のメトリクス
+    カウンター: inc()、ヒストグラム: observe()（名前とラベルの組み合わせごとに集計）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, str] = {}
+        self._counters: Dict[str, Dict[_LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[_LabelKey, _Histogram]] = {}
+        self._buckets: Dict[str, Sequence[float]] = {}
+
+    def describe(self, name: str, help_text: str) -> None:
+        """Prometheus出力の HELP 行"""
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        """カウンターを加算"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, buckets: Optional[Sequence[float]] = None, **labels: Any) -> None:
+        """ヒストグラムに観測値を追加（バケットは名前ごとに最初の指定を使う）"""
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                bucket_bounds = self._buckets.setdefault(name, buckets or DURATION_BUCKETS)
+                histogram = series[key] = _Histogram(bucket_bounds)
+            histogram.observe(value)
+
+    def quantiles(self, name: str, qs: Sequence[float] = (0.5, 0.95)) -> List[Dict[str, Any]]:
+        """
+        ヒストグラムの直近の観測値から分位数を計算（画面表示用）
+
+        Returns:
+            [{"labels": {...}, "count", "p50", "p95", ...}, ...]
+        """
+        with self._lock:
+            series = list(self._histograms.get(name, {}).items())
+            rows = []
+            for key, histogram in series:
+                row = {"labels": dict(key), "count": histogram.count}
+                for q in qs:
+                    row[f"p{int(q * 100)}"] = histogram.quantile(q)
+                rows.append(row)
+        return rows
+
+    def snapshot(self) -> Dict[str, Any]:
+        """全メトリクスの現在値（カウンターの値とヒストグラムの件数・合計）"""
+        with self._lock:
+            return {
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                "histograms": {
+                    name: [
+                        {"labels": dict(key), "count": h.count, "sum": h.sum}
+                        for key, h in series.items()
+                    ]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def render_prometheus(self) -> str:
+        """Prometheus のテキスト形式（exposition format 0.0.4）"""
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket{_format_labels(key, ('le', _format_value(bound)))} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(histogram.sum)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: Path) -> None:
+        """Prometheus形式でファイルに書き出す（一時ファイル経由で置き換え）"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(self.render_prometheus(), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+
+_registry = MetricsRegistry()
+_registry.describe(STAGE_SECONDS, "Duration of each pipeline stage in seconds")
+_registry.describe(STAGE_TOTAL, "Number of pipeline stage executions by status")
+
+
+def get_metrics() -> MetricsRegistry:
+    """プロセス共通のメトリクス"""
+    return _registry
+
+
+_log_lock = threading.Lock()
+
+
+def log_event(event: str, message: Optional[str] = None, level: str = "info", **fields: Any) -> None:
+    """
+    1行のログを出力
+    LOG_FORMAT=json の場合は {"ts", "level", "event", "message", ...fields} のJSON、
+    text の場合は message（なければイベント名と項目）をそのまま出力する
+    """
+    if LOG_FORMAT == "text":
+        line = message if message is not None else f"{event} {fields}"
+    else:
+        record = {"ts": round(time.time(), 3), "level": level, "event": event}
+        if message is not None:
+            record["message"] = message
+        session_id = current_context().session_id
+        if session_id != "default":
+            record["session_id"] = session_id
+        span = _current_span.get()
+        if span is not None:
+            record.setdefault("trace_id", span.trace_id)
+            record.setdefault("span_id", span.span_id)
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+    stream = sys.stderr if level == "error" else sys.stdout
+    with _log_lock:
+        print(line, file=stream, flush=True)
+
+
+class Span:
+    """計測中の処理段階（with span(...) as s: で s.set(key=value) により項目を追加できる）"""
+
+    def __init__(self, stage: str, trace_id: str, parent_id: Optional[str], fields: Dict[str, Any]):
+        self.stage = stage
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.fields = fields
+        self.started = time.perf_counter()
+
+    def set(self, **fields: Any) -> None:
+        self.fields.update(fields)
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("metrics_span", default=None)
+
+
+def _span_fields(fields: Dict[str, Any], **reserved: Any) -> Dict[str, Any]:
+    """
+    呼び出し側の項目と計測の項目をまとめる（同じ名前は計測の項目を優先）
+    log_event の引数名（event・message・level）と重なる項目は除く
+    """
+    merged = {key: value for key, value in fields.items() if key not in ("event", "message", "level")}
+    merged.update(reserved)
+    return merged
+
+
+@contextmanager
+def span(stage: str, **fields: Any) -> Iterator[Span]:
+    """
+    処理段階の計測
+    所要時間を cyclez_stage_duration_seconds{stage=...} に記録し、終了時に "span" イベントを出力する
+    入れ子にした場合は同じ trace_id で親子関係（parent_id）を記録する
+    """
+    parent = _current_span.get()
+    current = Span(stage, parent.trace_id if parent else uuid.uuid4().hex, parent.span_id if parent else None, fields)
+    token = _current_span.set(current)
+    status = "ok"
+    try:
+        yield current
+    except BaseException as e:
+        status = "error"
+        current.fields.setdefault("error", str(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        seconds = time.perf_counter() - current.started
+        _registry.observe(STAGE_SECONDS, seconds, stage=stage)
+        _registry.inc(STAGE_TOTAL, stage=stage, status=status)
+        log_event(
+            "span", f"⏱ {stage}: {seconds:.2f}s", level="error" if status == "error" else "info",
+            **_span_fields(
+                current.fields, stage=stage, duration_ms=round(seconds * 1000, 2), status=status,
+                trace_id=current.trace_id, span_id=current.span_id, parent_id=current.parent_id
+            )
+        )
+
+
+def record_stage(stage: str, seconds: float, status: str = "ok", **fields: Any) -> None:
+    """
+    計測済みの所要時間を記録（ストリーミングなど、with で囲めない処理用）
+    span() と同じメトリクス・ログを出力する
+    """
+    _registry.observe(STAGE_SECONDS, seconds, stage=stage)
+    _registry.inc(STAGE_TOTAL, stage=stage, status=status)
+    log_event(
+        "span", f"⏱ {stage}: {seconds:.2f}s",
+        **_span_fields(fields, stage=stage, duration_ms=round(seconds * 1000, 2), status=status)
+    )
+
+
+def stage_summary() -> List[Dict[str, Any]]:
+    """処理段階ごとの件数・p50・p95（秒、画面表示用）"""
+    rows = []
+    for row in get_metrics().quantiles(STAGE_SECONDS):
+        rows.append({"stage": row["labels"].get("stage"), "count": row["count"], "p50": row["p50"], "p95": row["p95"]})
+    return sorted(rows, key=lambda row: row["stage"] or "")
+
+
+class MetricsExporter:
+    """
+    メトリクスの公開
+    file: 一定間隔でPrometheus形式のファイルを書き出す
+    port: /metrics をHTTPで返すサーバーを起動する
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry or get_metrics()
+        self._server = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start_file(self, path: Path, interval: float = METRICS_FILE_INTERVAL) -> None:
+        def write_loop():
+            while True:
+                try:
+                    self.registry.write_textfile(path)
+                except Exception as e:
+                    log_event("metrics_export_error", f"⚠️ メトリクスの書き出しエラー: {e}", level="warning")
+                if self._stop.wait(interval):
+                    return
+
+        thread = threading.Thread(target=write_loop, name="metrics-file", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start_http(self, port: int, host: str = "0.0.0.0") -> None:
+        # http.server は公開を有効にした場合だけ読み込む（起動時間を増やさない）
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start_from_env(self) -> "MetricsExporter":
+        """METRICS_FILE・METRICS_PORT の設定に従って公開を開始"""
+        if METRICS_FILE:
+            self.start_file(Path(METRICS_FILE))
+            log_event("metrics_export", f"📊 メトリクスを書き出し: {METRICS_FILE}", path=METRICS_FILE)
+        if METRICS_PORT:
+            self.start_http(int(METRICS_PORT))
+            log_event("metrics_export", f"📊 メトリクスを公開: http://0.0.0.0:{METRICS_PORT}/metrics", port=int(METRICS_PORT))
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
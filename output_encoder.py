@@ -0,0 +1,322 @@
+"""
+生成画像の書き出し（用途別の派生ファイル）
+保存した元画像から、Instagram用JPEG・Web用WebP（容量の上限内）・印刷用PNG などをプロセスプールで作成する
+元画像はそのまま残し、派生ファイルは同じディレクトリに <画像ID>.<プリセット名>.<拡張子> で保存する
+作成結果（パス・サイズ・圧縮率）は出力ストアの metadata["derivatives"] に記録する
+"""
+
+import os
+import io
+import sys
+import time
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import Future, ProcessPoolExecutor, BrokenExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+from output_store import MIME_EXTENSIONS, OutputStore
+from metrics import SIZE_BUCKETS, get_metrics, log_event, record_stage
+
+# 書き出しの設定
+#   format: Pillow の保存形式 / max_edge: 長辺の上限（None は縮小しない）
+#   max_bytes: ファイルサイズの上限（品質→解像度の順に下げて収める。None は上限なし）
+#   quality / min_quality: 非可逆形式の品質の初期値と下限 / dpi: 印刷用の解像度情報
+OUTPUT_PRESETS = {
+    "instagram": {
+        "label": "Instagram (JPEG)",
+        "format": "JPEG",
+        "max_edge": 1440,
+        "max_bytes": 1024 * 1024,
+        "quality": 90,
+        "min_quality": 60,
+    },
+    "web": {
+        "label": "Web (WebP)",
+        "format": "WEBP",
+        "max_edge": 2048,
+        "max_bytes": 400 * 1024,
+        "quality": 85,
+        "min_quality": 50,
+    },
+    "print": {
+        "label": "印刷用 (PNG)",
+        "format": "PNG",
+        "max_edge": None,
+        "max_bytes": None,
+        "dpi": 300,
+    },
+}
+
+FORMAT_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# 作成するプリセット（カンマ区切り。空にすると書き出しを行わない）
+DEFAULT_PRESETS = [name.strip() for name in os.getenv("OUTPUT_PRESETS", ",".join(OUTPUT_PRESETS)).split(",") if name.strip()]
+# 容量の上限に収まらない場合に解像度を下げる倍率（の上限）と回数
+DOWNSCALE_STEP = 0.85
+MAX_DOWNSCALES = 5
+
+# メトリクス名
+ENCODED_BYTES = "cyclez_encoded_bytes"
+get_metrics().describe(ENCODED_BYTES, "Size of encoded output derivatives in bytes")
+
+
+def _encode(image: Any, preset: Dict[str, Any], quality: Optional[int]) -> bytes:
+    buffer = io.BytesIO()
+    if preset["format"] == "JPEG":
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif preset["format"] == "WEBP":
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+    else:
+        dpi = preset.get("dpi")
+        image.save(buffer, format=preset["format"], compress_level=9, **({"dpi": (dpi, dpi)} if dpi else {}))
+    return buffer.getvalue()
+
+
+def _fit_quality(image: Any, preset: Dict[str, Any]) -> Tuple[Optional[bytes], int, int]:
+    """
+    容量の上限に収まる最も高い品質を二分探索
+
+    Returns:
+        (データ（下限の品質でも収まらない場合は None）, 品質, 最後に試したデータのバイト数)
+    """
+    low, high = preset["min_quality"], preset["quality"]
+    data = _encode(image, preset, high)
+    if len(data) <= preset["max_bytes"]:
+        return data, high, len(data)
+    data = _encode(image, preset, low)
+    if len(data) > preset["max_bytes"]:
+        return None, low, len(data)
+    best = (data, low)
+    low, high = low + 1, high - 1
+    while low <= high:
+        middle = (low + high) // 2
+        data = _encode(image, preset, middle)
+        if len(data) <= preset["max_bytes"]:
+            best = (data, middle)
+            low = middle + 1
+        else:
+            high = middle - 1
+    return best[0], best[1], len(best[0])
+
+
+def _render_derivatives(source: str, targets: Dict[str, Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """
+    元画像から各プリセットの派生ファイルを作成（プロセスプールで実行するためモジュール直下に定義）
+
+    Args:
+        source: 元画像のパス
+        targets: {プリセット名: (保存先のパス, プリセットの設定)}
+
+    Returns:
+        {プリセット名: {"bytes", "width", "height", "quality", "compression_ratio", "seconds", ...}}
+    """
+    from PIL import Image, ImageOps
+
+    source_bytes = os.path.getsize(source)
+    results = {}
+    with Image.open(source) as original:
+        original = ImageOps.exif_transpose(original)
+        for name, (target, preset) in targets.items():
+            started = time.perf_counter()
+            image = original.convert("RGBA" if preset["format"] == "PNG" and original.mode in ("RGBA", "LA", "P") else "RGB")
+            if preset.get("max_edge") and max(image.size) > preset["max_edge"]:
+                image.thumbnail((preset["max_edge"], preset["max_edge"]), Image.LANCZOS)
+
+            quality = preset.get("quality")
+            if preset.get("max_bytes") and quality is not None:
+                data, quality, size = _fit_quality(image, preset)
+                downscales = 0
+                while data is None and downscales < MAX_DOWNSCALES:
+                    # 品質の下限でも収まらない場合は解像度を下げる（バイト数は画素数にほぼ比例するため超過分から倍率を見積もる）
+                    scale = max(0.5, min(DOWNSCALE_STEP, (preset["max_bytes"] / size) ** 0.5 * 0.95))
+                    image = image.resize(
+                        (max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS
+                    )
+                    data, quality, size = _fit_quality(image, preset)
+                    downscales += 1
+                if data is None:
+                    data = _encode(image, preset, preset["min_quality"])
+            else:
+                data = _encode(image, preset, quality)
+
+            target_path = Path(target)
+            tmp_path = target_path.with_name(f".tmp_{os.getpid()}_{target_path.name}")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, target_path)
+            results[name] = {
+                "format": preset["format"],
+                "bytes": len(data),
+                "width": image.width,
+                "height": image.height,
+                "quality": quality,
+                "compression_ratio": source_bytes / len(data) if data else None,
+                "within_limit": preset.get("max_bytes") is None or len(data) <= preset["max_bytes"],
+                "seconds": time.perf_counter() - started,
+            }
+    return results
+
+
+class OutputEncoder:
+    """
+    派生ファイルの作成をプロセスプールで実行する
+    submit() は待たずに戻り、完了時に出力ストアの metadata["derivatives"] を更新する
+    """
+
+    def __init__(self, presets: Optional[List[str]] = None, max_workers: Optional[int] = None):
+        self.presets = [name for name in (DEFAULT_PRESETS if presets is None else presets) if name in OUTPUT_PRESETS]
+        self.max_workers = max_workers or min(2, os.cpu_count() or 1)
+
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[str, Future] = {}
+        self.encoded = 0
+        self.failures = 0
+
+    @staticmethod
+    def derivative_path(record: Dict[str, Any], name: str) -> Path:
+        """派生ファイルのパス（出力ストアのルートからの相対パス）"""
+        extension = MIME_EXTENSIONS[FORMAT_MIME_TYPES[OUTPUT_PRESETS[name]["format"]]]
+        return Path(record["path"]).with_name(f"{record['id']}.{name}{extension}")
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 最初の書き出しまでワーカープロセスを起動しない
+        # 書き出しは生成スレッド・イベントループのスレッドから始まるため、スレッドの状態（ロック）を
+        # 引き継がないよう fork ではなく forkserver（Windows では spawn）でワーカーを作る（サムネイルキャッシュと同じ）
+        with self._lock:
+            if self._executor is None:
+                method = "spawn" if sys.platform == "win32" else "forkserver"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context(method)
+                )
+            return self._executor
+
+    def _reset_executor(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def submit(self, record: Dict[str, Any], store: OutputStore, presets: Optional[List[str]] = None) -> Optional[Future]:
+        """
+        保存済みの画像（OutputStore.save / get の結果）の派生ファイル作成を開始
+
+        Returns:
+            Future（結果は metadata["derivatives"] と同じ辞書）。作成するもの・開始できるワーカーがない場合は None
+        """
+        names = [name for name in (self.presets if presets is None else presets) if name in OUTPUT_PRESETS]
+        if not names:
+            return None
+
+        root = Path(record["absolute_path"]).parent
+        targets = {name: (str(root / self.derivative_path(record, name).name), OUTPUT_PRESETS[name]) for name in names}
+        args = (record["absolute_path"], targets)
+        try:
+            try:
+                future = self._get_executor().submit(_render_derivatives, *args)
+            except BrokenExecutor:
+                self._reset_executor()
+                future = self._get_executor().submit(_render_derivatives, *args)
+        except Exception as e:
+            # 書き出しに失敗しても生成結果（元画像）には影響させない
+            self.failures += 1
+            log_event("encode_error", f"⚠️ 書き出しを開始できません [{record['id']}]: {e}", level="error",
+                      image_id=record["id"], error=str(e))
+            return None
+
+        with self._lock:
+            self._pending[record["id"]] = future
+        future.add_done_callback(lambda done: self._on_done(done, record, store))
+        return future
+
+    def _on_done(self, future: Future, record: Dict[str, Any], store: OutputStore) -> None:
+        try:
+            results = future.result()
+        except Exception as e:
+            if isinstance(e, BrokenExecutor):
+                # ワーカーが異常終了した場合は次回の書き出しでプールを作り直す
+                self._reset_executor()
+            self.failures += 1
+            log_event("encode_error", f"⚠️ 書き出しエラー [{record['id']}]: {e}", level="error",
+                      image_id=record["id"], error=str(e))
+            results = None
+
+        if results:
+            derivatives = {}
+            for name, result in results.items():
+                derivatives[name] = dict(
+                    result,
+                    label=OUTPUT_PRESETS[name]["label"],
+                    path=self.derivative_path(record, name).as_posix(),
+                    mime_type=FORMAT_MIME_TYPES[result["format"]],
+                )
+                get_metrics().observe(ENCODED_BYTES, result["bytes"], buckets=SIZE_BUCKETS, preset=name)
+                record_stage("encode", result["seconds"], preset=name)
+                log_event(
+                    "encoded",
+                    f"🗜 書き出し [{name}]: {result['bytes'] // 1024}KB "
+                    f"（{result['width']}x{result['height']}、圧縮率 {result['compression_ratio']:.1f}倍）",
+                    image_id=record["id"], preset=name, bytes=result["bytes"],
+                    compression_ratio=round(result["compression_ratio"], 3), quality=result["quality"]
+                )
+            try:
+                store.update_metadata(record["id"], derivatives=derivatives)
+                self.encoded += 1
+            except Exception as e:
+                self.failures += 1
+                log_event("encode_error", f"⚠️ 書き出し結果の記録エラー [{record['id']}]: {e}", level="error",
+                          image_id=record["id"], error=str(e))
+
+        with self._lock:
+            if self._pending.get(record["id"]) is future:
+                del self._pending[record["id"]]
+
+    def wait(self, image_ids: List[str], timeout: Optional[float] = None) -> bool:
+        """
+        指定した画像の書き出しが終わるまで待つ（このプロセスで実行中のものだけ）
+
+        Returns:
+            すべて終わっていれば True
+        """
+        with self._lock:
+            futures = [self._pending[image_id] for image_id in image_ids if image_id in self._pending]
+        if not futures:
+            return True
+        _, not_done = wait(futures, timeout)
+        if not_done:
+            return False
+        # 完了時のコールバック（メタデータの更新）が終わるまで待つ
+        deadline = time.monotonic() + 1.0
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not any(image_id in self._pending for image_id in image_ids):
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def is_pending(self, image_id: str) -> bool:
+        with self._lock:
+            return image_id in self._pending
+
+    def stats(self) -> Dict[str, int]:
+        """書き出し済み・実行中・失敗の件数"""
+        with self._lock:
+            pending = len(self._pending)
+        return {"encoded": self.encoded, "pending": pending, "failures": self.failures}
+
+    def close(self) -> None:
+        """ワーカープロセスを終了"""
+        self._reset_executor()
+
+
+_default_encoder: Optional[OutputEncoder] = None
+_default_encoder_lock = threading.Lock()
+
+
+def get_output_encoder() -> OutputEncoder:
+    """プロセス共通のデフォルトエンコーダーを取得"""
+    global _default_encoder
+    with _default_encoder_lock:
+        if _default_encoder is None:
+            _default_encoder = OutputEncoder()
+        return _default_encoder
@@ -0,0 +1,364 @@
+"""
+生成画像の保存・検索モジュール
+画像ごとに重複しないIDを割り当て、日付ごとのディレクトリに一時ファイル経由で安全に保存する
+生成条件（プロンプト・参照画像・処理時間など）はSQLiteのインデックスに記録する
+save(..., background=True) ではファイルの書き込みとインデックスへの記録を書き込み用スレッドで行い、
+生成直後の表示・ダウンロードはメモリ上のデータ（result_buffers.py）を使う
+"""
+
+import os
+import json
+import uuid
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Any, List, Optional
+
+from prompt_cache import canonical_hash
+from metrics import log_event
+
+DEFAULT_ROOT = Path(__file__).parent / "outputs"
+INDEX_FILENAME = "index.sqlite3"
+
+MIME_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+# ファイル先頭のバイト列 -> MIMEタイプ（APIが返す mime_type が実際の形式と異なる場合があるため内容で判定する）
+MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+# 画像ファイルをバックグラウンドで書き込むスレッド数（fsync の待ちを生成スレッドから外す）
+WRITER_THREADS = 2
+# 書き込み中の画像を get / update_metadata で待つ上限（秒）
+WRITE_WAIT_SECONDS = 30.0
+
+# 検索・表示に使う列（JSON列は読み込み時に復元）
+_JSON_COLUMNS = ("generation_input", "reference_hashes", "timings", "metadata")
+
+
+def detect_mime_type(data: bytes, default: Optional[str] = None) -> Optional[str]:
+    """画像データの先頭バイトから実際の形式（MIMEタイプ）を判定（不明な場合は default）"""
+    head = bytes(data[:16])
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    return default
+
+
+class OutputStore:
+    """
+    生成画像のストア
+    ファイル: <root>/YYYY/MM/DD/<image_id>.<ext>
+    インデックス: <root>/index.sqlite3
+    """
+
+    def __init__(self, root: Path = DEFAULT_ROOT):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / INDEX_FILENAME
+        # 書き込み中の画像ID -> Future（書き込みとインデックスへの記録が終わると取り除く）
+        self._pending: Dict[str, Future] = {}
+        # 書き込み中の画像ID -> 記録する内容（書き込みを待たずに表示するため）
+        self._pending_records: Dict[str, Dict[str, Any]] = {}
+        self._pending_lock = threading.Lock()
+        self._writer: Optional[ThreadPoolExecutor] = None
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outputs (
+                    id TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    date TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    byte_size INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    prompt TEXT,
+                    input_hash TEXT,
+                    generation_input TEXT,
+                    staff TEXT,
+                    situation TEXT,
+                    aspect_ratio TEXT,
+                    reference_hashes TEXT,
+                    timings TEXT,
+                    metadata TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_date ON outputs (date, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_staff ON outputs (staff, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_situation ON outputs (situation, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_created ON outputs (created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outputs_input_hash ON outputs (input_hash)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.index_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def new_id() -> str:
+        """重複しない画像ID（時刻 + ランダム値、時刻順に並ぶ）"""
+        return f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:10]}"
+
+    def _write_atomic(self, path: Path, data: bytes) -> None:
+        """一時ファイルに書き込んでからリネーム（書きかけのファイルが見えないようにする）"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp_", suffix=path.suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+
+    def _insert(self, row: Dict[str, Any]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO outputs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values())
+            )
+
+    def _write_and_insert(self, path: Path, data: bytes, row: Dict[str, Any]) -> None:
+        """ファイルを書き込んでからインデックスに記録（インデックスが書きかけのファイルを指さないようにする）"""
+        self._write_atomic(path, data)
+        self._insert(row)
+
+    def _get_writer(self) -> ThreadPoolExecutor:
+        with self._pending_lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="output-writer")
+            return self._writer
+
+    def save(
+        self,
+        data: bytes,
+        mime_type: str = "image/png",
+        prompt: Optional[str] = None,
+        generation_input: Optional[Dict[str, Any]] = None,
+        reference_hashes: Optional[List[str]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        background: bool = False
+    ) -> Dict[str, Any]:
+        """
+        画像を保存してインデックスに記録
+        拡張子と mime_type は指定された mime_type ではなくデータの実際の形式で決める
+
+        Args:
+            background: True の場合はファイルの書き込みとインデックスへの記録を書き込み用スレッドで行い、
+                すぐに戻る（完了は when_written / wait_written で待つ。data は書き込みが終わるまで変更しないこと）
+
+        Returns:
+            記録した内容（"id", "path" などを含む辞書）
+        """
+        detected = detect_mime_type(data, mime_type)
+        if detected != mime_type:
+            metadata = dict(metadata or {}, declared_mime_type=mime_type)
+            mime_type = detected
+
+        image_id = self.new_id()
+        now = datetime.now()
+        relative_path = Path(now.strftime("%Y"), now.strftime("%m"), now.strftime("%d"),
+                             image_id + MIME_EXTENSIONS.get(mime_type, ".png"))
+        path = self.root / relative_path
+
+        generation_input = generation_input or {}
+        record = {
+            "id": image_id,
+            "created_at": time.time(),
+            "date": now.strftime("%Y-%m-%d"),
+            "path": relative_path.as_posix(),
+            "mime_type": mime_type,
+            "byte_size": len(data),
+            "content_hash": hashlib.sha256(data).hexdigest(),
+            "prompt": prompt,
+            "input_hash": canonical_hash(generation_input) if generation_input else None,
+            "generation_input": generation_input,
+            "staff": generation_input.get("staff"),
+            "situation": generation_input.get("situation"),
+            "aspect_ratio": generation_input.get("aspect_ratio"),
+            "reference_hashes": reference_hashes or [],
+            "timings": timings or {},
+            "metadata": metadata or {},
+        }
+
+        row = dict(record)
+        for column in _JSON_COLUMNS:
+            row[column] = json.dumps(row[column], ensure_ascii=False, default=str)
+
+        record["absolute_path"] = str(path)
+        if not background:
+            self._write_and_insert(path, data, row)
+            return record
+
+        future = self._get_writer().submit(self._write_and_insert, path, data, row)
+        with self._pending_lock:
+            self._pending[image_id] = future
+            self._pending_records[image_id] = record
+
+        def finished(done: Future) -> None:
+            with self._pending_lock:
+                self._pending.pop(image_id, None)
+                self._pending_records.pop(image_id, None)
+            if done.exception() is not None:
+                log_event("write_error", f"❌ 画像の書き込みエラー [{image_id}]: {done.exception()}", level="error",
+                          image_id=image_id, error=str(done.exception()))
+
+        future.add_done_callback(finished)
+        return record
+
+    def when_written(self, image_id: str, callback: Callable[[], None]) -> None:
+        """画像の書き込みが終わったら callback を呼ぶ（書き込み済みならすぐに呼ぶ。失敗した場合は呼ばない）"""
+        with self._pending_lock:
+            future = self._pending.get(image_id)
+        if future is None:
+            callback()
+            return
+        future.add_done_callback(lambda done: callback() if done.exception() is None else None)
+
+    def wait_written(self, image_ids: Optional[List[str]] = None, timeout: Optional[float] = WRITE_WAIT_SECONDS) -> bool:
+        """
+        バックグラウンドの書き込みが終わるまで待つ（image_ids が None の場合は書き込み中のすべて）
+
+        Returns:
+            時間内にすべて終わったか
+        """
+        with self._pending_lock:
+            if image_ids is None:
+                futures = list(self._pending.values())
+            else:
+                futures = [self._pending[image_id] for image_id in image_ids if image_id in self._pending]
+        if not futures:
+            return True
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+    def is_written(self, image_id: str) -> bool:
+        """バックグラウンドの書き込みが終わっているか（待たない。失敗した場合も True）"""
+        with self._pending_lock:
+            return image_id not in self._pending
+
+    def peek(self, image_id: str) -> Optional[Dict[str, Any]]:
+        """
+        IDで1件取得（書き込み中の場合は待たずに記録予定の内容を返す。ファイルはまだないため、
+        画像データは result_buffers から読むこと）
+        """
+        with self._pending_lock:
+            record = self._pending_records.get(image_id)
+        if record is not None:
+            return dict(record)
+        return self.get(image_id)
+
+    def _to_record(self, row: sqlite3.Row) -> Dict[str, Any]:
+        record = dict(row)
+        for column in _JSON_COLUMNS:
+            record[column] = json.loads(record[column]) if record[column] else None
+        record["absolute_path"] = str(self.root / record["path"])
+        return record
+
+    def get(self, image_id: str) -> Optional[Dict[str, Any]]:
+        """IDで1件取得（書き込み中の場合は記録されるまで待つ）"""
+        self.wait_written([image_id])
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM outputs WHERE id = ?", (image_id,)).fetchone()
+        return self._to_record(row) if row else None
+
+    def update_metadata(self, image_id: str, **values: Any) -> None:
+        """metadata 列に値を追加（読み込みから書き込みまでを1つの書き込みトランザクションで行う）"""
+        self.wait_written([image_id])
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT metadata FROM outputs WHERE id = ?", (image_id,)).fetchone()
+            if row is None:
+                return
+            metadata = json.loads(row["metadata"]) if row["metadata"] else {}
+            metadata.update(values)
+            conn.execute(
+                "UPDATE outputs SET metadata = ? WHERE id = ?",
+                (json.dumps(metadata, ensure_ascii=False, default=str), image_id)
+            )
+
+    @staticmethod
+    def _where(date: Optional[str], staff: Optional[str], situation: Optional[str]):
+        clauses = []
+        params = []
+        for column, value in (("date", date), ("staff", staff), ("situation", situation)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, params
+
+    def query(
+        self,
+        date: Optional[str] = None,
+        staff: Optional[str] = None,
+        situation: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0
+    ) -> List[Dict[str, Any]]:
+        """
+        条件に合う画像を新しい順に取得（インデックスを使用）
+
+        Args:
+            date: 日付 "YYYY-MM-DD"
+            staff: スタッフ名
+            situation: シチュエーション
+        """
+        where, params = self._where(date, staff, situation)
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM outputs {where} ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def dates(self) -> List[str]:
+        """画像がある日付の一覧（新しい順）"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT DISTINCT date FROM outputs ORDER BY date DESC").fetchall()
+        return [row["date"] for row in rows]
+
+    def count(
+        self,
+        date: Optional[str] = None,
+        staff: Optional[str] = None,
+        situation: Optional[str] = None
+    ) -> int:
+        """条件に合う画像の件数"""
+        where, params = self._where(date, staff, situation)
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM outputs {where}", params).fetchone()[0]
+
+
+_stores: Dict[str, OutputStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_output_store(root: Optional[Path] = None) -> OutputStore:
+    """出力先ディレクトリごとのストアを取得（Noneの場合はデフォルトの outputs/）"""
+    root = Path(root) if root is not None else DEFAULT_ROOT
+    key = str(root.resolve())
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = OutputStore(root)
+        return _stores[key]
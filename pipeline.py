@@ -0,0 +1,285 @@
+"""
+非同期生成パイプライン
+プロンプト変換（Claude）→ 画像生成（Gemini）を1つのコルーチンにまとめ、
+1つのイベントループで多数の生成を同時実行できるようにする
+"""
+
+import time
+import asyncio
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+from prompt_router import DEFAULT_BUDGET_SECONDS, SOURCE_CACHE, route_prompt_async
+from image_generator import (
+    build_gemini_contents, generate_image_with_gemini, generate_image_with_gemini_async,
+    generate_from_contents_async
+)
+from scheduler import request_context
+from metrics import span
+from api_clients import run_async
+from output_store import get_output_store
+from brand_compliance import ComplianceChecker, log_compliance
+
+# 同時実行数のデフォルト（APIごとのセマフォ）
+DEFAULT_CLAUDE_CONCURRENCY = 4
+DEFAULT_GEMINI_CONCURRENCY = 4
+
+
+async def generate_async(
+    generation_input: Dict[str, Any],
+    reference_images: List[Dict[str, Any]],
+    prompt: Optional[str] = None,
+    force_refresh: bool = False,
+    output_dir: Optional[Path] = None,
+    claude_semaphore: Optional[asyncio.Semaphore] = None,
+    gemini_semaphore: Optional[asyncio.Semaphore] = None,
+    budget_seconds: float = DEFAULT_BUDGET_SECONDS,
+    export_formats: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    プロンプト変換から画像生成までを実行するコルーチン
+
+    Args:
+        generation_input: 画像生成の入力情報（convert_prompt_with_claude と同じ）
+        reference_images: 参照画像のリスト（generate_image_with_gemini と同じ）
+        prompt: 変換済みプロンプト（指定時はClaude APIを呼ばない）
+        force_refresh: プロンプトキャッシュを無視して再変換するか
+        output_dir: 出力ディレクトリ（Noneの場合はデフォルト）
+        claude_semaphore: Claude API の同時実行数を制限するセマフォ
+        gemini_semaphore: Gemini API の同時実行数を制限するセマフォ
+        budget_seconds: Claudeでのプロンプト変換を待つ上限（秒）
+        export_formats: マルチフォーマット書き出しの形式（smart_crop.EXPORT_FORMATS の名前）
+            指定時はマスター画像を1枚だけ生成し、各形式はローカルで切り出す
+
+    Returns:
+        generate_image_with_gemini の結果に "prompt", "prompt_from_cache",
+        "prompt_source"（"cache" / "claude" / "local" / 指定時は "given"）、
+        "compliance"（ブランドチェックの結果）、
+        "exports"（export_formats 指定時: {形式名: {"image_id", "image_path"}}）を加えた辞書
+    """
+    prompt_source = "given"
+
+    if export_formats:
+        # numpy は書き出しを使う場合だけ読み込む
+        import smart_crop
+        ratios = [smart_crop.EXPORT_FORMATS[name][1] for name in export_formats]
+        generation_input = dict(generation_input, aspect_ratio=smart_crop.master_aspect_ratio(ratios))
+
+    if prompt is None:
+        # 予算内にClaudeで変換できない・失敗した場合はローカル生成のプロンプトを使う
+        if claude_semaphore is not None:
+            async with claude_semaphore:
+                prompt, route_info = await route_prompt_async(generation_input, budget_seconds, force_refresh)
+        else:
+            prompt, route_info = await route_prompt_async(generation_input, budget_seconds, force_refresh)
+        prompt_source = route_info["source"]
+
+    # ブランドガイドラインのチェック（バッチでは再変換せず置き換えで直す）
+    prompt, compliance = ComplianceChecker().enforce(prompt)
+    log_compliance(compliance, generation_input.get("situation", ""))
+
+    generate_kwargs = {
+        "prompt": smart_crop.master_prompt(prompt) if export_formats else prompt,
+        "reference_images": reference_images,
+        "aspect_ratio": generation_input.get("aspect_ratio", "1:1"),
+        "output_dir": output_dir,
+        "generation_input": generation_input,
+    }
+    if gemini_semaphore is not None:
+        async with gemini_semaphore:
+            result = await generate_image_with_gemini_async(**generate_kwargs)
+    else:
+        result = await generate_image_with_gemini_async(**generate_kwargs)
+
+    result["prompt"] = prompt
+    result["prompt_from_cache"] = prompt_source == SOURCE_CACHE
+    result["prompt_source"] = prompt_source
+    result["compliance"] = compliance
+    if result.get("image_id"):
+        await asyncio.to_thread(
+            get_output_store(output_dir).update_metadata, result["image_id"], brand_compliance=compliance
+        )
+        if export_formats:
+            store = get_output_store(output_dir)
+            exported = await asyncio.to_thread(
+                smart_crop.export_formats, store.get(result["image_id"]), store, export_formats
+            )
+            result["exports"] = {
+                name: {"image_id": record["id"], "image_path": record["absolute_path"]}
+                for name, record in exported.items()
+            }
+    return result
+
+
+async def generate_candidates_async(
+    prompt: str,
+    reference_images: List[Dict[str, Any]],
+    count: int,
+    aspect_ratio: str = "1:1",
+    output_dir: Optional[Path] = None,
+    gemini_semaphore: Optional[asyncio.Semaphore] = None,
+    generation_input: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    同じプロンプト・参照画像で count 件の画像生成を並列に実行（候補の生成）
+    参照画像の前処理とコンテンツ構築は1回だけ行い、全リクエストで共有する
+    generation_input は出力インデックスへの記録用（オプション）
+
+    Returns:
+        Dict: {
+            "success": bool (1枚以上生成できたか),
+            "image_paths": List[str] (全候補の画像。1レスポンスに複数画像があればすべて含む),
+            "image_ids": List[str] (全候補のストアでのID),
+            "results": List[Dict] (リクエストごとの結果),
+            "reference_stats": Dict,
+            "error": str (全件失敗時)
+        }
+    """
+    try:
+        started = time.perf_counter()
+        contents, reference_stats = await asyncio.to_thread(
+            build_gemini_contents, prompt, reference_images, aspect_ratio
+        )
+        timings = {"reference_io": time.perf_counter() - started}
+    except Exception as e:
+        return {"success": False, "image_paths": [], "image_ids": [], "results": [], "error": str(e)}
+
+    async def generate_one() -> Dict[str, Any]:
+        generate = generate_from_contents_async(
+            contents, reference_stats, output_dir, prompt, generation_input, timings
+        )
+        if gemini_semaphore is not None:
+            async with gemini_semaphore:
+                return await generate
+        return await generate
+
+    results = await asyncio.gather(*[generate_one() for _ in range(count)])
+
+    successful = [result for result in results if result.get("success")]
+    image_paths = [path for result in successful for path in result["image_paths"]]
+    summary = {
+        "success": bool(image_paths),
+        "image_paths": image_paths,
+        "image_ids": [image_id for result in successful for image_id in result["image_ids"]],
+        "results": results,
+        "reference_stats": reference_stats,
+    }
+    if not image_paths:
+        summary["error"] = next((r.get("error") for r in results if r.get("error")), "画像が生成されませんでした")
+    return summary
+
+
+def generate_candidates(
+    prompt: str,
+    reference_images: List[Dict[str, Any]],
+    count: int,
+    aspect_ratio: str = "1:1",
+    output_dir: Optional[Path] = None,
+    generation_input: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """generate_candidates_async の同期ラッパー（イベントループ外から呼び出す）"""
+    return run_async(generate_candidates_async(
+        prompt, reference_images, count, aspect_ratio, output_dir, generation_input=generation_input
+    ))
+
+
+async def generate_many_async(
+    jobs: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+    claude_concurrency: int = DEFAULT_CLAUDE_CONCURRENCY,
+    gemini_concurrency: int = DEFAULT_GEMINI_CONCURRENCY,
+    output_dir: Optional[Path] = None
+) -> List[Dict[str, Any]]:
+    """
+    複数の (generation_input, reference_images) を同時に生成
+
+    Returns:
+        jobs と同じ順番の結果リスト
+    """
+    claude_semaphore = asyncio.Semaphore(claude_concurrency)
+    gemini_semaphore = asyncio.Semaphore(gemini_concurrency)
+
+    return await asyncio.gather(*[
+        generate_async(
+            generation_input,
+            reference_images,
+            output_dir=output_dir,
+            claude_semaphore=claude_semaphore,
+            gemini_semaphore=gemini_semaphore
+        )
+        for generation_input, reference_images in jobs
+    ])
+
+
+def generate_many(
+    jobs: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]],
+    claude_concurrency: int = DEFAULT_CLAUDE_CONCURRENCY,
+    gemini_concurrency: int = DEFAULT_GEMINI_CONCURRENCY,
+    output_dir: Optional[Path] = None
+) -> List[Dict[str, Any]]:
+    """generate_many_async の同期ラッパー（イベントループ外から呼び出す）"""
+    return run_async(generate_many_async(jobs, claude_concurrency, gemini_concurrency, output_dir))
+
+
+def run_generation_job(payload: Dict[str, Any], job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    ジョブキューの "generate" ジョブを実行（JobWorkerPool のハンドラー）
+
+    payload:
+        {"prompt", "reference_images", "aspect_ratio", "count", "generation_input", "prompt_source", "compliance",
+         "export_formats"（マルチフォーマット書き出し時: マスター画像1枚から切り出す形式の名前）}
+
+    Returns:
+        {"success", "image_ids", "image_paths", "text_response", "reference_stats", "prompt_source", "error",
+         "exports"（マルチフォーマット書き出し時: {形式名: 画像ID}）}
+        （画像はストアに保存済みのため、結果にはIDとパスだけを含める）
+    """
+    export_formats = payload.get("export_formats")
+    count = 1 if export_formats else payload.get("count", 1)
+    prompt = payload["prompt"]
+    if export_formats:
+        import smart_crop
+        prompt = smart_crop.master_prompt(prompt)
+    kwargs = {
+        "prompt": prompt,
+        "reference_images": payload["reference_images"],
+        "aspect_ratio": payload.get("aspect_ratio", "1:1"),
+        "generation_input": payload.get("generation_input"),
+    }
+
+    # スケジューラの待ち行列では、ジョブを登録したセッションのリクエストとして扱う
+    with request_context(job.get("session_id") or "default", job.get("priority", 0)):
+        with span("generation_job", job_id=job["id"], count=count) as job_span:
+            if count > 1:
+                result = generate_candidates(count=count, **kwargs)
+            else:
+                result = generate_image_with_gemini(resolution="high", **kwargs)
+                result.setdefault("image_ids", [])
+                result.setdefault("image_paths", [])
+            job_span.set(success=result.get("success", False), images=len(result.get("image_ids", [])))
+
+    # ブランドチェックの結果を生成画像ごとに記録（画像ファイルの書き込みが終わってから。ジョブの完了は待たせない）
+    if payload.get("compliance"):
+        store = get_output_store()
+        for image_id in result.get("image_ids", []):
+            store.when_written(
+                image_id,
+                lambda image_id=image_id: store.update_metadata(image_id, brand_compliance=payload["compliance"])
+            )
+
+    exports = {}
+    if export_formats and result.get("image_ids"):
+        store = get_output_store()
+        exported = smart_crop.export_formats(store.get(result["image_ids"][0]), store, export_formats)
+        exports = {name: record["id"] for name, record in exported.items()}
+
+    return {
+        "success": result.get("success", False),
+        "count": count,
+        "image_ids": result.get("image_ids", []),
+        "image_paths": result.get("image_paths", []),
+        "text_response": result.get("text_response"),
+        "reference_stats": result.get("reference_stats"),
+        "prompt_source": payload.get("prompt_source"),
+        "exports": exports,
+        "error": result.get("error"),
+    }
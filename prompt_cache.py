@@ -0,0 +1,146 @@
+"""
+プロンプト変換結果の永続キャッシュ
+generation_input と静的データのハッシュをキーに、Claude APIの変換結果をSQLiteに保存
+LRUによる件数上限・TTLによる有効期限・ヒット/ミス数の集計に対応
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_CACHE_PATH = Path(__file__).parent / "cache" / "prompt_cache.sqlite3"
+DEFAULT_MAX_ENTRIES = int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "500"))
+DEFAULT_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+def canonical_hash(value: Any) -> str:
+    """
+    辞書などの値を正規化（キー順ソート・区切り固定）したJSONのSHA-256ハッシュ
+    同じ内容であればキーの順番に関係なく同じハッシュになる
+    """
+    data = json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class PromptCache:
+    """
+    SQLiteを使ったプロンプトキャッシュ
+    プロセス・セッションをまたいで共有される
+    """
+
+    def __init__(
+        self,
+        path: Path = DEFAULT_CACHE_PATH,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: int = DEFAULT_TTL_SECONDS
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS prompts (
+                    key TEXT PRIMARY KEY,
+                    prompt TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_prompts_accessed ON prompts (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # スレッドごとに接続を作る（Streamlitのスクリプトスレッドは毎回異なる）
+        return sqlite3.connect(self.path, timeout=10)
+
+    def make_key(self, generation_input: Dict[str, Any], context_hash: str) -> str:
+        """入力情報と静的データのハッシュからキャッシュキーを作成"""
+        return canonical_hash({"input": generation_input, "context": context_hash})
+
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュから取得（期限切れ・未登録の場合は None）"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT prompt, created_at FROM prompts WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            prompt, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM prompts WHERE key = ?", (key,))
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            conn.execute("UPDATE prompts SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return prompt
+
+    def put(self, key: str, prompt: str) -> None:
+        """キャッシュに保存し、件数上限を超えた分は最終アクセスが古い順に削除"""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO prompts (key, prompt, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, prompt, now, now)
+            )
+
+            if self.max_entries:
+                cursor = conn.execute(
+                    """
+                    DELETE FROM prompts WHERE key IN (
+                        SELECT key FROM prompts ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,)
+                )
+                self.evictions += max(cursor.rowcount, 0)
+
+    def clear(self) -> None:
+        """キャッシュを全削除"""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM prompts")
+
+    def stats(self) -> Dict[str, Any]:
+        """ヒット/ミス数などの統計情報"""
+        with self._lock, self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_default_cache: Optional[PromptCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_prompt_cache() -> PromptCache:
+    """プロセス共通のデフォルトキャッシュを取得"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PromptCache()
+        return _default_cache
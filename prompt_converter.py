@@ -5,8 +5,22 @@ cycleZのブランドガイドラインを反映
 """
 
 import os
-import anthropic
-from typing import Dict, Any
+import time
+import asyncio
+import threading
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from api_clients import get_anthropic_client, get_async_anthropic_client
+from prompt_cache import PromptCache, canonical_hash, get_prompt_cache
+from scheduler import get_scheduler
+from metrics import get_metrics, log_event, record_stage, span
+
+# 使用するClaudeモデル
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+
+# メトリクス名
+CLAUDE_TOKENS_TOTAL = "cyclez_claude_tokens_total"
+get_metrics().describe(CLAUDE_TOKENS_TOTAL, "Claude input tokens by kind (uncached, cache read, cache write)")
 
 # cycleZブランドガイドライン
 BRAND_GUIDELINES = """
@@ -62,6 +76,21 @@ racing, competitive, professional, intense, aggressive, extreme, championship,
 aero, time trial, velodrome, peloton, pro team
 """
 
+# ガイドラインのメーカー・キーワード一覧（BRAND_GUIDELINES と同じ内容。ブランドチェックで照合に使用）
+RECOMMENDED_BIKE_BRANDS = ["GIOS", "BASSO", "SCOTT", "DEROSA", "WILIER", "Cervelo", "BISYA", "SURLY", "MATE", "TOKYOBIKE"]
+RECOMMENDED_WEAR_BRANDS = ["STEMDESIGN", "ASSOS", "RINPROJECT", "CHROME", "CCP", "ISADORE", "ALBA Optics"]
+RECOMMENDED_KEYWORDS = [
+    "casual cycling", "lifestyle", "urban commute", "weekend ride", "stylish", "approachable",
+    "friendly staff", "comfortable", "enjoyable", "hobby", "leisure", "natural light",
+    "clean shop interior", "modern", "welcoming atmosphere",
+]
+NG_BIKE_BRANDS = ["Specialized", "Trek", "Colnago", "GIANT", "PINARELLO", "Bianchi", "Cannondale", "MERIDA", "ANCHOR"]
+NG_WEAR_BRANDS = ["Rapha", "Pearl Izumi"]
+NG_KEYWORDS = [
+    "racing", "competitive", "professional", "intense", "aggressive", "extreme", "championship",
+    "aero", "time trial", "velodrome", "peloton", "pro team",
+]
+
 SITUATION_PROMPTS = {
     "バイクフィッティング": {
         "scene": "professional bike fitting session in a modern bicycle shop",
@@ -134,10 +163,96 @@ MOOD_MODIFIERS = {
     "活気ある": "positive lively atmosphere, bright daylight, excitement about bikes and cycling lifestyle"
 }
 
+# 用途の説明
+PURPOSE_DESCRIPTIONS = {
+    "promotional_staff": "スタッフ紹介用の宣材写真。スタッフの人柄や専門性が伝わる、プロフェッショナルで親しみやすい雰囲気。",
+    "instagram": "Instagram投稿用の写真。目を引く構図、ライフスタイル感、シェアしたくなるような魅力的な画像。",
+    "shop_interior": "店舗紹介用の写真。人物なしで店舗の魅力を伝える。清潔感があり、入りたくなる雰囲気。",
+    "product": "バイク・商品紹介用の写真。商品の魅力が際立つ構図。",
+    "custom": "カスタム設定。指定された条件に従って生成。"
+}
 
-def convert_prompt_with_claude(generation_input: Dict[str, Any]) -> str:
+
+# Claude への指示（リクエストごとに変わらない部分）
+# Anthropic のプロンプトキャッシュを使うため、全リクエストでバイト単位で同一の内容にする
+SYSTEM_PROMPT = f"""あなたは画像生成AI（Gemini）用のプロンプトを作成する専門家です。
+cycleZというスポーツバイクショップのマーケティング画像を生成するためのプロンプトを作成します。
+
+{BRAND_GUIDELINES}
+
+## あなたのタスク
+1. 入力された日本語の指示を理解する
+2. ブランドガイドラインに完全に沿った英語プロンプトを生成する
+3. NGメーカー・NGワードは絶対に使わない
+4. 推奨メーカー・推奨キーワードを積極的に使用する
+5. 具体的で視覚的な描写を含める
+6. 【重要】登場人物は全員日本人（Japanese）であることを明記する。プロンプトの冒頭に "All people in this image must be Japanese." を必ず含める
+7. 【重要】バイクが登場する場合は推奨メーカー（GIOS, BASSO, SCOTT, DEROSA, WILIER, Cervelo, BISYA, SURLY, MATE, TOKYOBIKE）から選ぶ
+8. 【重要】ウェアが登場する場合は推奨ブランド（STEMDESIGN, ASSOS, RINPROJECT, CHROME, CCP, ISADORE, ALBA Optics）から選ぶ
+
+## 出力形式
+英語のプロンプトのみを出力してください。説明や注釈は不要です。
+プロンプトは1つの段落で、以下の要素を含めてください：
+- シーン設定（場所、環境）
+- 人物描写（いる場合）
+- アクション/ポーズ
+- 光と雰囲気
+- カメラアングル/構図
+- スタイル指定（写真風、イラスト等）
+"""
+
+# プロンプトキャッシュの利用状況（プロセス全体の累計トークン数）
+_cache_usage = {"requests": 0, "input_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+_cache_usage_lock = threading.Lock()
+
+
+def build_system_blocks() -> List[Dict[str, Any]]:
     """
-    Claude APIを使用して、入力情報を最適化された画像生成プロンプトに変換
+    system パラメータ（キャッシュ対象のブロック）
+    ブランドガイドラインを含む静的なシステムプロンプトに cache_control を付け、
+    2回目以降のリクエストではキャッシュから読み込ませる（1024トークン未満のブロックはキャッシュされない）
+    """
+    return [
+        {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+    ]
+
+
+def record_usage(usage: Any) -> Dict[str, int]:
+    """
+    レスポンスの usage からキャッシュ読み込み・書き込みのトークン数を記録して表示
+
+    Returns:
+        {"input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"}
+    """
+    tokens = {
+        key: getattr(usage, key, None) or 0
+        for key in ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+    }
+    with _cache_usage_lock:
+        _cache_usage["requests"] += 1
+        for key, value in tokens.items():
+            _cache_usage[key] += value
+    for key, value in tokens.items():
+        get_metrics().inc(CLAUDE_TOKENS_TOTAL, value, kind=key)
+    log_event(
+        "claude_usage",
+        f"🧠 Claudeプロンプトキャッシュ: 読み込み {tokens['cache_read_input_tokens']} / "
+        f"書き込み {tokens['cache_creation_input_tokens']} / 通常入力 {tokens['input_tokens']} トークン",
+        **tokens
+    )
+    return tokens
+
+
+def get_cache_usage() -> Dict[str, int]:
+    """プロンプトキャッシュの利用状況（累計）"""
+    with _cache_usage_lock:
+        return dict(_cache_usage)
+
+
+def build_claude_request(generation_input: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    入力情報から Claude API (messages.create) に渡すリクエスト引数を構築
+    同期版・非同期版で共通に使用する
 
     Args:
         generation_input: 画像生成の入力情報
@@ -154,11 +269,9 @@ def convert_prompt_with_claude(generation_input: Dict[str, Any]) -> str:
             - mood: 雰囲気
 
     Returns:
-        最適化された英語プロンプト
+        messages.create のキーワード引数
     """
 
-    client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-
     # 入力情報を整理
     purpose = generation_input.get("purpose", "custom")
     use_background = generation_input.get("use_background", True)
@@ -177,41 +290,7 @@ def convert_prompt_with_claude(generation_input: Dict[str, Any]) -> str:
     image_text = generation_input.get("image_text")
     location = generation_input.get("location", "cycleZ店舗") if use_background else None
 
-    # Claude への指示
-    system_prompt = f"""あなたは画像生成AI（Gemini）用のプロンプトを作成する専門家です。
-cycleZというスポーツバイクショップのマーケティング画像を生成するためのプロンプトを作成します。
-
-{BRAND_GUIDELINES}
-
-## あなたのタスク
-1. 入力された日本語の指示を理解する
-2. ブランドガイドラインに完全に沿った英語プロンプトを生成する
-3. NGメーカー・NGワードは絶対に使わない
-4. 推奨メーカー・推奨キーワードを積極的に使用する
-5. 具体的で視覚的な描写を含める
-6. 【重要】登場人物は全員日本人（Japanese）であることを明記する。プロンプトの冒頭に "All people in this image must be Japanese." を必ず含める
-7. 【重要】バイクが登場する場合は推奨メーカー（GIOS, BASSO, SCOTT, DEROSA, WILIER, Cervelo, BISYA, SURLY, MATE, TOKYOBIKE）から選ぶ
-8. 【重要】ウェアが登場する場合は推奨ブランド（STEMDESIGN, ASSOS, RINPROJECT, CHROME, CCP, ISADORE, ALBA Optics）から選ぶ
-
-## 出力形式
-英語のプロンプトのみを出力してください。説明や注釈は不要です。
-プロンプトは1つの段落で、以下の要素を含めてください：
-- シーン設定（場所、環境）
-- 人物描写（いる場合）
-- アクション/ポーズ
-- 光と雰囲気
-- カメラアングル/構図
-- スタイル指定（写真風、イラスト等）
-"""
-
     # 用途の説明
-    PURPOSE_DESCRIPTIONS = {
-        "promotional_staff": "スタッフ紹介用の宣材写真。スタッフの人柄や専門性が伝わる、プロフェッショナルで親しみやすい雰囲気。",
-        "instagram": "Instagram投稿用の写真。目を引く構図、ライフスタイル感、シェアしたくなるような魅力的な画像。",
-        "shop_interior": "店舗紹介用の写真。人物なしで店舗の魅力を伝える。清潔感があり、入りたくなる雰囲気。",
-        "product": "バイク・商品紹介用の写真。商品の魅力が際立つ構図。",
-        "custom": "カスタム設定。指定された条件に従って生成。"
-    }
     purpose_desc = PURPOSE_DESCRIPTIONS.get(purpose, PURPOSE_DESCRIPTIONS["custom"])
 
     # ユーザーメッセージを構築
@@ -290,19 +369,212 @@ cycleZというスポーツバイクショップのマーケティング画像
 8. レース系・ガチ勢の雰囲気を避ける
 """
 
-    # Claude API 呼び出し
-    message = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=1024,
-        messages=[
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": 1024,
+        "messages": [
             {"role": "user", "content": user_message}
         ],
-        system=system_prompt
-    )
+        "system": build_system_blocks()
+    }
+
+
+def convert_prompt_with_claude(generation_input: Dict[str, Any]) -> str:
+    """
+    Claude APIを使用して、入力情報を最適化された画像生成プロンプトに変換
+
+    Args:
+        generation_input: 画像生成の入力情報（build_claude_request を参照）
+
+    Returns:
+        最適化された英語プロンプト
+    """
+    # プロセス共通のクライアントを使い回す（接続を維持）
+    client = get_anthropic_client()
+    # 全セッション共通のレート制限・待ち行列を通して呼び出す
+    with get_scheduler().slot("claude", CLAUDE_MODEL), span("claude_request", model=CLAUDE_MODEL):
+        message = client.messages.create(**build_claude_request(generation_input))
+    record_usage(message.usage)
+    return message.content[0].text
+
+
+async def convert_prompt_with_claude_async(generation_input: Dict[str, Any]) -> str:
+    """
+    convert_prompt_with_claude の非同期版（AsyncAnthropic を使用）
+    """
+    client = get_async_anthropic_client()
+    async with get_scheduler().slot_async("claude", CLAUDE_MODEL):
+        with span("claude_request", model=CLAUDE_MODEL):
+            message = await client.messages.create(**build_claude_request(generation_input))
+    record_usage(message.usage)
+    return message.content[0].text
+
+
+def revise_prompt_with_claude(generation_input: Dict[str, Any], prompt: str, terms: List[str]) -> str:
+    """
+    ガイドライン違反の語を含むプロンプトを、該当箇所だけClaudeに書き直させる（1回のみ）
+    元の変換と同じ会話に続けて依頼するため、システムプロンプトはキャッシュから読み込まれる
+
+    Args:
+        generation_input: 元の変換に使った入力情報
+        prompt: 書き直す前のプロンプト
+        terms: 取り除く語（NGメーカー・NGワード）
 
+    Returns:
+        書き直したプロンプト
+    """
+    request = build_claude_request(generation_input)
+    request["messages"] += [
+        {"role": "assistant", "content": prompt},
+        {"role": "user", "content": (
+            "このプロンプトにはブランドガイドラインで禁止されている次の語が含まれています: "
+            f"{', '.join(terms)}\n"
+            "否定形（no / avoid など）での言及も含めてこれらの語を使わずに、該当箇所だけを書き直した"
+            "プロンプト全体を出力してください。それ以外の内容は変えないでください。"
+        )},
+    ]
+    client = get_anthropic_client()
+    with get_scheduler().slot("claude", CLAUDE_MODEL), span("claude_revision", model=CLAUDE_MODEL, terms=terms):
+        message = client.messages.create(**request)
+    record_usage(message.usage)
     return message.content[0].text
 
 
+class ClaudePromptStream:
+    """
+    Claude APIのストリーミングでプロンプトを変換
+    for delta in stream: でテキストの差分を受け取り、終了後に text・計測値を参照する
+
+    例:
+        stream = ClaudePromptStream(generation_input)
+        for delta in stream:
+            print(delta, end="")
+        print(stream.text, stream.time_to_first_token, stream.total_seconds)
+    待ち行列での待ち時間は queue_seconds（time_to_first_token・total_seconds には含まない）
+    受信完了後、プロンプトキャッシュのトークン数を usage に保持する
+    """
+
+    def __init__(self, generation_input: Dict[str, Any]):
+        self.generation_input = generation_input
+        self.time_to_first_token: Optional[float] = None
+        self.total_seconds: Optional[float] = None
+        self.queue_seconds: Optional[float] = None
+        self.usage: Optional[Dict[str, int]] = None
+        self._parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """これまでに受信したテキスト（終了後は完成したプロンプト）"""
+        return "".join(self._parts)
+
+    def __iter__(self) -> Iterator[str]:
+        client = get_anthropic_client()
+        queued = time.perf_counter()
+
+        # 実行枠は受信が終わる（または途中で打ち切られる）まで保持する
+        with get_scheduler().slot("claude", CLAUDE_MODEL):
+            started = time.perf_counter()
+            self.queue_seconds = started - queued
+            with client.messages.stream(**build_claude_request(self.generation_input)) as stream:
+                for delta in stream.text_stream:
+                    if self.time_to_first_token is None:
+                        self.time_to_first_token = time.perf_counter() - started
+                    self._parts.append(delta)
+                    yield delta
+                self.usage = record_usage(stream.get_final_message().usage)
+
+        self.total_seconds = time.perf_counter() - started
+        # ストリーミングは呼び出し側で中断されうるため span で囲まず、完了時に記録する
+        record_stage("queue_wait", self.queue_seconds, api="claude")
+        record_stage("claude_first_token", self.time_to_first_token or self.total_seconds, model=CLAUDE_MODEL)
+        record_stage("claude_stream", self.total_seconds, model=CLAUDE_MODEL)
+
+
+def prompt_context_hash() -> str:
+    """
+    プロンプト変換結果に影響する静的データ（ガイドライン・各テーブル・モデル名）のハッシュ
+    いずれかが変更されるとキャッシュキーが変わり、古い結果は使われなくなる
+    """
+    return canonical_hash({
+        "brand_guidelines": BRAND_GUIDELINES,
+        "situation_prompts": SITUATION_PROMPTS,
+        "client_descriptions": CLIENT_DESCRIPTIONS,
+        "mood_modifiers": MOOD_MODIFIERS,
+        "purpose_descriptions": PURPOSE_DESCRIPTIONS,
+        "model": CLAUDE_MODEL,
+    })
+
+
+def lookup_cached_prompt(
+    generation_input: Dict[str, Any],
+    cache: Optional[PromptCache] = None
+) -> Optional[str]:
+    """キャッシュ済みのプロンプトを取得（なければ None）"""
+    if cache is None:
+        cache = get_prompt_cache()
+    return cache.get(cache.make_key(generation_input, prompt_context_hash()))
+
+
+def store_cached_prompt(
+    generation_input: Dict[str, Any],
+    prompt: str,
+    cache: Optional[PromptCache] = None
+) -> None:
+    """変換結果をキャッシュに保存"""
+    if cache is None:
+        cache = get_prompt_cache()
+    cache.put(cache.make_key(generation_input, prompt_context_hash()), prompt)
+
+
+def convert_prompt_cached(
+    generation_input: Dict[str, Any],
+    force_refresh: bool = False,
+    cache: Optional[PromptCache] = None
+) -> Tuple[str, bool]:
+    """
+    キャッシュを利用してプロンプトを変換（同じ入力ならClaude APIを呼ばない）
+
+    Args:
+        generation_input: 画像生成の入力情報（convert_prompt_with_claude と同じ）
+        force_refresh: True の場合はキャッシュを無視して再変換し、結果で上書き
+        cache: 使用するキャッシュ（Noneの場合はデフォルト）
+
+    Returns:
+        (最適化された英語プロンプト, キャッシュから取得したか)
+    """
+    if not force_refresh:
+        cached = lookup_cached_prompt(generation_input, cache)
+        if cached is not None:
+            return cached, True
+
+    prompt = convert_prompt_with_claude(generation_input)
+    store_cached_prompt(generation_input, prompt, cache)
+    return prompt, False
+
+
+async def convert_prompt_cached_async(
+    generation_input: Dict[str, Any],
+    force_refresh: bool = False,
+    cache: Optional[PromptCache] = None
+) -> Tuple[str, bool]:
+    """
+    convert_prompt_cached の非同期版
+    """
+    if cache is None:
+        cache = get_prompt_cache()
+
+    key = cache.make_key(generation_input, prompt_context_hash())
+
+    if not force_refresh:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached, True
+
+    prompt = await convert_prompt_with_claude_async(generation_input)
+    await asyncio.to_thread(cache.put, key, prompt)
+    return prompt, False
+
+
 def build_simple_prompt(generation_input: Dict[str, Any]) -> str:
     """
     Claude APIを使わずにシンプルなプロンプトを構築（フォールバック用）
@@ -357,6 +629,196 @@ def build_simple_prompt(generation_input: Dict[str, Any]) -> str:
     return " ".join(parts)
 
 
+# ローカルプロンプト生成（Claude API を使わない）用のテーブル
+PURPOSE_STYLES = {
+    "promotional_staff": {
+        "subject": "a staff introduction",
+        "composition": "staff member as the clear focal point, eye-level medium shot, friendly eye contact with the camera or customer",
+        "style": "professional portrait photography, approachable and trustworthy expression",
+    },
+    "instagram": {
+        "subject": "an eye-catching Instagram lifestyle post",
+        "composition": "dynamic but balanced composition with depth, subject slightly off-center, room for the feed crop",
+        "style": "vibrant lifestyle photography, shareable and aspirational mood",
+    },
+    "shop_interior": {
+        "subject": "a shop introduction",
+        "composition": "wide-angle view showing the layout and depth of the store, straight verticals",
+        "style": "architectural interior photography, clean and inviting",
+    },
+    "product": {
+        "subject": "a feature on a bicycle or accessory",
+        "composition": "product centered and in sharp focus, shallow depth of field for the background",
+        "style": "commercial product photography, attention to craftsmanship and detail",
+    },
+    "custom": {
+        "subject": "marketing",
+        "composition": "well-balanced composition at eye level",
+        "style": "high quality lifestyle photography",
+    },
+}
+
+# シチュエーションごとに登場させるバイクメーカー（推奨メーカーのみ）
+SITUATION_BIKE_BRANDS = {
+    "通勤・通学バイク提案": ["TOKYOBIKE", "BISYA", "MATE", "GIOS"],
+    "ロングライド相談": ["SURLY", "GIOS", "DEROSA", "WILIER", "BASSO"],
+    "バイク展示": ["DEROSA", "WILIER", "Cervelo", "BASSO", "GIOS"],
+}
+DEFAULT_BIKE_BRANDS = ["GIOS", "BASSO", "SCOTT", "DEROSA", "WILIER", "TOKYOBIKE"]
+WEAR_BRANDS = RECOMMENDED_WEAR_BRANDS[:6]
+
+ASPECT_RATIO_FRAMING = {
+    "1:1": "square framing",
+    "4:5": "vertical 4:5 framing",
+    "9:16": "tall vertical framing for stories, subject in the middle third",
+    "16:9": "wide horizontal framing with space on the sides",
+    "4:3": "horizontal 4:3 framing",
+    "3:2": "horizontal 3:2 framing",
+    "21:9": "cinematic ultra-wide framing",
+}
+
+
+def _pick(options: List[str], seed: str, count: int) -> List[str]:
+    """入力のハッシュから決定的に選ぶ（同じ入力なら常に同じ結果）"""
+    start = int(seed[:8], 16) % len(options)
+    return [options[(start + i) % len(options)] for i in range(min(count, len(options)))]
+
+
+def build_local_prompt(generation_input: Dict[str, Any]) -> str:
+    """
+    Claude APIを使わずにテーブルから英語プロンプトを組み立てる（遅延時・障害時の代替）
+    用途・背景・シチュエーション・人物（眼鏡の指定を含む）・雰囲気・画像内テキスト・サイズを反映し、
+    同じ入力からは常に同じプロンプトを生成する
+
+    Args:
+        generation_input: 画像生成の入力情報（build_claude_request と同じ）
+
+    Returns:
+        英語プロンプト
+    """
+    seed = canonical_hash(generation_input)
+    purpose = PURPOSE_STYLES.get(generation_input.get("purpose", "custom"), PURPOSE_STYLES["custom"])
+    situation = generation_input.get("situation", "試乗相談")
+    situation_info = SITUATION_PROMPTS.get(situation, SITUATION_PROMPTS["試乗相談"])
+
+    staff_name = generation_input.get("staff")
+    client_type = generation_input.get("client")
+    client_count = generation_input.get("client_count", 1)
+    client_desc = CLIENT_DESCRIPTIONS.get(client_type, "") if client_type else ""
+
+    mood = generation_input.get("mood", "ニュートラル")
+    mood_desc = MOOD_MODIFIERS.get(mood, MOOD_MODIFIERS["ニュートラル"])
+    use_background = generation_input.get("use_background", True)
+
+    parts = []
+    if staff_name or client_desc:
+        parts.append("All people in this image must be Japanese.")
+
+    parts.append(f"A photograph for {purpose['subject']} of cycleZ, a friendly sports bicycle shop in Japan: "
+                 f"{situation_info['scene']}.")
+
+    # 背景
+    if use_background:
+        parts.append("Use the provided background image as the setting, keeping the real shop interior recognizable.")
+    else:
+        parts.append("Use a clean, simple background (white, light gray, or soft gradient).")
+
+    # 人物
+    if staff_name:
+        parts.append("The staff member from the reference images is present, maintaining their exact appearance. "
+                     "Study all provided reference photos of this staff member from different angles to accurately "
+                     "reproduce their facial features, hairstyle, body type and skin tone.")
+        staff_glasses = generation_input.get("staff_glasses")
+        if staff_glasses == "眼鏡あり":
+            parts.append("The staff member is wearing glasses.")
+        elif staff_glasses:
+            parts.append("The staff member is not wearing glasses.")
+        parts.append("The staff wears casual, stylish shop attire.")
+    if client_desc:
+        if client_count == 1:
+            parts.append(f"A customer: {client_desc}.")
+        else:
+            parts.append(f"{client_count} customers: {client_desc} (a group of {client_count} people of similar type).")
+    if not staff_name and not client_desc:
+        parts.append("No people in the scene.")
+
+    # アクション・雰囲気
+    parts.append(f"Scene: {situation_info['action']}.")
+    parts.append(f"Mood: {situation_info['mood']}; {mood_desc}.")
+
+    # 推奨メーカー（入力ごとに決定的に選ぶ）
+    bikes = _pick(SITUATION_BIKE_BRANDS.get(situation, DEFAULT_BIKE_BRANDS), seed, 2)
+    parts.append(f"Bicycles shown are stylish {' and '.join(bikes)} models.")
+    if staff_name or client_desc:
+        wear = _pick(WEAR_BRANDS, seed[8:], 2)
+        parts.append(f"Any cycling apparel is casual and fashionable, in the style of {' or '.join(wear)}.")
+
+    # 画像内テキスト・追加指示（日本語のまま渡す）
+    image_text = generation_input.get("image_text")
+    if image_text:
+        parts.append(f'Include the text "{image_text}" in the image, clearly legible.')
+    additional = generation_input.get("additional_prompt")
+    if additional:
+        parts.append(f"Additional direction (in Japanese): {additional}.")
+
+    # 構図・スタイル
+    framing = ASPECT_RATIO_FRAMING.get(generation_input.get("aspect_ratio", "1:1"), "")
+    parts.append(f"Composition: {purpose['composition']}{', ' + framing if framing else ''}.")
+    parts.append(f"Style: {purpose['style']}, natural light, clean modern bicycle shop interior, "
+                 "casual cycling lifestyle, approachable and welcoming atmosphere, brand accent color red (#e63232).")
+
+    return " ".join(parts)
+
+
+def _check_prompt_caching() -> None:
+    """
+    ダミーのクライアントでプロンプトキャッシュ用のリクエスト形式を確認（APIは呼ばない）
+    - system が cache_control 付きのブロックになっていること
+    - 入力が異なってもキャッシュ対象の部分がバイト単位で同一であること
+    """
+    from types import SimpleNamespace
+    from api_clients import ClientRegistry, get_client_registry, set_client_registry
+
+    requests = []
+
+    class StandInMessages:
+        def create(self, **kwargs):
+            requests.append(kwargs)
+            # 1回目はキャッシュ書き込み、2回目以降は読み込みとして応答
+            first = len(requests) == 1
+            return SimpleNamespace(
+                content=[SimpleNamespace(text="All people in this image must be Japanese.")],
+                usage=SimpleNamespace(
+                    input_tokens=200,
+                    cache_creation_input_tokens=1500 if first else 0,
+                    cache_read_input_tokens=0 if first else 1500,
+                ),
+            )
+
+    class StandInRegistry(ClientRegistry):
+        def anthropic_client(self):
+            return SimpleNamespace(messages=StandInMessages())
+
+    original = get_client_registry()
+    set_client_registry(StandInRegistry())
+    try:
+        convert_prompt_with_claude({"situation": "試乗相談", "staff": "岡田"})
+        convert_prompt_with_claude({"situation": "バイク展示", "mood": "活気ある", "use_background": False})
+    finally:
+        set_client_registry(original)
+
+    first, second = requests
+    for request in requests:
+        system = request["system"]
+        assert isinstance(system, list) and len(system) == 1, system
+        assert system[0]["type"] == "text" and system[0]["cache_control"] == {"type": "ephemeral"}
+        assert BRAND_GUIDELINES in system[0]["text"]
+        assert request["messages"][0]["role"] == "user"
+    assert first["system"][0]["text"].encode("utf-8") == second["system"][0]["text"].encode("utf-8")
+    assert first["messages"] != second["messages"]
+    print(f"✅ プロンプトキャッシュのリクエスト形式: OK（{get_cache_usage()}）")
+
+
 if __name__ == "__main__":
     # テスト
     test_input = {
@@ -372,6 +834,14 @@ if __name__ == "__main__":
     print(build_simple_prompt(test_input))
     print()
 
+    print("=== ローカル生成プロンプト（レイテンシ予算超過時）===")
+    print(build_local_prompt(test_input))
+    print()
+
+    print("=== プロンプトキャッシュ（ダミークライアント）===")
+    _check_prompt_caching()
+    print()
+
     # Claude API テスト（APIキーが設定されている場合）
     if os.getenv("ANTHROPIC_API_KEY"):
         print("=== Claude API 最適化プロンプト ===")
@@ -0,0 +1,207 @@
+"""
+プロンプト変換の経路選択（レイテンシ予算）
+Claude APIでの変換をバックグラウンドで開始し、予算内に終わらない・失敗した場合は
+ローカルのテンプレート生成（build_local_prompt）に自動で切り替える
+切り替えた後もClaudeの変換は続行し、完了した結果はキャッシュに保存する（次回以降に使用）
+"""
+
+import os
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from metrics import log_event
+from prompt_converter import (
+    ClaudePromptStream, build_local_prompt, convert_prompt_cached_async, lookup_cached_prompt,
+    store_cached_prompt
+)
+
+# Claudeでの変換を待つ上限（秒）。待ち行列での待ち時間を含む
+DEFAULT_BUDGET_SECONDS = float(os.getenv("CLAUDE_LATENCY_BUDGET_SECONDS", "20"))
+
+# プロンプトの出どころ
+SOURCE_CACHE = "cache"
+SOURCE_SPECULATION = "speculation"
+SOURCE_CLAUDE = "claude"
+SOURCE_LOCAL = "local"
+
+# 予算超過後もClaudeの変換を続けられるよう、UIスレッドとは別のスレッドで実行
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prompt-router")
+
+
+def _route_info(source: str, started: float, reason: Optional[str] = None, **extra: Any) -> Dict[str, Any]:
+    info = {"source": source, "reason": reason, "seconds": time.perf_counter() - started}
+    info.update(extra)
+    return info
+
+
+def fallback_to_local(generation_input: Dict[str, Any], reason: str, started: Optional[float] = None) -> Tuple[str, Dict[str, Any]]:
+    """ローカル生成に切り替える（理由を表示して経路情報を返す）"""
+    log_event("prompt_fallback", f"🔀 ローカル生成に切り替え: {reason}", level="warning", reason=reason)
+    return build_local_prompt(generation_input), _route_info(SOURCE_LOCAL, started or time.perf_counter(), reason)
+
+
+class ClaudeRoute:
+    """
+    予算付きのClaude変換1件
+    start() 後に poll() / wait() で完了・予算超過・失敗を判定する
+    実行中は text で受信済みのテキストを参照できる
+
+    例:
+        route = ClaudeRoute(generation_input, budget_seconds=20).start()
+        prompt = route.wait(on_progress=lambda r: print(r.text))
+        print(route.info["source"])  # "claude" または "local"
+    """
+
+    def __init__(self, generation_input: Dict[str, Any], budget_seconds: float = DEFAULT_BUDGET_SECONDS):
+        self.generation_input = generation_input
+        self.budget_seconds = budget_seconds
+        self.stream = ClaudePromptStream(generation_input)
+        self.prompt: Optional[str] = None
+        self.info: Optional[Dict[str, Any]] = None
+        self._future = None
+        self._started = 0.0
+
+    def start(self, started: Optional[float] = None) -> "ClaudeRoute":
+        """
+        バックグラウンドで変換を開始（呼び出し元の request_context を引き継ぐ）
+        started を指定すると、その時点（time.perf_counter()）から予算を数える
+        """
+        self._started = started if started is not None else time.perf_counter()
+        self._future = _executor.submit(contextvars.copy_context().run, self._convert)
+        return self
+
+    def _convert(self) -> str:
+        for _ in self.stream:
+            pass
+        # 予算を超えてローカル生成に切り替えた後に完了した場合も保存し、次回はキャッシュから返す
+        store_cached_prompt(self.generation_input, self.stream.text)
+        return self.stream.text
+
+    @property
+    def text(self) -> str:
+        """これまでに受信したテキスト"""
+        return self.stream.text
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def poll(self) -> bool:
+        """経路が決まっていれば True（Claudeの完了・失敗・予算超過のいずれか）"""
+        if self.info is not None:
+            return True
+        if self._future.done():
+            try:
+                self.prompt = self._future.result()
+                self.info = _route_info(
+                    SOURCE_CLAUDE, self._started,
+                    time_to_first_token=self.stream.time_to_first_token,
+                    queue_seconds=self.stream.queue_seconds,
+                )
+            except Exception as e:
+                log_event("prompt_error", f"❌ Claude APIエラー: {e}", level="error", error=str(e))
+                self.prompt, self.info = fallback_to_local(self.generation_input, f"Claude APIエラー: {e}", self._started)
+        elif self.elapsed > self.budget_seconds:
+            self.prompt, self.info = fallback_to_local(
+                self.generation_input, f"予算 {self.budget_seconds:g}秒 を超過", self._started
+            )
+        return self.info is not None
+
+    def wait(self, on_progress: Optional[Callable[["ClaudeRoute"], None]] = None, interval: float = 0.1) -> str:
+        """経路が決まるまで待ってプロンプトを返す（on_progress は interval ごとに呼ばれる）"""
+        while not self.poll():
+            if on_progress is not None:
+                on_progress(self)
+            remaining = self.budget_seconds - self.elapsed
+            try:
+                self._future.result(timeout=max(0.0, min(interval, remaining)))
+            except Exception:
+                pass
+        return self.prompt
+
+
+def route_prompt(
+    generation_input: Dict[str, Any],
+    budget_seconds: float = DEFAULT_BUDGET_SECONDS,
+    force_refresh: bool = False,
+    on_progress: Optional[Callable[[ClaudeRoute], None]] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    キャッシュ → Claude（予算内）→ ローカル生成 の順でプロンプトを決める
+
+    Returns:
+        (プロンプト, {"source", "reason", "seconds", ...})
+        source は "cache" / "claude" / "local"
+    """
+    started = time.perf_counter()
+    if not force_refresh:
+        cached = lookup_cached_prompt(generation_input)
+        if cached is not None:
+            return cached, _route_info(SOURCE_CACHE, started)
+
+    route = ClaudeRoute(generation_input, budget_seconds).start()
+    prompt = route.wait(on_progress)
+    return prompt, route.info
+
+
+async def route_prompt_async(
+    generation_input: Dict[str, Any],
+    budget_seconds: float = DEFAULT_BUDGET_SECONDS,
+    force_refresh: bool = False
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    route_prompt の非同期版
+    予算を超えた場合もClaudeの変換タスクは取り消さず、完了時にキャッシュへ保存される
+    """
+    started = time.perf_counter()
+    task = asyncio.ensure_future(convert_prompt_cached_async(generation_input, force_refresh))
+    try:
+        prompt, from_cache = await asyncio.wait_for(asyncio.shield(task), budget_seconds)
+    except asyncio.TimeoutError:
+        # 取り残したタスクの例外が「未回収」として警告されないよう回収だけしておく
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return fallback_to_local(generation_input, f"予算 {budget_seconds:g}秒 を超過", started)
+    except Exception as e:
+        log_event("prompt_error", f"❌ Claude APIエラー: {e}", level="error", error=str(e))
+        return fallback_to_local(generation_input, f"Claude APIエラー: {e}", started)
+    return prompt, _route_info(SOURCE_CACHE if from_cache else SOURCE_CLAUDE, started)
+
+
+def _check_fallback() -> None:
+    """
+    代替クライアントでローカル生成への切り替えを確認（APIは呼ばない）
+    - fallback_to_local を直接呼ぶ
+    - 予算超過（同期・非同期）と Claude APIエラーで source が "local" になる
+    """
+    from fake_clients import FakeProfile, install_fake_clients, uninstall_fake_clients
+
+    os.environ.setdefault("ANTHROPIC_API_KEY", "fake")
+    os.environ.setdefault("GEMINI_API_KEY", "fake")
+    generation_input = {"situation": "試乗相談", "staff": "岡田", "client": "30代男性"}
+
+    prompt, info = fallback_to_local(generation_input, "確認")
+    assert prompt == build_local_prompt(generation_input) and info["source"] == SOURCE_LOCAL, info
+
+    install_fake_clients(claude=FakeProfile(latency=2.0, jitter=0.0))
+    try:
+        prompt, info = route_prompt(generation_input, budget_seconds=0.05, force_refresh=True)
+        assert info["source"] == SOURCE_LOCAL and prompt, info
+        prompt, info = asyncio.run(route_prompt_async(generation_input, budget_seconds=0.05, force_refresh=True))
+        assert info["source"] == SOURCE_LOCAL and prompt, info
+    finally:
+        uninstall_fake_clients()
+
+    install_fake_clients(claude=FakeProfile(latency=0.01, failure_rate=1.0))
+    try:
+        prompt, info = route_prompt(generation_input, budget_seconds=5, force_refresh=True)
+        assert info["source"] == SOURCE_LOCAL and "Claude APIエラー" in info["reason"], info
+    finally:
+        uninstall_fake_clients()
+    print("✅ ローカル生成への切り替え: OK（予算超過・非同期の予算超過・APIエラー）")
+
+
+if __name__ == "__main__":
+    _check_fallback()
@@ -0,0 +1,170 @@
+"""
+プロンプトの先読み（投機的実行）
+設定が一定時間変更されなければ、生成ボタンが押される前にClaude APIでプロンプト変換を開始する
+設定が変わった場合は古い先読みを中断し、結果は generation_input ごとにキャッシュへ保存する
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Optional
+
+from prompt_cache import canonical_hash
+from scheduler import PRIORITY_SPECULATIVE, request_context
+from metrics import log_event
+from prompt_converter import ClaudePromptStream, lookup_cached_prompt, store_cached_prompt
+
+# 設定が落ち着いたとみなすまでの待ち時間（秒）
+DEFAULT_DEBOUNCE_SECONDS = 1.5
+
+# 全セッション共通のワーカー（中断された先読みが終了するまでの間も新しい先読みを開始できるよう複数）
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prompt-speculator")
+
+
+class _Speculation:
+    """1件の先読み（generation_input 1つ分）"""
+
+    def __init__(self, generation_input: Dict[str, Any]):
+        self.generation_input = generation_input
+        self.key = canonical_hash(generation_input)
+        self.stale = threading.Event()
+        # デバウンスを打ち切る合図（中断時・生成ボタン押下時）
+        self.wake = threading.Event()
+        self.stream: Optional[ClaudePromptStream] = None
+        self.prompt: Optional[str] = None
+        self.error: Optional[str] = None
+        self.future: Optional[Future] = None
+
+
+class PromptSpeculator:
+    """
+    セッションごとの先読み管理
+    submit() を毎回の再実行で呼び、生成時に wait() で結果を受け取る
+    """
+
+    def __init__(self, debounce_seconds: float = DEFAULT_DEBOUNCE_SECONDS, session_id: str = "default"):
+        self.debounce_seconds = debounce_seconds
+        # スケジューラの待ち行列で使うセッションID（先読みは対話より低い優先度で実行）
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self._current: Optional[_Speculation] = None
+        self.started = 0
+        self.cancelled = 0
+        self.completed = 0
+
+    def submit(self, generation_input: Dict[str, Any]) -> None:
+        """現在の設定で先読みを予約（同じ設定なら何もしない、異なる設定なら古い先読みを中断）"""
+        key = canonical_hash(generation_input)
+        with self._lock:
+            if self._current is not None and self._current.key == key:
+                return
+            if self._current is not None:
+                self._cancel(self._current)
+
+            speculation = _Speculation(generation_input)
+            speculation.future = _executor.submit(self._run, speculation)
+            self._current = speculation
+
+    def cancel(self) -> None:
+        """実行中の先読みを中断"""
+        with self._lock:
+            if self._current is not None:
+                self._cancel(self._current)
+                self._current = None
+
+    def _cancel(self, speculation: _Speculation) -> None:
+        # self._lock を保持した状態で呼ぶ
+        if speculation.prompt is None and speculation.error is None:
+            self.cancelled += 1
+        speculation.stale.set()
+        speculation.wake.set()
+        speculation.future.cancel()
+
+    def _run(self, speculation: _Speculation) -> None:
+        # デバウンス: 待機中に設定が変わった場合は何もせず終了
+        speculation.wake.wait(self.debounce_seconds)
+        if speculation.stale.is_set():
+            return
+
+        cached = lookup_cached_prompt(speculation.generation_input)
+        if cached is not None:
+            speculation.prompt = cached
+            return
+
+        with self._lock:
+            self.started += 1
+        try:
+            speculation.stream = ClaudePromptStream(speculation.generation_input)
+            with request_context(self.session_id, PRIORITY_SPECULATIVE):
+                for _ in speculation.stream:
+                    # 設定が変わったらストリームを閉じて生成を打ち切る
+                    if speculation.stale.is_set():
+                        return
+            speculation.prompt = speculation.stream.text
+            store_cached_prompt(speculation.generation_input, speculation.prompt)
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            speculation.error = str(e)
+            log_event("prompt_speculation_error", f"⚠️ プロンプト先読みエラー: {e}", level="warning", error=str(e))
+
+    def _find(self, generation_input: Dict[str, Any]) -> Optional[_Speculation]:
+        with self._lock:
+            current = self._current
+        if current is not None and current.key == canonical_hash(generation_input):
+            return current
+        return None
+
+    def status(self, generation_input: Dict[str, Any]) -> str:
+        """先読みの状態: ready（完了）/ running（実行中）/ waiting（デバウンス中）/ idle（なし）"""
+        speculation = self._find(generation_input)
+        if speculation is None or speculation.error is not None:
+            return "idle"
+        if speculation.prompt is not None:
+            return "ready"
+        if speculation.stream is not None:
+            return "running"
+        return "waiting"
+
+    def partial_text(self, generation_input: Dict[str, Any]) -> str:
+        """実行中の先読みでこれまでに受信したテキスト"""
+        speculation = self._find(generation_input)
+        if speculation is None or speculation.stream is None:
+            return ""
+        return speculation.stream.text
+
+    def result(self, generation_input: Dict[str, Any]) -> Optional[str]:
+        """先読みが完了していればプロンプトを返す（未完了・対象外なら None）"""
+        speculation = self._find(generation_input)
+        return speculation.prompt if speculation is not None else None
+
+    def expedite(self, generation_input: Dict[str, Any]) -> bool:
+        """
+        同じ設定の先読みがあればデバウンスを打ち切ってすぐに開始させる
+
+        Returns:
+            対象の先読みがあるか（False の場合は呼び出し側で通常の変換を行う）
+        """
+        speculation = self._find(generation_input)
+        if speculation is None or speculation.error is not None:
+            return False
+        speculation.wake.set()
+        return True
+
+    def wait(self, generation_input: Dict[str, Any], timeout: Optional[float] = None) -> Optional[str]:
+        """
+        同じ設定の先読みの完了を待つ
+        先読みがない・失敗した・タイムアウトした場合は None（呼び出し側で通常の変換を行う）
+        """
+        if not self.expedite(generation_input):
+            return None
+        speculation = self._find(generation_input)
+        try:
+            speculation.future.result(timeout=timeout)
+        except Exception:
+            return None
+        return speculation.prompt
+
+    def stats(self) -> Dict[str, int]:
+        """開始・完了・中断した先読みの件数"""
+        with self._lock:
+            return {"started": self.started, "completed": self.completed, "cancelled": self.cancelled}
@@ -0,0 +1,214 @@
+"""
+参照画像の前処理モジュール
+EXIFの向き補正・長辺の縮小・再エンコードを行い、結果をキャッシュに保存
+元画像が変更されると自動的に作り直す
+"""
+
+import os
+import io
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+from metrics import log_event
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_CACHE_DIR = Path(__file__).parent / "cache" / "references"
+DEFAULT_MAX_EDGE = int(os.getenv("REFERENCE_MAX_EDGE", "1536"))
+DEFAULT_QUALITY = int(os.getenv("REFERENCE_JPEG_QUALITY", "85"))
+
+MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.gif': 'image/gif'
+}
+
+
+def _load_pil():
+    """Pillow は初めて画像を処理する時点で読み込む（Pillow未インストール時は元画像をそのまま送信）"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None, None
+    return Image, ImageOps
+
+
+def guess_mime_type(path: Path) -> str:
+    """拡張子からMIMEタイプを推定"""
+    return MIME_TYPES.get(Path(path).suffix.lower(), 'image/jpeg')
+
+
+class ReferencePreprocessor:
+    """
+    参照画像の前処理とキャッシュ
+    キャッシュキーは 元画像のパス・更新時刻・内容ハッシュ・処理設定 から作成
+    派生ファイル名は「元画像のパスのハッシュ_キャッシュキーのハッシュ」で、同じ元画像の古い派生ファイルは
+    ディスク上で探して削除する（再起動しても溜まらない）
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        max_edge: int = DEFAULT_MAX_EDGE,
+        quality: int = DEFAULT_QUALITY
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_edge = max_edge
+        self.quality = quality
+
+        self._lock = threading.Lock()
+        # パス -> (mtime_ns, size, content_hash)
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+
+    def content_hash(self, path: Path) -> str:
+        """元画像の内容ハッシュ（更新時刻・サイズが変わらない限り再計算しない）"""
+        path = Path(path)
+        stat = path.stat()
+        key = str(path.resolve())
+
+        with self._lock:
+            known = self._hashes.get(key)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()
+        with self._lock:
+            self._hashes[key] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    @staticmethod
+    def _source_id(path: Path) -> str:
+        return hashlib.sha256(str(path.resolve()).encode("utf-8")).hexdigest()[:16]
+
+    def _derived_path(self, path: Path, mtime_ns: int, digest: str) -> Path:
+        key = f"{path.resolve()}|{mtime_ns}|{digest}|{self.max_edge}|{self.quality}"
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return self.cache_dir / f"{self._source_id(path)}_{name}"
+
+    def _write(self, target: Path, data: bytes) -> None:
+        """派生ファイルを書き込み、同じ元画像の古い派生ファイル（元画像の変更前・設定の変更前）を削除"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # 同じ画像を複数スレッドが同時に処理しても一時ファイルが衝突しないようにする
+        tmp_path = target.with_name(f".tmp_{os.getpid()}_{threading.get_ident()}_{target.name}")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, target)
+
+        source_id = target.name.split("_", 1)[0]
+        for stale in self.cache_dir.glob(f"{source_id}_*"):
+            if stale.stem != target.stem:
+                stale.unlink(missing_ok=True)
+
+    def _encode(self, raw: bytes) -> Optional[Tuple[bytes, str]]:
+        """向き補正・縮小・再エンコード（失敗時は None）"""
+        Image, ImageOps = _load_pil()
+        if Image is None:
+            return None
+        try:
+            with Image.open(io.BytesIO(raw)) as img:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+
+                buffer = io.BytesIO()
+                has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+                if has_alpha:
+                    img.save(buffer, format="PNG", optimize=True)
+                    return buffer.getvalue(), "image/png"
+
+                img.convert("RGB").save(buffer, format="JPEG", quality=self.quality, optimize=True)
+                return buffer.getvalue(), "image/jpeg"
+        except Exception as e:
+            log_event("reference_preprocess_error", f"⚠️ 参照画像の前処理に失敗（元画像を使用）: {e}",
+                      level="warning", error=str(e))
+            return None
+
+    def prepare(self, path: Path) -> Dict[str, Any]:
+        """
+        参照画像を前処理して送信用データを返す
+
+        Returns:
+            Dict: {
+                "data": bytes,
+                "mime_type": str,
+                "content_hash": str (元画像の内容ハッシュ),
+                "original_bytes": int,
+                "prepared_bytes": int,
+                "cached": bool (キャッシュから取得したか)
+            }
+        """
+        path = Path(path)
+        stat = path.stat()
+        digest = self.content_hash(path)
+        derived = self._derived_path(path, stat.st_mtime_ns, digest)
+
+        result = {
+            "content_hash": digest,
+            "original_bytes": stat.st_size,
+            "cached": False,
+        }
+
+        for candidate, mime_type in ((derived.with_suffix(".jpg"), "image/jpeg"),
+                                     (derived.with_suffix(".png"), "image/png")):
+            if candidate.exists():
+                data = candidate.read_bytes()
+                result.update(data=data, mime_type=mime_type, prepared_bytes=len(data), cached=True)
+                return result
+
+        # 再エンコードしても小さくならなかった画像は、元画像を使う目印（空ファイル）だけを保存してある
+        original_marker = derived.with_suffix(".original")
+        if original_marker.exists():
+            raw = path.read_bytes()
+            result.update(data=raw, mime_type=guess_mime_type(path), prepared_bytes=len(raw), cached=True)
+            return result
+
+        raw = path.read_bytes()
+        encoded = self._encode(raw)
+        if encoded is None:
+            # 読み込めない・Pillow がない場合は記録しない（次回もう一度試す）
+            result.update(data=raw, mime_type=guess_mime_type(path), prepared_bytes=len(raw))
+            return result
+
+        # 再エンコードで小さくならない場合は元画像をそのまま使う（次回からは Pillow で処理しない）
+        if len(encoded[0]) >= len(raw):
+            self._write(original_marker, b"")
+            result.update(data=raw, mime_type=guess_mime_type(path), prepared_bytes=len(raw))
+            return result
+
+        data, mime_type = encoded
+        self._write(derived.with_suffix(".png" if mime_type == "image/png" else ".jpg"), data)
+        result.update(data=data, mime_type=mime_type, prepared_bytes=len(data))
+        return result
+
+    def prepare_many(self, paths: List[Path]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        複数の参照画像を前処理
+
+        Returns:
+            (前処理結果のリスト, {"count", "original_bytes", "sent_bytes", "saved_bytes", "hashes"})
+        """
+        prepared = [self.prepare(path) for path in paths]
+        original_bytes = sum(item["original_bytes"] for item in prepared)
+        sent_bytes = sum(item["prepared_bytes"] for item in prepared)
+        stats = {
+            "count": len(prepared),
+            "original_bytes": original_bytes,
+            "sent_bytes": sent_bytes,
+            "saved_bytes": original_bytes - sent_bytes,
+            "hashes": [item["content_hash"] for item in prepared],
+        }
+        return prepared, stats
+
+
+_default_preprocessor: Optional[ReferencePreprocessor] = None
+_default_preprocessor_lock = threading.Lock()
+
+
+def get_reference_preprocessor() -> ReferencePreprocessor:
+    """プロセス共通のデフォルト前処理インスタンスを取得"""
+    global _default_preprocessor
+    with _default_preprocessor_lock:
+        if _default_preprocessor is None:
+            _default_preprocessor = ReferencePreprocessor()
+        return _default_preprocessor
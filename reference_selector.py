@@ -0,0 +1,266 @@
+"""
+参照画像の自動選択
+スタッフの写真が増えても送信サイズが増え続けないよう、送信サイズの予算内で互いに似ていない写真を選ぶ
+写真ごとに知覚ハッシュ（dHash）と色・構図の特徴ベクトルを NumPy で計算してキャッシュし、
+ほぼ同じ写真は1枚にまとめ、残りは「すでに選んだ写真から最も離れている写真」から順に予算まで加える
+選ばなかった写真には理由（ほぼ同じ写真がある・予算超過・枚数の上限）を記録する
+"""
+
+import io
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from reference_preprocessor import ReferencePreprocessor, get_reference_preprocessor
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / "cache" / "reference_features"
+# 参照画像（スタッフ写真）の送信サイズの予算と枚数の上限
+DEFAULT_BYTE_BUDGET = int(float(os.getenv("REFERENCE_BYTE_BUDGET_MB", "4")) * 1024 * 1024)
+DEFAULT_MAX_COUNT = int(os.getenv("REFERENCE_MAX_COUNT", "8"))
+# dHash（64ビット）の違いがこのビット数以下なら、ほぼ同じ写真として扱う
+NEAR_DUPLICATE_BITS = int(os.getenv("REFERENCE_DUPLICATE_BITS", "6"))
+
+# 写真どうしの距離の重み（知覚ハッシュ・色の分布・明暗の配置）
+HASH_WEIGHT = 0.5
+COLOR_WEIGHT = 0.25
+LAYOUT_WEIGHT = 0.25
+
+# 選ばなかった理由
+REASON_DUPLICATE = "near_duplicate"
+REASON_BUDGET = "budget"
+REASON_LIMIT = "limit"
+REASON_UNREADABLE = "unreadable"
+
+REASON_LABELS = {
+    REASON_DUPLICATE: "ほぼ同じ写真を選択済み",
+    REASON_BUDGET: "送信サイズの予算を超える",
+    REASON_LIMIT: "枚数の上限（選んだ写真と似ている）",
+    REASON_UNREADABLE: "画像を読み込めない",
+}
+
+
+def compute_features(data: bytes) -> Dict[str, Any]:
+    """
+    画像データの特徴（32x32 に縮小して計算）
+
+    Returns:
+        {"dhash": 16桁の16進数, "color": 64次元（RGB 各4段階の分布）, "layout": 64次元（8x8 の明暗、正規化済み）}
+    """
+    # Pillow・NumPy は特徴を計算する時点で読み込む（起動時間を増やさない）
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        # JPEG は縮小して読み込む（全画素をデコードしない）
+        img.draft("RGB", (128, 128))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        small = img.resize((32, 32), Image.BILINEAR)
+        hash_source = img.convert("L").resize((9, 8), Image.BILINEAR)
+
+    # dHash: 横に隣り合う画素の明るさの大小
+    gray9 = np.asarray(hash_source, dtype=np.int16)
+    bits = (gray9[:, 1:] > gray9[:, :-1]).ravel()
+    dhash = int("".join("1" if bit else "0" for bit in bits), 2)
+
+    rgb = np.asarray(small, dtype=np.float32) / 255.0
+    levels = np.minimum((rgb * 4).astype(np.int64), 3)
+    color = np.bincount((levels[..., 0] * 16 + levels[..., 1] * 4 + levels[..., 2]).ravel(), minlength=64)
+    color = color / color.sum()
+
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    layout = gray.reshape(8, 4, 8, 4).mean(axis=(1, 3)).ravel()
+    layout = layout - layout.mean()
+    norm = float(np.linalg.norm(layout))
+    layout = layout / norm if norm > 0 else layout
+
+    return {"dhash": f"{dhash:016x}", "color": color.round(5).tolist(), "layout": layout.round(5).tolist()}
+
+
+def distance_matrix(features: List[Dict[str, Any]]) -> "Tuple[np.ndarray, np.ndarray]":
+    """
+    写真どうしの距離（0: 同じ 〜 1: まったく違う）
+
+    Returns:
+        (距離 [n, n], dHash の違いのビット数 [n, n])
+    """
+    import numpy as np
+
+    bits = np.array([[c == "1" for c in f"{int(item['dhash'], 16):064b}"] for item in features], dtype=bool)
+    hamming = (bits[:, None, :] != bits[None, :, :]).sum(axis=2)
+    color = np.array([item["color"] for item in features], dtype=np.float32)
+    layout = np.array([item["layout"] for item in features], dtype=np.float32)
+
+    color_distance = 0.5 * np.abs(color[:, None, :] - color[None, :, :]).sum(axis=2)
+    layout_distance = (1.0 - np.clip(layout @ layout.T, -1.0, 1.0)) / 2.0
+    distance = HASH_WEIGHT * hamming / 64.0 + COLOR_WEIGHT * color_distance + LAYOUT_WEIGHT * layout_distance
+    return distance, hamming
+
+
+class ReferenceSelector:
+    """
+    参照画像の特徴のキャッシュと選択
+    特徴は送信用に前処理した画像（ReferencePreprocessor）から計算し、元画像の内容ハッシュごとにディスクに保存する
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        preprocessor: Optional[ReferencePreprocessor] = None
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.preprocessor = preprocessor or get_reference_preprocessor()
+        self._lock = threading.Lock()
+        # パス -> (mtime_ns, size, 特徴)
+        self._features: Dict[str, Tuple[int, int, Dict[str, Any]]] = {}
+        self.computed = 0
+
+    def _cache_path(self, content_hash: str) -> Path:
+        key = f"{content_hash}|{self.preprocessor.max_edge}|{self.preprocessor.quality}"
+        return self.cache_dir / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}.json"
+
+    def features(self, path: Path) -> Dict[str, Any]:
+        """
+        写真の特徴と送信サイズ（元画像が変更されていなければキャッシュを使う）
+
+        Returns:
+            compute_features の結果に "bytes"（前処理後の送信サイズ）を加えた辞書
+        """
+        path = Path(path)
+        stat = path.stat()
+        key = str(path.resolve())
+        with self._lock:
+            known = self._features.get(key)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+
+        cache_path = self._cache_path(self.preprocessor.content_hash(path))
+        try:
+            features = json.loads(cache_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            prepared = self.preprocessor.prepare(path)
+            features = dict(compute_features(prepared["data"]), bytes=prepared["prepared_bytes"])
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(f".tmp_{threading.get_ident()}_{cache_path.name}")
+            tmp_path.write_text(json.dumps(features), encoding="utf-8")
+            os.replace(tmp_path, cache_path)
+            with self._lock:
+                self.computed += 1
+
+        with self._lock:
+            self._features[key] = (stat.st_mtime_ns, stat.st_size, features)
+        return features
+
+    def select(
+        self,
+        paths: List[Path],
+        byte_budget: int = DEFAULT_BYTE_BUDGET,
+        max_count: int = DEFAULT_MAX_COUNT
+    ) -> Dict[str, Any]:
+        """
+        送信サイズの予算内で互いに似ていない写真を選ぶ
+
+        1枚目は他の写真との距離の合計が最も小さい（最も代表的な）写真、
+        以降は選んだ写真との最小距離が最も大きい写真から順に、予算と枚数の上限まで加える
+
+        Returns:
+            {
+                "selected": List[Path]（元の並び順）,
+                "dropped": List[{"path", "reason", "similar_to", "distance", "bytes"}],
+                "selected_bytes", "total_bytes", "budget_bytes", "max_count",
+                "over_budget": bool（予算に収まる写真がなく、最小の1枚だけを選んだ場合）
+            }
+        """
+        import numpy as np
+
+        paths = [Path(path) for path in paths]
+        readable, features, dropped = [], [], []
+        for path in paths:
+            try:
+                features.append(self.features(path))
+                readable.append(path)
+            except Exception as e:
+                dropped.append({"path": path, "reason": REASON_UNREADABLE, "similar_to": None,
+                                "distance": None, "bytes": 0, "error": str(e)})
+
+        summary = {
+            "selected": [], "dropped": dropped, "selected_bytes": 0,
+            "total_bytes": sum(item["bytes"] for item in features),
+            "budget_bytes": byte_budget, "max_count": max_count, "over_budget": False,
+        }
+        if not readable:
+            return summary
+
+        sizes = np.array([item["bytes"] for item in features], dtype=np.int64)
+        distance, hamming = distance_matrix(features)
+        remaining = set(range(len(readable)))
+        reasons: Dict[int, Tuple[str, Optional[int]]] = {}
+
+        # 1枚目: 予算に収まる写真のうち最も代表的なもの（収まるものがなければ最小の写真）
+        affordable = [i for i in remaining if sizes[i] <= byte_budget]
+        if affordable:
+            first = min(affordable, key=lambda i: float(distance[i].sum()))
+        else:
+            first = int(np.argmin(sizes))
+            summary["over_budget"] = True
+        chosen = [first]
+        remaining.discard(first)
+        used = int(sizes[first])
+
+        while remaining:
+            nearest = {i: min(chosen, key=lambda j: float(distance[i, j])) for i in remaining}
+            # ほぼ同じ写真はすでに選んだもので足りる
+            for i in list(remaining):
+                if hamming[i, nearest[i]] <= NEAR_DUPLICATE_BITS:
+                    reasons[i] = (REASON_DUPLICATE, nearest[i])
+                    remaining.discard(i)
+            for i in list(remaining):
+                if used + sizes[i] > byte_budget:
+                    reasons[i] = (REASON_BUDGET, nearest[i])
+                    remaining.discard(i)
+            if not remaining:
+                break
+            if len(chosen) >= max_count:
+                for i in remaining:
+                    reasons[i] = (REASON_LIMIT, nearest[i])
+                break
+            best = max(remaining, key=lambda i: float(distance[i, nearest[i]]))
+            chosen.append(best)
+            remaining.discard(best)
+            used += int(sizes[best])
+
+        summary["selected"] = [readable[i] for i in sorted(chosen)]
+        summary["selected_bytes"] = used
+        summary["dropped"] = [
+            {
+                "path": readable[i],
+                "reason": reason,
+                "similar_to": readable[j] if j is not None else None,
+                "distance": float(distance[i, j]) if j is not None else None,
+                "bytes": int(sizes[i]),
+            }
+            for i, (reason, j) in sorted(reasons.items())
+        ] + dropped
+        return summary
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"cached": len(self._features), "computed": self.computed}
+
+
+_default_selector: Optional[ReferenceSelector] = None
+_default_selector_lock = threading.Lock()
+
+
+def get_reference_selector() -> ReferenceSelector:
+    """プロセス共通のデフォルト選択インスタンスを取得"""
+    global _default_selector
+    with _default_selector_lock:
+        if _default_selector is None:
+            _default_selector = ReferenceSelector()
+        return _default_selector
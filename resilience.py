@@ -0,0 +1,470 @@
+"""
+API呼び出しの耐障害レイヤー
+試行ごとの期限・ジッター付き指数バックオフによる再試行・遅いリクエストの重複送信（ヘッジ）・
+サーキットブレーカー（バックエンドが不調な間は即座に失敗させる）をまとめて提供する
+試行回数とレイテンシの分布を記録し、状態表示に使う
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import log_event
+from scheduler import get_scheduler
+
+# 再試行する HTTP ステータス（タイムアウト・レート制限・サーバーエラー）
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return float(value)
+
+
+class AttemptTimeoutError(TimeoutError):
+    """1回の試行が期限内に終わらなかった"""
+
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いているため呼び出しを行わなかった"""
+
+
+class AbandonedAttemptsError(RuntimeError):
+    """期限切れで結果を捨てた試行がまだ実行中のため、新しい試行を送らなかった"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """再試行で回復する可能性があるエラーか"""
+    if isinstance(error, (CircuitOpenError, AbandonedAttemptsError)):
+        return False
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    # google-genai の APIError は code、httpx / anthropic は status_code を持つ
+    status = getattr(error, "code", None)
+    if not isinstance(status, int):
+        status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    # httpx の通信エラー（接続切断・読み込みタイムアウトなど）
+    return type(error).__module__.split(".")[0] in ("httpx", "httpcore")
+
+
+class ResiliencePolicy:
+    """
+    再試行・ヘッジの設定
+    環境変数 <PREFIX>_ATTEMPT_TIMEOUT_SECONDS などで上書きできる
+    """
+
+    def __init__(
+        self,
+        attempt_timeout: float = 120.0,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 20.0,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20,
+        breaker_failures: int = 5,
+        breaker_reset_seconds: float = 60.0,
+        max_abandoned: int = 4
+    ):
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # 例: 0.95 なら過去の成功レイテンシの p95 を超えた時点で同じリクエストをもう1本送る（None で無効）
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_seconds = breaker_reset_seconds
+        # 同期呼び出しで期限切れ後も実行中の試行の上限（超えると再試行・新しい呼び出しを送らない）
+        # 期限切れの試行はスレッドを止められず、応答が返れば課金されるため、再試行すると最大で
+        # (max_abandoned + 実行中) 件分が重複して課金される可能性がある
+        self.max_abandoned = max_abandoned
+
+    @classmethod
+    def from_env(cls, prefix: str, **defaults: Any) -> "ResiliencePolicy":
+        policy = cls(**defaults)
+        policy.attempt_timeout = _env_float(f"{prefix}_ATTEMPT_TIMEOUT_SECONDS", policy.attempt_timeout)
+        policy.max_attempts = int(_env_float(f"{prefix}_MAX_ATTEMPTS", policy.max_attempts))
+        policy.hedge_percentile = _env_float(f"{prefix}_HEDGE_PERCENTILE", policy.hedge_percentile)
+        policy.breaker_failures = int(_env_float(f"{prefix}_BREAKER_FAILURES", policy.breaker_failures))
+        policy.breaker_reset_seconds = _env_float(f"{prefix}_BREAKER_RESET_SECONDS", policy.breaker_reset_seconds)
+        policy.max_abandoned = int(_env_float(f"{prefix}_MAX_ABANDONED", policy.max_abandoned))
+        return policy
+
+    def backoff(self, attempt: int) -> float:
+        """attempt 回目の失敗後の待ち時間（フルジッター付き指数バックオフ）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    連続失敗数で開閉するサーキットブレーカー
+    closed（通常）→ 連続 failure_threshold 回失敗で open（即座に失敗）→
+    reset_seconds 経過後に half_open（1件だけ試行）→ 成功で closed / 失敗で open
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.rejections = 0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        """呼び出し可能か確認（開いている場合は CircuitOpenError）"""
+        with self._lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.reset_seconds - time.monotonic()
+                if remaining > 0:
+                    self.rejections += 1
+                    raise CircuitOpenError(f"APIが不安定なため呼び出しを停止中です（{remaining:.0f}秒後に再開）")
+                self.state = "half_open"
+                self._probe_in_flight = False
+
+            if self.state == "half_open":
+                if self._probe_in_flight:
+                    self.rejections += 1
+                    raise CircuitOpenError("APIの回復を確認中です。しばらくしてから再度お試しください")
+                self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """直近の成功レイテンシ（秒）の分布"""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """p（0〜1）パーセンタイル（サンプルがなければ None）"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class ResilientCaller:
+    """
+    1つのバックエンド（Gemini など）への呼び出しに再試行・ヘッジ・サーキットブレーカーを適用
+    同期版 call() と非同期版 call_async() で状態（ブレーカー・レイテンシ・統計）を共有する
+
+    非同期版は期限切れの試行をキャンセルする（通信も切断される）が、同期版はスレッドを止められない。
+    期限切れの試行は結果を捨てたまま完了まで動き続け、その間に再試行した分と重複して課金されうる。
+    fn 側で通信のタイムアウトを試行の期限に合わせたうえで、実行中のまま残った試行が
+    policy.max_abandoned 件に達したら再試行・新しい呼び出しを止める（AbandonedAttemptsError）
+    """
+
+    def __init__(self, name: str, policy: Optional[ResiliencePolicy] = None):
+        self.name = name
+        self.policy = policy or ResiliencePolicy()
+        self.breaker = CircuitBreaker(self.policy.breaker_failures, self.policy.breaker_reset_seconds)
+        self.latency = LatencyTracker()
+
+        self._lock = threading.Lock()
+        # 同期呼び出しの期限・ヘッジ用（期限切れの試行は結果を捨て、スレッドは完了まで動き続ける）
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix=f"{name}-request")
+        # 期限切れ後も実行中の試行（完了すると取り除く）
+        self._abandoned: set = set()
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+        self.abandoned_rejections = 0
+        self.failures = 0
+
+    def _count(self, **increments: int) -> None:
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def _hedge_slot(self, model: Optional[str]) -> Tuple[bool, Optional[Any]]:
+        """
+        ヘッジ用の実行枠をスケジューラから取得（待たない。レート制限・同時実行数に空きがなければ送らない）
+
+        Returns:
+            (ヘッジを送るか, 返却する実行枠。スケジューラで管理していないバックエンドは None)
+        """
+        scheduler = get_scheduler()
+        try:
+            ticket = scheduler.acquire(self.name, model, blocking=False)
+        except KeyError:
+            return True, None
+        if ticket is None:
+            self._count(hedges_skipped=1)
+            return False, None
+        return True, ticket
+
+    def _abandon(self, futures: List[Future]) -> None:
+        """期限切れの試行を記録（キャンセルできなかったものは完了するまで数える）"""
+        for future in futures:
+            if future.cancel():
+                continue
+            with self._lock:
+                self._abandoned.add(future)
+            future.add_done_callback(self._forget_abandoned)
+
+    def _forget_abandoned(self, future: Future) -> None:
+        with self._lock:
+            self._abandoned.discard(future)
+
+    def _abandoned_count(self) -> int:
+        with self._lock:
+            return len(self._abandoned)
+
+    def _check_abandoned(self) -> None:
+        """期限切れの試行が上限まで残っている場合は新しい試行を送らない"""
+        with self._lock:
+            abandoned = len(self._abandoned)
+            if abandoned < self.policy.max_abandoned:
+                return
+            self.abandoned_rejections += 1
+        raise AbandonedAttemptsError(
+            f"{self.name}: 期限切れのリクエストが{abandoned}件まだ実行中のため、新しいリクエストを見合わせました"
+        )
+
+    def _hedge_delay(self) -> Optional[float]:
+        p = self.policy.hedge_percentile
+        if not p or self.latency.count() < self.policy.hedge_min_samples:
+            return None
+        delay = self.latency.percentile(p)
+        return delay if delay is not None and delay < self.policy.attempt_timeout else None
+
+    def _handle_failure(self, error: BaseException, attempt: int, info: Dict[str, Any]) -> Optional[float]:
+        """失敗を記録し、再試行する場合は待ち時間を返す（再試行しない場合は None）"""
+        info["errors"].append(f"{type(error).__name__}: {error}")
+        if isinstance(error, AttemptTimeoutError):
+            self._count(timeouts=1)
+        if not is_retryable(error):
+            # バックエンドは応答している（リクエスト側の問題）のでブレーカーには成功として扱う
+            self.breaker.record_success()
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.policy.max_attempts:
+            return None
+        if isinstance(error, AttemptTimeoutError) and self._abandoned_count() >= self.policy.max_abandoned:
+            # 期限切れの試行がまだ課金対象として動いているため、さらに重複させない
+            return None
+        self._count(retries=1)
+        delay = self.policy.backoff(attempt)
+        log_event(
+            "retry", f"🔁 {self.name}: 再試行 {attempt + 1}/{self.policy.max_attempts}（{delay:.1f}秒後）: {error}",
+            level="warning", backend=self.name, attempt=attempt + 1, delay_seconds=round(delay, 2), error=str(error)
+        )
+        return delay
+
+    def _finish(self, started: float, info: Dict[str, Any], attempt_started: float) -> None:
+        self.breaker.record_success()
+        self.latency.record(time.perf_counter() - attempt_started)
+        info["elapsed"] = time.perf_counter() - started
+
+    def call(self, fn: Callable[[], Any], model: Optional[str] = None) -> Tuple[Any, Dict[str, Any]]:
+        """
+        fn() を再試行・ヘッジ付きで実行
+        ヘッジはスケジューラの実行枠（model 単位の上限を含む）を取得できた場合だけ送る
+
+        Returns:
+            (fn の戻り値, {"attempts", "hedged", "hedge_won", "errors", "elapsed"})
+
+        Raises:
+            最後の試行のエラー、またはブレーカーが開いている場合は CircuitOpenError
+        """
+        info = {"attempts": 0, "hedged": False, "hedge_won": False, "errors": []}
+        started = time.perf_counter()
+        self._count(calls=1)
+
+        for attempt in range(1, self.policy.max_attempts + 1):
+            try:
+                self._check_abandoned()
+            except AbandonedAttemptsError as e:
+                info["errors"].append(f"{type(e).__name__}: {e}")
+                self._count(failures=1)
+                raise
+            self.breaker.before_call()
+            attempt_started = time.perf_counter()
+            try:
+                result = self._attempt_sync(fn, info, model)
+            except Exception as e:
+                delay = self._handle_failure(e, attempt, info)
+                if delay is None:
+                    self._count(failures=1)
+                    raise
+                time.sleep(delay)
+                continue
+            self._finish(started, info, attempt_started)
+            return result, info
+
+    def _attempt_sync(self, fn: Callable[[], Any], info: Dict[str, Any], model: Optional[str] = None) -> Any:
+        deadline = time.perf_counter() + self.policy.attempt_timeout
+        primary = self._executor.submit(fn)
+        pending: List[Future] = [primary]
+        self._count(attempts=1)
+        info["attempts"] += 1
+
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is not None:
+            done, _ = wait(pending, timeout=hedge_delay)
+            allowed, ticket = self._hedge_slot(model) if not done else (False, None)
+            if allowed:
+                hedge = self._executor.submit(fn)
+                if ticket is not None:
+                    hedge.add_done_callback(lambda _: get_scheduler().release(ticket))
+                pending.append(hedge)
+                self._count(attempts=1, hedges=1)
+                info["attempts"] += 1
+                info["hedged"] = True
+
+        error: Optional[BaseException] = None
+        while pending:
+            done, _ = wait(pending, timeout=max(0.0, deadline - time.perf_counter()), return_when=FIRST_COMPLETED)
+            if not done:
+                self._abandon(pending)
+                raise AttemptTimeoutError(f"{self.name}: {self.policy.attempt_timeout:g}秒以内に応答がありませんでした")
+            for future in done:
+                pending.remove(future)
+                if future.exception() is None:
+                    if future is not primary:
+                        self._count(hedge_wins=1)
+                        info["hedge_won"] = True
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def call_async(self, fn: Callable[[], Awaitable[Any]], model: Optional[str] = None) -> Tuple[Any, Dict[str, Any]]:
+        """call() の非同期版（fn はコルーチンを返す関数。ヘッジで重複した試行は完了後にキャンセル）"""
+        info = {"attempts": 0, "hedged": False, "hedge_won": False, "errors": []}
+        started = time.perf_counter()
+        self._count(calls=1)
+
+        for attempt in range(1, self.policy.max_attempts + 1):
+            self.breaker.before_call()
+            attempt_started = time.perf_counter()
+            try:
+                result = await self._attempt_async(fn, info, model)
+            except Exception as e:
+                delay = self._handle_failure(e, attempt, info)
+                if delay is None:
+                    self._count(failures=1)
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._finish(started, info, attempt_started)
+            return result, info
+
+    async def _attempt_async(self, fn: Callable[[], Awaitable[Any]], info: Dict[str, Any],
+                             model: Optional[str] = None) -> Any:
+        deadline = time.perf_counter() + self.policy.attempt_timeout
+        primary = asyncio.ensure_future(fn())
+        pending = {primary}
+        self._count(attempts=1)
+        info["attempts"] += 1
+
+        try:
+            hedge_delay = self._hedge_delay()
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                allowed, ticket = self._hedge_slot(model) if not done else (False, None)
+                if allowed:
+                    hedge = asyncio.ensure_future(fn())
+                    if ticket is not None:
+                        hedge.add_done_callback(lambda _: get_scheduler().release(ticket))
+                    pending.add(hedge)
+                    self._count(attempts=1, hedges=1)
+                    info["attempts"] += 1
+                    info["hedged"] = True
+
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, deadline - time.perf_counter()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise AttemptTimeoutError(f"{self.name}: {self.policy.attempt_timeout:g}秒以内に応答がありませんでした")
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count(hedge_wins=1)
+                            info["hedge_won"] = True
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """呼び出し・試行・再試行・ヘッジの件数、ブレーカーの状態、レイテンシ分布"""
+        with self._lock:
+            counts = {
+                "calls": self.calls,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedges_skipped": self.hedges_skipped,
+                "abandoned": len(self._abandoned),
+                "abandoned_rejections": self.abandoned_rejections,
+                "failures": self.failures,
+            }
+        counts.update(
+            circuit=self.breaker.state,
+            circuit_rejections=self.breaker.rejections,
+            p50=self.latency.percentile(0.50),
+            p95=self.latency.percentile(0.95),
+            p99=self.latency.percentile(0.99),
+        )
+        return counts
+
+
+_callers: Dict[str, ResilientCaller] = {}
+_callers_lock = threading.Lock()
+
+
+def get_resilient_caller(name: str, policy: Optional[ResiliencePolicy] = None) -> ResilientCaller:
+    """
+    バックエンドごとの共有インスタンスを取得（初回の policy だけが使われる）
+    policy を省略した場合は環境変数 <NAME>_ATTEMPT_TIMEOUT_SECONDS などから設定する
+    """
+    with _callers_lock:
+        if name not in _callers:
+            _callers[name] = ResilientCaller(name, policy or ResiliencePolicy.from_env(name.upper()))
+        return _callers[name]
@@ -0,0 +1,104 @@
+"""
+生成結果の受け渡し用バッファ
+Gemini のレスポンスに含まれる画像データ（bytes）をコピーせずに memoryview として保持し、
+生成直後の表示とダウンロードでファイルを読み直さずに同じバッファを使う
+保持するのは直近の結果だけ（合計サイズが上限を超えたら古いものから手放す）
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# 保持する画像データの合計サイズの上限（MB）
+DEFAULT_MAX_BYTES = int(os.getenv("RESULT_BUFFER_MB", "256")) * 1024 * 1024
+
+
+def as_bytes(buffer: memoryview) -> bytes:
+    """memoryview が bytes 全体を指している場合は元の bytes をそのまま返す（コピーしない）"""
+    if isinstance(buffer.obj, bytes) and buffer.nbytes == len(buffer.obj):
+        return buffer.obj
+    return buffer.tobytes()
+
+
+class ResultBuffers:
+    """画像ID -> 画像データ（memoryview）の LRU"""
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._buffers: "OrderedDict[str, memoryview]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_read_bytes = 0
+
+    def put(self, image_id: str, data: bytes) -> memoryview:
+        """画像データを保持して memoryview を返す（data はコピーしない）"""
+        buffer = data if isinstance(data, memoryview) else memoryview(data)
+        with self._lock:
+            previous = self._buffers.pop(image_id, None)
+            if previous is not None:
+                self.total_bytes -= previous.nbytes
+            self._buffers[image_id] = buffer
+            self.total_bytes += buffer.nbytes
+            # 上限を超えた分は古いものから手放す（今入れたものは残す）
+            while self.total_bytes > self.max_bytes and len(self._buffers) > 1:
+                _, evicted = self._buffers.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+        return buffer
+
+    def get(self, image_id: str) -> Optional[memoryview]:
+        with self._lock:
+            buffer = self._buffers.get(image_id)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self._buffers.move_to_end(image_id)
+            self.hits += 1
+            return buffer
+
+    def read(self, record: Dict[str, Any]) -> bytes:
+        """
+        表示・ダウンロード用の画像データ（OutputStore のレコード）
+        保持していればそのバッファの bytes を返し、なければファイルを1回だけ読んで保持する
+        """
+        buffer = self.get(record["id"])
+        if buffer is not None:
+            return as_bytes(buffer)
+        with open(record["absolute_path"], "rb") as f:
+            data = f.read()
+        with self._lock:
+            self.disk_read_bytes += len(data)
+        self.put(record["id"], data)
+        return data
+
+    def discard(self, image_id: str) -> None:
+        with self._lock:
+            buffer = self._buffers.pop(image_id, None)
+            if buffer is not None:
+                self.total_bytes -= buffer.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._buffers),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_read_bytes": self.disk_read_bytes,
+            }
+
+
+_default_result_buffers: Optional[ResultBuffers] = None
+_default_result_buffers_lock = threading.Lock()
+
+
+def get_result_buffers() -> ResultBuffers:
+    """プロセス共通のバッファ（ジョブのワーカースレッドと画面の間で共有する）"""
+    global _default_result_buffers
+    with _default_result_buffers_lock:
+        if _default_result_buffers is None:
+            _default_result_buffers = ResultBuffers()
+        return _default_result_buffers
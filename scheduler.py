@@ -0,0 +1,378 @@
+"""
+API呼び出しのスケジューラ（プロセス全体で共有）
+APIごと・モデルごとのトークンバケットでリクエスト数を制限し、同時実行数の上限を超えた分は待ち行列に入れる
+待ち行列は優先度（対話 > 先読み > バッチ）ごとに、セッション間で順番に割り当てる（1つのセッションが独占しない）
+待ち順と予想待ち時間を取得でき、UIでスピナーの代わりに表示する
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# 優先度（小さいほど先に実行）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SPECULATIVE = 1
+PRIORITY_BATCH = 2
+
+# APIごとのデフォルト設定（環境変数 <API>_RPM / <API>_MAX_CONCURRENT / <API>_BURST で上書き可能）
+# burst（連続で送れる件数）は未指定の場合 max_concurrent 以上にする。
+# rpm / 6 だけでは Gemini（rpm=10）の複数候補が約6秒間隔に並び、同時に生成されなくなるため
+DEFAULT_LIMITS = {
+    "claude": {"rpm": 50, "max_concurrent": 8, "expected_seconds": 8.0},
+    "gemini": {"rpm": 10, "max_concurrent": 4, "expected_seconds": 40.0},
+}
+
+
+class TokenBucket:
+    """1分あたり rate_per_minute 件、最大 burst 件まで連続で許可するトークンバケット"""
+
+    def __init__(self, rate_per_minute: float, burst: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, rate_per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """1件取得できるまでの秒数（0 なら今すぐ取得可能）"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RequestContext:
+    """呼び出し元の情報（セッション・優先度・待機中の通知先）"""
+
+    def __init__(
+        self,
+        session_id: str = "default",
+        priority: int = PRIORITY_INTERACTIVE,
+        on_wait: Optional[Callable[[Dict[str, Any]], None]] = None
+    ):
+        self.session_id = session_id
+        self.priority = priority
+        # 待機中に呼ばれる関数（待機しているスレッドから呼ばれる）
+        self.on_wait = on_wait
+
+
+_current_context: contextvars.ContextVar = contextvars.ContextVar("scheduler_request_context", default=None)
+
+
+@contextmanager
+def request_context(
+    session_id: str,
+    priority: int = PRIORITY_INTERACTIVE,
+    on_wait: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Iterator[RequestContext]:
+    """
+    このブロック内（および asyncio タスク・asyncio.to_thread の中）のAPI呼び出しに
+    セッションID・優先度を設定する
+    """
+    context = RequestContext(session_id, priority, on_wait)
+    token = _current_context.set(context)
+    try:
+        yield context
+    finally:
+        _current_context.reset(token)
+
+
+def current_context() -> RequestContext:
+    return _current_context.get() or RequestContext()
+
+
+class _Ticket:
+    """待ち行列の1件"""
+
+    def __init__(self, api: str, model: Optional[str], context: RequestContext):
+        self.id = uuid.uuid4().hex
+        self.api = api
+        self.model = model
+        self.session_id = context.session_id
+        self.priority = context.priority
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+
+
+class ApiScheduler:
+    """トークンバケット・同時実行数・公平な待ち行列によるAPI呼び出しの割り当て"""
+
+    def __init__(self, limits: Optional[Dict[str, Dict[str, float]]] = None,
+                 model_limits: Optional[Dict[str, float]] = None):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._limits: Dict[str, Dict[str, float]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._model_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._model_limits = dict(model_limits or {})
+        # API -> 優先度 -> セッションID -> 待機中のチケット
+        self._queues: Dict[str, Dict[int, "OrderedDict[str, deque]"]] = {}
+        self._running: Dict[str, int] = {}
+        # API -> 直近の処理時間（予想待ち時間の計算用）
+        self._durations: Dict[str, deque] = {}
+        self.granted = 0
+        self.waited = 0
+
+        for api, values in (limits or DEFAULT_LIMITS).items():
+            self.configure(api, **values)
+
+    def configure(self, api: str, rpm: float, max_concurrent: int, expected_seconds: float = 10.0,
+                  burst: Optional[float] = None) -> None:
+        """APIごとの上限を設定（burst を省略した場合は max_concurrent と rpm / 6 の大きい方）"""
+        if burst is None:
+            burst = max(float(max_concurrent), rpm / 6.0)
+        with self._lock:
+            self._limits[api] = {
+                "rpm": rpm, "max_concurrent": max_concurrent, "expected_seconds": expected_seconds, "burst": burst
+            }
+            self._buckets[api] = TokenBucket(rpm, burst)
+            self._queues.setdefault(api, {})
+            self._running.setdefault(api, 0)
+            self._durations.setdefault(api, deque(maxlen=20))
+
+    def _model_bucket(self, api: str, model: Optional[str]) -> Optional[TokenBucket]:
+        if model is None or model not in self._model_limits:
+            return None
+        key = (api, model)
+        if key not in self._model_buckets:
+            # モデル単位の上限でも、APIの burst までは同時に送れるようにする
+            self._model_buckets[key] = TokenBucket(self._model_limits[model], self._buckets[api].capacity)
+        return self._model_buckets[key]
+
+    def _ensure_api(self, api: str) -> None:
+        if api not in self._limits:
+            raise KeyError(f"スケジューラに未登録のAPIです: {api}")
+
+    def _order(self, api: str) -> List[_Ticket]:
+        """待ち行列の実行順（優先度順、同じ優先度の中ではセッションごとに順番に）"""
+        order = []
+        for priority in sorted(self._queues[api]):
+            sessions = [list(tickets) for tickets in self._queues[api][priority].values()]
+            depth = 0
+            while any(depth < len(tickets) for tickets in sessions):
+                order.extend(tickets[depth] for tickets in sessions if depth < len(tickets))
+                depth += 1
+        return order
+
+    def _enqueue(self, ticket: _Ticket) -> None:
+        sessions = self._queues[ticket.api].setdefault(ticket.priority, OrderedDict())
+        sessions.setdefault(ticket.session_id, deque()).append(ticket)
+
+    def _dequeue(self, ticket: _Ticket) -> None:
+        sessions = self._queues[ticket.api].get(ticket.priority, {})
+        tickets = sessions.get(ticket.session_id)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        # 割り当てを受けたセッションは同じ優先度の最後に回す
+        if tickets:
+            sessions.move_to_end(ticket.session_id)
+        else:
+            del sessions[ticket.session_id]
+        if not sessions:
+            del self._queues[ticket.api][ticket.priority]
+
+    def _try_grant(self, ticket: _Ticket) -> Optional[float]:
+        """
+        割り当てを試みる（ロック内で呼ぶ）
+
+        Returns:
+            0: 割り当て済み / 正の値: トークンが貯まるまでの秒数 / None: 他のリクエストの完了待ち
+        """
+        if ticket.granted_at is not None:
+            return 0.0
+        order = self._order(ticket.api)
+        if not order or order[0] is not ticket:
+            return None
+        if self._running[ticket.api] >= self._limits[ticket.api]["max_concurrent"]:
+            return None
+
+        now = time.monotonic()
+        buckets = [self._buckets[ticket.api]]
+        model_bucket = self._model_bucket(ticket.api, ticket.model)
+        if model_bucket is not None:
+            buckets.append(model_bucket)
+        wait = max(bucket.wait_time(now) for bucket in buckets)
+        if wait > 0:
+            return wait
+
+        for bucket in buckets:
+            bucket.take()
+        self._dequeue(ticket)
+        self._running[ticket.api] += 1
+        ticket.granted_at = now
+        self.granted += 1
+        if now - ticket.enqueued_at > 0.01:
+            self.waited += 1
+        return 0.0
+
+    def _status(self, ticket: _Ticket) -> Dict[str, Any]:
+        """チケットの待ち順・予想待ち時間（ロック内で呼ぶ）"""
+        if ticket.granted_at is not None:
+            return {"state": "running", "api": ticket.api}
+
+        order = self._order(ticket.api)
+        index = order.index(ticket) if ticket in order else 0
+        limits = self._limits[ticket.api]
+        durations = self._durations[ticket.api]
+        expected = sum(durations) / len(durations) if durations else limits["expected_seconds"]
+
+        # 同時実行数による待ち: 前に並んでいる件数と実行中の件数から、空きが出るまでの周回数を見積もる
+        ahead = index + self._running[ticket.api]
+        rounds = max(0, ahead - limits["max_concurrent"] + 1)
+        concurrency_wait = -(-rounds // limits["max_concurrent"]) * expected
+        # レート制限による待ち: 前に並んでいる件数分のトークンが貯まるまで
+        bucket = self._buckets[ticket.api]
+        bucket.wait_time(time.monotonic())
+        token_wait = max(0.0, index + 1 - bucket.tokens) / bucket.rate
+
+        return {
+            "state": "queued",
+            "api": ticket.api,
+            "position": index + 1,
+            "queued": len(order),
+            "eta_seconds": max(concurrency_wait, token_wait),
+            "waited_seconds": time.monotonic() - ticket.enqueued_at,
+        }
+
+    def _release(self, ticket: _Ticket) -> None:
+        with self._changed:
+            if ticket.granted_at is not None:
+                self._running[ticket.api] -= 1
+                self._durations[ticket.api].append(time.monotonic() - ticket.granted_at)
+            else:
+                self._dequeue(ticket)
+            self._changed.notify_all()
+
+    def acquire(self, api: str, model: Optional[str] = None, context: Optional[RequestContext] = None,
+                blocking: bool = True) -> Optional[_Ticket]:
+        """
+        順番が来るまで待って実行枠を取得（release() で返却）
+        blocking=False の場合は待たず、すぐに割り当てられなければ None を返す（ヘッジなど、空きがある時だけ送る用）
+        """
+        self._ensure_api(api)
+        context = context or current_context()
+        ticket = _Ticket(api, model, context)
+        with self._changed:
+            self._enqueue(ticket)
+            if not blocking:
+                if self._try_grant(ticket) == 0:
+                    return ticket
+                self._dequeue(ticket)
+                return None
+            self._changed.notify_all()
+            try:
+                while True:
+                    wait = self._try_grant(ticket)
+                    if wait == 0:
+                        return ticket
+                    if context.on_wait is not None:
+                        status = self._status(ticket)
+                        # 通知先の処理中はロックを外す（UI描画などで他のリクエストを止めない）
+                        self._lock.release()
+                        try:
+                            context.on_wait(status)
+                        finally:
+                            self._lock.acquire()
+                    self._changed.wait(min(wait, 0.5) if wait is not None else 0.5)
+            except BaseException:
+                self._dequeue(ticket)
+                self._changed.notify_all()
+                raise
+
+    def release(self, ticket: _Ticket) -> None:
+        """実行枠を返却"""
+        self._release(ticket)
+
+    @contextmanager
+    def slot(self, api: str, model: Optional[str] = None) -> Iterator[_Ticket]:
+        """with scheduler.slot("gemini", model): の間だけ実行枠を確保"""
+        ticket = self.acquire(api, model)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def slot_async(self, api: str, model: Optional[str] = None):
+        """slot() の非同期版（待機中もイベントループを止めない。キャンセルされた場合は待ち行列から外す）"""
+        self._ensure_api(api)
+        ticket = _Ticket(api, model, current_context())
+        with self._changed:
+            self._enqueue(ticket)
+        try:
+            while True:
+                with self._changed:
+                    wait = self._try_grant(ticket)
+                if wait == 0:
+                    break
+                await asyncio.sleep(min(wait, 0.25) if wait is not None else 0.1)
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def session_status(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """セッションの待機中（なければ実行中）のリクエストの状態"""
+        with self._lock:
+            for api, priorities in self._queues.items():
+                for sessions in priorities.values():
+                    tickets = sessions.get(session_id)
+                    if tickets:
+                        return self._status(tickets[0])
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """APIごとの実行中・待機中の件数"""
+        with self._lock:
+            apis = {}
+            for api in self._limits:
+                apis[api] = {
+                    "running": self._running[api],
+                    "queued": len(self._order(api)),
+                    "max_concurrent": self._limits[api]["max_concurrent"],
+                    "rpm": self._limits[api]["rpm"],
+                    "burst": self._limits[api]["burst"],
+                }
+            return {"granted": self.granted, "waited": self.waited, "apis": apis}
+
+
+def _limits_from_env() -> Dict[str, Dict[str, float]]:
+    limits = {}
+    for api, values in DEFAULT_LIMITS.items():
+        prefix = api.upper()
+        limits[api] = dict(
+            values,
+            rpm=float(os.getenv(f"{prefix}_RPM", values["rpm"])),
+            max_concurrent=int(os.getenv(f"{prefix}_MAX_CONCURRENT", values["max_concurrent"])),
+        )
+        if os.getenv(f"{prefix}_BURST"):
+            limits[api]["burst"] = float(os.getenv(f"{prefix}_BURST"))
+    return limits
+
+
+_scheduler: Optional[ApiScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> ApiScheduler:
+    """
+    プロセス共通のスケジューラを取得
+    上限は環境変数 CLAUDE_RPM / GEMINI_RPM / <API>_MAX_CONCURRENT / <API>_BURST、
+    モデル単位の上限は SCHEDULER_MODEL_RPM（JSON: {"モデル名": 1分あたりの件数}）で設定する
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ApiScheduler(_limits_from_env(), json.loads(os.getenv("SCHEDULER_MODEL_RPM", "{}")))
+        return _scheduler
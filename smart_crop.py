@@ -0,0 +1,294 @@
+"""
+マルチフォーマット書き出し（1枚のマスター画像から各比率を切り出す）
+Instagram・ストーリー・YouTube・チラシなどの比率ごとに生成し直す代わりに、
+広めの構図で1枚だけ生成し、人物（肌色）・輪郭・色の目立つ部分を残すように NumPy で切り出し位置を決める
+切り出し位置は 0〜1 の offset（切り出せる範囲のどこに置くか）で表し、画面から手動で調整できる
+"""
+
+import io
+import time
+from pathlib import Path
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from app_config import ASPECT_RATIOS
+from output_store import OutputStore
+from result_buffers import get_result_buffers
+from metrics import log_event, span
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# 書き出す形式: 名前 -> (表示名, 比率)
+EXPORT_FORMATS = {
+    "instagram": ("Instagram", "1:1"),
+    "instagram_portrait": ("Instagram 縦", "4:5"),
+    "story": ("ストーリー", "9:16"),
+    "youtube": ("YouTube", "16:9"),
+    "flyer": ("チラシ", "4:3"),
+}
+
+# マスター画像の生成時にプロンプトへ追加する構図の指示（どの比率に切り出しても人物が切れないようにする）
+MASTER_FRAMING_INSTRUCTION = (
+    "FRAMING: This image is a master that will be cropped to both vertical (9:16) and horizontal (16:9) formats. "
+    "Use a slightly wide shot with the main people and products grouped near the center, "
+    "keep generous empty margin around them on every side, and never place faces or key products near the edges."
+)
+
+# 注目度マップの計算に使う縮小サイズ（長辺）と各要素の重み
+SALIENCY_SIZE = 256
+EDGE_WEIGHT = 1.0
+COLOR_WEIGHT = 0.6
+SKIN_WEIGHT = 2.0
+# 切り出し枠の端で肌色（顔・手）を切る場合の減点（切り出す列・行の肌色の量に対する倍率）
+SKIN_CUT_PENALTY = 8.0
+
+
+def parse_ratio(ratio: str) -> float:
+    """"16:9" 形式の比率を 幅/高さ の値に変換"""
+    width, height = ratio.split(":")
+    return float(width) / float(height)
+
+
+def master_aspect_ratio(ratios: List[str], candidates: Optional[List[str]] = None) -> str:
+    """
+    各比率に切り出したときに残る面積の最小値が最も大きくなるマスターの比率
+    （例: 9:16〜16:9 を含む場合は 1:1）
+    """
+    targets = [parse_ratio(ratio) for ratio in ratios]
+
+    def worst_coverage(candidate: str) -> float:
+        master = parse_ratio(candidate)
+        return min(min(master, target) / max(master, target) for target in targets)
+
+    return max(candidates or list(ASPECT_RATIOS.values()), key=worst_coverage)
+
+
+def master_prompt(prompt: str) -> str:
+    """マスター画像用に構図の指示を加えたプロンプト"""
+    return f"{prompt}\n\n{MASTER_FRAMING_INSTRUCTION}"
+
+
+def _normalize(values: "np.ndarray") -> "np.ndarray":
+    peak = float(values.max())
+    return values / peak if peak > 0 else values
+
+
+def _box_blur(values: "np.ndarray", radius: int) -> "np.ndarray":
+    """累積和による平均化（半径 radius の正方形）"""
+    import numpy as np
+
+    if radius <= 0:
+        return values
+    padded = np.pad(values, radius + 1, mode="edge")
+    summed = padded.cumsum(axis=0).cumsum(axis=1)
+    size = 2 * radius + 1
+    window = (summed[size:, size:] - summed[:-size, size:] - summed[size:, :-size] + summed[:-size, :-size])
+    return window[:values.shape[0], :values.shape[1]] / (size * size)
+
+
+def saliency_maps(image: Any) -> "Tuple[np.ndarray, np.ndarray]":
+    """
+    縮小した画像から注目度マップと肌色マスクを計算
+
+    Returns:
+        (注目度 [h, w] 合計1に正規化, 肌色マスク [h, w] 0/1)
+    """
+    # NumPy は切り出し位置を計算する時点で読み込む（起動時間を増やさない）
+    import numpy as np
+
+    small = image.convert("RGB")
+    small.thumbnail((SALIENCY_SIZE, SALIENCY_SIZE))
+    rgb = np.asarray(small, dtype=np.float32) / 255.0
+
+    # 輪郭（輝度の勾配）
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    edges = np.abs(np.diff(gray, axis=1, append=gray[:, -1:])) + np.abs(np.diff(gray, axis=0, append=gray[-1:, :]))
+
+    # 色の目立ち具合（画像全体の平均色からの距離）
+    color = np.linalg.norm(rgb - rgb.reshape(-1, 3).mean(axis=0), axis=2)
+
+    # 肌色（YCbCr の範囲）: 人物・顔の位置の手がかり
+    r, g, b = rgb[..., 0] * 255, rgb[..., 1] * 255, rgb[..., 2] * 255
+    y = 0.299 * r + 0.587 * g + 0.114 * b
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    skin = ((cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173) & (y > 40)).astype(np.float32)
+    # 小さな点（ノイズ）は除き、まとまった領域だけを残す
+    skin = (_box_blur(skin, 2) > 0.5).astype(np.float32)
+
+    radius = max(1, min(gray.shape) // 64)
+    saliency = (
+        EDGE_WEIGHT * _normalize(_box_blur(edges, radius))
+        + COLOR_WEIGHT * _normalize(_box_blur(color, radius))
+        + SKIN_WEIGHT * _box_blur(skin, radius)
+    )
+    total = float(saliency.sum())
+    return (saliency / total if total > 0 else saliency), skin
+
+
+def crop_box(size: Tuple[int, int], ratio: str, offset: float) -> Tuple[int, int, int, int]:
+    """
+    比率 ratio の最大の切り出し枠 (left, top, right, bottom)
+    offset は切り出せる範囲での位置（0: 左・上端 / 1: 右・下端）
+    """
+    width, height = size
+    target = parse_ratio(ratio)
+    offset = min(1.0, max(0.0, offset))
+    if width / height > target:
+        crop_width = max(1, round(height * target))
+        left = round((width - crop_width) * offset)
+        return left, 0, left + crop_width, height
+    crop_height = max(1, round(width / target))
+    top = round((height - crop_height) * offset)
+    return 0, top, width, top + crop_height
+
+
+def _best_offset(profile: "np.ndarray", skin_profile: "np.ndarray", window: int) -> Tuple[float, float]:
+    """1次元の注目度の並びで、window 幅の合計（端で肌色を切る分は減点）が最大になる位置"""
+    import numpy as np
+
+    slack = len(profile) - window
+    if slack <= 0:
+        return 0.5, float(profile.sum())
+    cumulative = np.concatenate(([0.0], np.cumsum(profile)))
+    inside = cumulative[window:] - cumulative[:-window]
+    starts = np.arange(slack + 1)
+    # 枠の左（上）端の1列と右（下）端の1列にかかる肌色を減点
+    cut = skin_profile[starts] + skin_profile[np.minimum(starts + window - 1, len(profile) - 1)]
+    scores = inside - SKIN_CUT_PENALTY * cut * profile.mean()
+    best = int(np.argmax(scores))
+    return best / slack, float(inside[best])
+
+
+def plan_crop(size: Tuple[int, int], ratio: str, saliency: "np.ndarray", skin: "np.ndarray") -> Dict[str, Any]:
+    """
+    比率 ratio の切り出し位置を決める
+
+    Returns:
+        {"ratio", "axis"（"x" / "y" / None）, "offset", "box", "coverage"（残る注目度の割合）}
+    """
+    width, height = size
+    target = parse_ratio(ratio)
+    map_height, map_width = saliency.shape
+    if abs(width / height - target) < 1e-3:
+        return {"ratio": ratio, "axis": None, "offset": 0.5, "box": (0, 0, width, height), "coverage": 1.0}
+
+    if width / height > target:
+        axis = "x"
+        profile, skin_profile = saliency.sum(axis=0), skin.mean(axis=0)
+        window = max(1, round(map_height * target))
+    else:
+        axis = "y"
+        profile, skin_profile = saliency.sum(axis=1), skin.mean(axis=1)
+        window = max(1, round(map_width / target))
+    offset, coverage = _best_offset(profile, skin_profile, min(window, len(profile)))
+    return {"ratio": ratio, "axis": axis, "offset": offset, "box": crop_box(size, ratio, offset), "coverage": coverage}
+
+
+@lru_cache(maxsize=32)
+def _plans_for(path: str, mtime_ns: int, ratios: Tuple[str, ...]) -> Dict[str, Dict[str, Any]]:
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        saliency, skin = saliency_maps(image)
+        return {ratio: plan_crop(image.size, ratio, saliency, skin) for ratio in ratios}
+
+
+def plan_crops(path: Path, ratios: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    画像の各比率の切り出し位置（注目度マップは1回だけ計算し、画像ごとにキャッシュ）
+
+    Returns:
+        {比率: plan_crop の結果}
+    """
+    path = Path(path)
+    return _plans_for(str(path), path.stat().st_mtime_ns, tuple(dict.fromkeys(ratios)))
+
+
+def crop_preview(path: Path, ratio: str, offset: float, max_edge: int = 480) -> bytes:
+    """切り出し結果の縮小プレビュー（JPEG）"""
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        preview = image.crop(crop_box(image.size, ratio, offset)).convert("RGB")
+    preview.thumbnail((max_edge, max_edge))
+    buffer = io.BytesIO()
+    preview.save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def export_formats(
+    record: Dict[str, Any],
+    store: OutputStore,
+    formats: Optional[List[str]] = None,
+    offsets: Optional[Dict[str, float]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    マスター画像（出力ストアのレコード）から各形式を切り出して出力ストアに保存
+
+    Args:
+        record: マスター画像のレコード（OutputStore.save / get の結果）
+        store: 保存先のストア
+        formats: EXPORT_FORMATS の名前（None の場合はすべて）
+        offsets: {形式名: 切り出し位置 0〜1}（指定がない形式は自動で決めた位置）
+
+    Returns:
+        {形式名: 保存したレコード（metadata に derived_from・crop を記録）}
+    """
+    from PIL import Image, ImageOps
+    from output_encoder import get_output_encoder
+
+    formats = [name for name in (formats or list(EXPORT_FORMATS)) if name in EXPORT_FORMATS]
+    offsets = offsets or {}
+    plans = plan_crops(Path(record["absolute_path"]), [EXPORT_FORMATS[name][1] for name in formats])
+    save_format = "JPEG" if record["mime_type"] == "image/jpeg" else "PNG"
+
+    exported = {}
+    started = time.perf_counter()
+    with span("export_formats", image_id=record["id"], formats=formats), Image.open(record["absolute_path"]) as image:
+        image = ImageOps.exif_transpose(image)
+        for name in formats:
+            ratio = EXPORT_FORMATS[name][1]
+            plan = plans[ratio]
+            offset = offsets.get(name, plan["offset"])
+            box = crop_box(image.size, ratio, offset)
+
+            buffer = io.BytesIO()
+            cropped = image.crop(box)
+            if save_format == "JPEG":
+                cropped.convert("RGB").save(buffer, format="JPEG", quality=95)
+            else:
+                cropped.save(buffer, format="PNG", compress_level=3)
+
+            data = buffer.getvalue()
+            generation_input = dict(record.get("generation_input") or {}, aspect_ratio=ratio)
+            derived = store.save(
+                data,
+                mime_type=record["mime_type"],
+                prompt=record.get("prompt"),
+                generation_input=generation_input,
+                reference_hashes=record.get("reference_hashes"),
+                metadata={
+                    "derived_from": record["id"],
+                    "export_format": name,
+                    "crop": {"box": list(box), "offset": offset, "auto_offset": plan["offset"], "manual": name in offsets},
+                }
+            )
+            get_result_buffers().put(derived["id"], data)
+            get_output_encoder().submit(derived, store)
+            exported[name] = derived
+
+    # 位置を調整して書き出し直した形式だけを置き換える
+    current = store.get(record["id"]) or record
+    exports = dict((current.get("metadata") or {}).get("exports") or {})
+    exports.update({name: derived["id"] for name, derived in exported.items()})
+    store.update_metadata(record["id"], exports=exports)
+    log_event(
+        "formats_exported",
+        f"✂️ マルチフォーマット書き出し: {len(exported)}形式（{time.perf_counter() - started:.2f}s）",
+        image_id=record["id"], formats=list(exported)
+    )
+    return exported
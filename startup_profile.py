@@ -0,0 +1,163 @@
+"""
+起動時間の計測ツール
+app.py のモジュールごとの import 時間と、新しいプロセスで最初の画面描画が終わるまでの時間を計測する
+--budget を指定すると、描画までの時間が予算を超えた場合に終了コード 1 を返す（リグレッションチェック用）
+
+使い方:
+    python startup_profile.py
+    python startup_profile.py --budget 2.5 --runs 3
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+APP_DIR = Path(__file__).parent
+APP_PATH = APP_DIR / "app.py"
+DEFAULT_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "3.0"))
+
+# 新しいプロセスで最初の描画（1回目のスクリプト実行）が終わるまでを計測するスクリプト
+# Streamlit 本体の読み込みはサーバー起動時に済んでいるため別に計測する
+_FIRST_PAINT_SCRIPT = """
+import os, sys, json, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+framework = time.perf_counter() - started
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+started = time.perf_counter()
+at.run()
+first_paint = time.perf_counter() - started
+print(json.dumps({
+    "framework_seconds": framework,
+    "first_paint_seconds": first_paint,
+    "exceptions": [e.message for e in at.exception],
+}))
+sys.stdout.flush()
+# 先読みなどのバックグラウンドスレッドを待たずに終了
+os._exit(0)
+"""
+
+
+def _subprocess_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    # APIキー未設定の場合もエラー表示で終わらず、通常の画面を描画させる（描画まではAPIを呼ばない）
+    env.setdefault("ANTHROPIC_API_KEY", "startup-profile")
+    env.setdefault("GEMINI_API_KEY", "startup-profile")
+    return env
+
+
+def import_profile(module: str = "app") -> List[Dict[str, Any]]:
+    """
+    新しいプロセスで module を import し、-X importtime の結果を返す
+
+    Returns:
+        [{"module", "self_seconds", "cumulative_seconds", "depth"}, ...]（import された順）
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=APP_DIR, env=_subprocess_env(), capture_output=True, text=True
+    )
+    entries = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # "import time:  self [us] | cumulative | モジュール名（インデントが深さ）"
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        name = name[1:]
+        entries.append({
+            "module": name.strip(),
+            "self_seconds": int(self_us) / 1e6,
+            "cumulative_seconds": int(cumulative_us) / 1e6,
+            "depth": (len(name) - len(name.lstrip(" "))) // 2,
+        })
+    if completed.returncode != 0:
+        raise RuntimeError(f"{module} の import に失敗しました:\n{completed.stderr[-2000:]}")
+    return entries
+
+
+def measure_first_paint(runs: int = 1) -> Dict[str, Any]:
+    """
+    新しいプロセスで app.py を1回実行し、描画完了までの時間を計測（runs 回の中央値）
+
+    Returns:
+        {"first_paint_seconds", "framework_seconds", "samples", "exceptions"}
+    """
+    samples = []
+    framework = []
+    exceptions: List[str] = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-c", _FIRST_PAINT_SCRIPT, str(APP_PATH)],
+            cwd=APP_DIR, env=_subprocess_env(), capture_output=True, text=True
+        )
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("{")]
+        if not lines:
+            raise RuntimeError(f"起動時間の計測に失敗しました:\n{completed.stderr[-2000:]}")
+        result = json.loads(lines[-1])
+        samples.append(result["first_paint_seconds"])
+        framework.append(result["framework_seconds"])
+        exceptions.extend(result["exceptions"])
+
+    return {
+        "first_paint_seconds": statistics.median(samples),
+        "framework_seconds": statistics.median(framework),
+        "samples": samples,
+        "exceptions": exceptions,
+    }
+
+
+def print_report(entries: List[Dict[str, Any]], paint: Optional[Dict[str, Any]], top: int = 15) -> None:
+    """import 時間と描画時間のレポートを表示"""
+    root = next((entry for entry in reversed(entries) if entry["depth"] == 0), None)
+    if root is not None:
+        print(f"📦 import {root['module']}: {root['cumulative_seconds']:.3f}s")
+
+    # app.py が直接 import しているモジュール（配下の import を含む時間）
+    direct = [entry for entry in entries if entry["depth"] == 1]
+    print("\n◆ 直接 import しているモジュール（累積時間順）")
+    for entry in sorted(direct, key=lambda e: e["cumulative_seconds"], reverse=True)[:top]:
+        print(f"   {entry['cumulative_seconds']:8.3f}s  {entry['module']}")
+
+    print("\n◆ 単体の import 時間が長いモジュール")
+    for entry in sorted(entries, key=lambda e: e["self_seconds"], reverse=True)[:top]:
+        print(f"   {entry['self_seconds']:8.3f}s  {entry['module']}")
+
+    if paint is not None:
+        samples = ", ".join(f"{sample:.3f}s" for sample in paint["samples"])
+        print(f"\n⏱ Streamlit 読み込み: {paint['framework_seconds']:.3f}s")
+        print(f"⏱ 最初の描画まで: {paint['first_paint_seconds']:.3f}s（{samples}）")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="app.py の起動時間を計測")
+    parser.add_argument("--budget", type=float, nargs="?", const=DEFAULT_BUDGET_SECONDS,
+                        help=f"最初の描画までの許容時間（秒）。超えた場合は終了コード 1（デフォルト: {DEFAULT_BUDGET_SECONDS}）")
+    parser.add_argument("--runs", type=int, default=1, help="描画時間の計測回数（中央値を使用）")
+    parser.add_argument("--top", type=int, default=15, help="表示するモジュール数")
+    parser.add_argument("--imports-only", action="store_true", help="import 時間だけを計測")
+    args = parser.parse_args(argv)
+
+    entries = import_profile("app")
+    paint = None if args.imports_only else measure_first_paint(args.runs)
+    print_report(entries, paint, args.top)
+
+    if paint is None:
+        return 0
+    if paint["exceptions"]:
+        print(f"❌ 描画中にエラーが発生しました: {paint['exceptions']}")
+        return 1
+    if args.budget is not None:
+        if paint["first_paint_seconds"] > args.budget:
+            print(f"❌ 予算超過: {paint['first_paint_seconds']:.3f}s > {args.budget:.3f}s")
+            return 1
+        print(f"✅ 予算内: {paint['first_paint_seconds']:.3f}s <= {args.budget:.3f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
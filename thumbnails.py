@@ -0,0 +1,161 @@
+"""
+サムネイルキャッシュ
+生成画像の縮小版を必要になった時点でプロセスプールで作成し、内容ハッシュごとにディスクへ保存する
+履歴ギャラリーは表示中のページ分だけサムネイルを要求するため、出力が増えても表示時間は変わらない
+"""
+
+import os
+import sys
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+from typing import Dict, Any, List, Optional
+
+from metrics import log_event
+
+DEFAULT_CACHE_DIR = Path(__file__).parent / "cache" / "thumbnails"
+DEFAULT_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+DEFAULT_QUALITY = 80
+
+
+def _render_thumbnail(source: str, target: str, size: int, quality: int) -> str:
+    """サムネイルを作成して保存（プロセスプールで実行するためモジュール直下に定義）"""
+    from PIL import Image, ImageOps
+
+    target_path = Path(target)
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(source) as img:
+        # 縮小前提のデコード（JPEGは縮小した解像度で読み込まれる）
+        img.draft("RGB", (size, size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((size, size), Image.LANCZOS)
+        tmp_path = target_path.with_name(f".tmp_{os.getpid()}_{target_path.name}")
+        img.convert("RGB").save(tmp_path, format="JPEG", quality=quality, optimize=True)
+    os.replace(tmp_path, target_path)
+    return target
+
+
+class ThumbnailCache:
+    """
+    内容ハッシュをキーにしたサムネイルのディスクキャッシュ
+    ファイル: <cache_dir>/<hash先頭2文字>/<hash>_<size>.jpg
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        size: int = DEFAULT_SIZE,
+        quality: int = DEFAULT_QUALITY,
+        max_workers: Optional[int] = None
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.size = size
+        self.quality = quality
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.built = 0
+        self.hits = 0
+        self.failures = 0
+
+    def path_for(self, content_hash: str) -> Path:
+        """内容ハッシュに対応するサムネイルのパス"""
+        return self.cache_dir / content_hash[:2] / f"{content_hash}_{self.size}.jpg"
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # 最初にサムネイルが必要になるまでワーカープロセスを起動しない
+        # Streamlit のプロセスはマルチスレッドのため、ロックを引き継がないよう fork ではなく
+        # forkserver（Windows では spawn）でワーカーを作る
+        with self._lock:
+            if self._executor is None:
+                method = "spawn" if sys.platform == "win32" else "forkserver"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context(method)
+                )
+            return self._executor
+
+    def _reset_executor(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def ensure(self, records: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
+        """
+        出力ストアのレコードに対応するサムネイルを用意（未作成の分だけプロセスプールで作成）
+
+        Args:
+            records: OutputStore.query() の結果（"id", "content_hash", "absolute_path" を使用）
+
+        Returns:
+            {画像ID: サムネイルのパス（作成に失敗した場合は None）}
+        """
+        thumbnails: Dict[str, Optional[str]] = {}
+        missing = []
+        for record in records:
+            target = self.path_for(record["content_hash"])
+            if target.exists():
+                self.hits += 1
+                thumbnails[record["id"]] = str(target)
+            elif Path(record["absolute_path"]).exists():
+                missing.append((record, target))
+            else:
+                thumbnails[record["id"]] = None
+
+        if not missing:
+            return thumbnails
+
+        args = [(record["absolute_path"], str(target), self.size, self.quality) for record, target in missing]
+        try:
+            executor = self._get_executor()
+            futures = [executor.submit(_render_thumbnail, *arg) for arg in args]
+            outcomes = []
+            for future in futures:
+                try:
+                    outcomes.append(future.result())
+                except BrokenExecutor:
+                    raise
+                except Exception as e:
+                    log_event("thumbnail_error", f"⚠️ サムネイル作成エラー: {e}", level="warning", error=str(e))
+                    outcomes.append(None)
+        except BrokenExecutor:
+            # ワーカーが異常終了した場合はプールを作り直し、今回はこのプロセスで作成
+            self._reset_executor()
+            outcomes = []
+            for arg in args:
+                try:
+                    outcomes.append(_render_thumbnail(*arg))
+                except Exception as e:
+                    log_event("thumbnail_error", f"⚠️ サムネイル作成エラー: {e}", level="warning", error=str(e))
+                    outcomes.append(None)
+
+        for (record, _), outcome in zip(missing, outcomes):
+            if outcome is None:
+                self.failures += 1
+            else:
+                self.built += 1
+            thumbnails[record["id"]] = outcome
+        return thumbnails
+
+    def stats(self) -> Dict[str, int]:
+        """作成・キャッシュヒット・失敗の件数"""
+        return {"built": self.built, "hits": self.hits, "failures": self.failures}
+
+    def close(self) -> None:
+        """ワーカープロセスを終了"""
+        self._reset_executor()
+
+
+_default_thumbnail_cache: Optional[ThumbnailCache] = None
+_default_thumbnail_cache_lock = threading.Lock()
+
+
+def get_thumbnail_cache() -> ThumbnailCache:
+    """プロセス共通のデフォルトサムネイルキャッシュを取得"""
+    global _default_thumbnail_cache
+    with _default_thumbnail_cache_lock:
+        if _default_thumbnail_cache is None:
+            _default_thumbnail_cache = ThumbnailCache()
+        return _default_thumbnail_cache